@@ -1,33 +1,57 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 27, 2020
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """Python API for the `chat-archive` program."""
 
 # Standard library modules.
+import asyncio
 import collections
 import importlib
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # External dependencies.
-from humanfriendly import concatenate, format, parse_path, pluralize
-from pkg_resources import iter_entry_points
+from humanfriendly import Timer, concatenate, format, parse_path, pluralize
 from property_manager import lazy_property, mutable_property
-from sqlalchemy import func
+from sqlalchemy import and_, bindparam, func, or_, text
 from update_dotdee import ConfigLoader
 from verboselogs import VerboseLogger
 
 # Modules included in our package.
-from chat_archive.backends import ChatArchiveBackend
-from chat_archive.database import SchemaManager
+from chat_archive.backends import ChatArchiveBackend, discover_backends, find_friendly_name
+from chat_archive.database import SchemaManager, WriteSerializer, get_sqlite_profile
 from chat_archive.models import Account, Base, Contact, Conversation, EmailAddress, Message
+from chat_archive.search import SEARCH_INDEX_TABLE, compile_match_expression, is_indexable_keyword
+from chat_archive.stats import STATS_COLUMNS, STATS_TABLE, populate_archive_stats
 from chat_archive.utils import get_full_name
 
 DEFAULT_ACCOUNT_NAME = "default"
 """The name of the default account (a string)."""
 
+SCHEMA_REVISION = "297839a65f50"
+"""
+The head revision of the Alembic migration scripts included in this package (a string).
+
+This is used to check whether the database schema is up to date without
+importing Alembic. It needs to be updated whenever a migration is added
+(the test suite verifies that it matches the migration scripts).
+"""
+
+SQLITE_HAS_UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
+"""
+:data:`True` when SQLite supports ``UPDATE ... FROM`` (version 3.33 or newer), :data:`False` otherwise.
+
+Used by :func:`ChatArchive.update_message_positions()` to decide whether
+positions can be numbered by SQLite or need to be numbered in Python.
+"""
+
+SQLITE_PRAGMA_OPTIONS = ("journal-mode", "synchronous", "cache-size", "mmap-size", "temp-store", "busy-timeout")
+"""The configuration options that override individual SQLite pragmas (a tuple of strings)."""
+
 # Semi-standard package versioning.
 __version__ = "4.0.3"
 
@@ -61,8 +85,20 @@ class ChatArchive(SchemaManager):
          'hangouts': 'chat_archive.backends.hangouts',
          'slack': 'chat_archive.backends.slack',
          'telegram': 'chat_archive.backends.telegram'}
+
+        Refer to :func:`.discover_backends()` for details.
+        """
+        return dict(discover_backends())
+
+    @lazy_property
+    def changed_conversations(self):
+        """
+        The conversations whose messages need to be renumbered (a :class:`set` of :class:`.Conversation` objects).
+
+        Backends add conversations to this set when they import new messages,
+        refer to :func:`update_message_positions()` for details.
         """
-        return dict((ep.name, ep.module_name) for ep in iter_entry_points("chat_archive.backends"))
+        return set()
 
     @lazy_property
     def config(self):
@@ -140,11 +176,48 @@ class ChatArchive(SchemaManager):
         """
         return False
 
+    @lazy_property
+    def have_archive_stats(self):
+        """
+        :data:`True` if the database contains the statistics table, :data:`False` otherwise.
+
+        The statistics table is only available when the database is SQLite
+        (refer to :mod:`chat_archive.stats`).
+        """
+        if self.database_engine.dialect.name == "sqlite":
+            query = text("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = :name")
+            return bool(self.session.execute(query, dict(name=STATS_TABLE)).scalar())
+        return False
+
+    @lazy_property
+    def have_search_index(self):
+        """
+        :data:`True` if the database contains the full-text search index, :data:`False` otherwise.
+
+        The search index is only available when the database is SQLite and
+        SQLite was compiled with FTS5 support (refer to :mod:`chat_archive.search`).
+        """
+        if self.database_engine.dialect.name == "sqlite":
+            query = text("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = :name")
+            return bool(self.session.execute(query, dict(name=SEARCH_INDEX_TABLE)).scalar())
+        return False
+
     @lazy_property
     def import_stats(self):
         """Statistics about objects imported by backends (a :class:`BackendStats` object)."""
         return BackendStats()
 
+    @mutable_property
+    def jobs(self):
+        """
+        The number of accounts to synchronize concurrently (an integer, defaults to 1).
+
+        When this is greater than one :func:`synchronize()` uses
+        :func:`synchronize_concurrently()` to synchronize multiple accounts at
+        the same time.
+        """
+        return 1
+
     @property
     def num_contacts(self):
         """The total number of chat contacts in the local archive (a number)."""
@@ -187,11 +260,51 @@ class ChatArchive(SchemaManager):
             value = get_full_name()
         return value
 
+    @property
+    def schema_revision(self):
+        """The head revision of the migration scripts (the value of :data:`SCHEMA_REVISION`)."""
+        return SCHEMA_REVISION
+
+    @mutable_property
+    def sqlite_pragmas(self):
+        """
+        The SQLite pragmas applied to new database connections (a dictionary).
+
+        This defaults to the pragmas of the profile given by
+        :attr:`sqlite_profile`. Individual pragmas can be overridden in the
+        configuration file using the options in :data:`SQLITE_PRAGMA_OPTIONS`:
+
+        .. code-block:: ini
+
+           [chat-archive]
+           sqlite-profile = fast
+           cache-size = -262144
+           busy-timeout = 30000
+        """
+        pragmas = get_sqlite_profile(self.sqlite_profile)
+        for option in SQLITE_PRAGMA_OPTIONS:
+            value = self.config.get(option)
+            if value:
+                pragmas[option.replace("-", "_")] = value
+        return pragmas
+
+    @mutable_property
+    def sqlite_profile(self):
+        """
+        The name of a profile in :data:`~chat_archive.database.SQLITE_PROFILES` (a string).
+
+        The value of this property is taken from the ``sqlite-profile`` option
+        in the configuration file and defaults to 'fast'.
+        """
+        return self.config.get("sqlite-profile", "fast")
+
     def commit_changes(self):
         """Show import statistics when committing database changes to disk."""
         # Show import statistics just before every commit, to give the
         # operator something nice to look at while they're waiting 😇.
         self.import_stats.show()
+        # Renumber the messages in conversations that received new messages.
+        self.update_message_positions()
         # Commit database changes to disk (and possibly save profile data).
         return super(ChatArchive, self).commit_changes()
 
@@ -212,10 +325,46 @@ class ChatArchive(SchemaManager):
             if backend_name == configured_backend:
                 yield configured_account or DEFAULT_ACCOUNT_NAME
 
+    def get_archive_stats(self):
+        """
+        Get statistics about the messages in the local archive.
+
+        :returns: A dictionary with the keys given by :data:`.STATS_COLUMNS`
+                  and integers as values.
+
+        When :attr:`have_archive_stats` is :data:`True` the statistics are
+        computed from the counters per conversation, otherwise a full scan of
+        the messages is required.
+        """
+        if self.have_archive_stats:
+            query = text(
+                "SELECT %s FROM %s" % (", ".join("COALESCE(SUM(%s), 0)" % name for name in STATS_COLUMNS), STATS_TABLE)
+            )
+            values = self.session.execute(query).fetchone()
+        else:
+            values = self.session.query(
+                func.count(Message.id),
+                func.count(Message.html),
+                func.coalesce(func.sum(func.length(Message.text)), 0),
+                func.coalesce(func.sum(func.length(Message.html)), 0),
+            ).one()
+        return dict(zip(STATS_COLUMNS, values))
+
     def get_backend_name(self, backend_name):
-        """Get a human friendly name for the given backend."""
-        module = self.load_backend_module(backend_name)
-        return getattr(module, "FRIENDLY_NAME", backend_name)
+        """
+        Get a human friendly name for the given backend.
+
+        :param backend_name: The name of the backend (a string).
+        :returns: The friendly name of the backend (a string).
+
+        The backend module is only imported when :func:`.find_friendly_name()`
+        can't determine the friendly name by itself.
+        """
+        friendly_name = find_friendly_name(self.backends[backend_name])
+        if not friendly_name:
+            module = self.load_backend_module(backend_name)
+            friendly_name = getattr(module, "FRIENDLY_NAME", backend_name)
+        return friendly_name
 
     def get_backends_and_accounts(self, *backends):
         """Select backends and accounts to synchronize."""
@@ -284,8 +433,86 @@ class ChatArchive(SchemaManager):
         backend_name, _, account_name = value.partition(":")
         return backend_name, account_name
 
+    def recompute_archive_stats(self):
+        """
+        Recompute the statistics table from scratch.
+
+        This is only needed when the statistics table got out of sync with
+        the messages (for example because the database was modified by an
+        older version of the `chat-archive` program).
+        """
+        if self.have_archive_stats:
+            timer = Timer()
+            logger.info("Recomputing archive statistics ..")
+            populate_archive_stats(self.session)
+            self.commit_changes()
+            logger.verbose("Recomputed archive statistics in %s.", timer)
+        else:
+            logger.warning("The database doesn't contain a statistics table! (this requires SQLite)")
+
+    def rerender_messages(self, start_id=0):
+        """
+        Regenerate the HTML and text of messages based on their raw text.
+
+        :param start_id: Only messages whose :attr:`~chat_archive.models.Message.id`
+                         is greater than this value are processed (an integer,
+                         used to resume an interrupted run).
+        :returns: The number of messages that were updated (an integer).
+
+        This calls :func:`~chat_archive.backends.ChatArchiveBackend.rerender_messages()`
+        for each account with messages whose :attr:`~chat_archive.models.Message.raw`
+        text is available (currently only the Slack backend stores this).
+        """
+        num_updated = 0
+        query = (
+            self.session.query(Account)
+            .filter(Account.conversations.any(Conversation.messages.any(Message.raw != None)))
+            .order_by(Account.id)
+        )
+        for account in query.all():
+            backend_name = self.get_backend_name(account.backend)
+            logger.info("Re-rendering %s messages in %r account ..", backend_name, account.name)
+            backend = self.initialize_backend(account.backend, account.name)
+            num_updated += backend.rerender_messages(start_id)
+        self.commit_changes()
+        return num_updated
+
     def search_messages(self, keywords):
-        """Search the chat messages in the local archive for the given keyword(s)."""
+        """
+        Search the chat messages in the local archive for the given keyword(s).
+
+        :param keywords: A list of strings with search keywords.
+        :returns: An SQLAlchemy query that produces :class:`.Message` objects.
+
+        When :attr:`have_search_index` is :data:`True` the keywords are matched
+        using the full-text search index, otherwise the slower fall back
+        implemented by :func:`search_messages_like()` is used. The fall back
+        is also used for keywords without alphanumeric characters (refer to
+        :func:`~chat_archive.search.is_indexable_keyword()`).
+
+        Note that the two implementations don't return the same results: The
+        search index matches keywords against the start of words (refer to
+        :func:`~chat_archive.search.compile_match_expression()`) while the fall
+        back matches keywords as substrings, so for example ``chive`` matches
+        "archive" only when the fall back is used.
+        """
+        if not (keywords and self.have_search_index and all(map(is_indexable_keyword, keywords))):
+            return self.search_messages_like(keywords)
+        matches = text("SELECT rowid FROM %s WHERE %s MATCH :expression" % (SEARCH_INDEX_TABLE, SEARCH_INDEX_TABLE))
+        matches = matches.bindparams(expression=compile_match_expression(keywords))
+        matches = matches.columns(rowid=Message.id.type)
+        return self.session.query(Message).filter(Message.id.in_(matches)).order_by(Message.timestamp)
+
+    def search_messages_like(self, keywords):
+        """
+        Search the chat messages in the local archive using ``LIKE`` filters.
+
+        :param keywords: A list of strings with search keywords.
+        :returns: An SQLAlchemy query that produces :class:`.Message` objects.
+
+        This requires a full table scan of the messages in the archive, it's
+        used when the full-text search index isn't available.
+        """
         query = (
             self.session.query(Message)
             .join(Conversation)
@@ -325,17 +552,212 @@ class ChatArchive(SchemaManager):
         account.
         """
         # Synchronize the selected (backend, account) pairs.
-        for backend_name, account_name in self.get_backends_and_accounts(*backends):
-            # Provide backends their own import statistics without losing
-            # aggregate statistics collected about all backends together.
-            with self.import_stats:
-                logger.info(
-                    "Synchronizing %s messages in %r account ..", self.get_backend_name(backend_name), account_name
-                )
-                self.initialize_backend(backend_name, account_name).synchronize()
+        selected = list(self.get_backends_and_accounts(*backends))
+        if self.jobs > 1 and len(selected) > 1:
+            self.synchronize_concurrently(selected)
+        else:
+            for backend_name, account_name in selected:
+                # Provide backends their own import statistics without losing
+                # aggregate statistics collected about all backends together.
+                with self.import_stats:
+                    self.synchronize_account(backend_name, account_name)
         # Commit any outstanding database changes.
         self.commit_changes()
 
+    def synchronize_account(self, backend_name, account_name):
+        """
+        Download new chat messages for a single account.
+
+        :param backend_name: The name of the backend (a string).
+        :param account_name: The name of the account (a string).
+        """
+        logger.info("Synchronizing %s messages in %r account ..", self.get_backend_name(backend_name), account_name)
+        self.initialize_backend(backend_name, account_name).synchronize()
+
+    def synchronize_concurrently(self, selected):
+        """
+        Download new chat messages for multiple accounts at the same time.
+
+        :param selected: A list of (backend name, account name) tuples.
+        :raises: The first exception raised by a worker (after all
+                 workers have finished).
+
+        Up to :attr:`jobs` accounts are synchronized at the same time, each
+        by a worker thread that runs :func:`synchronize_worker()`. Workers
+        have their own SQLAlchemy session but share :attr:`database_engine`,
+        whose write transactions are serialized by a
+        :class:`~chat_archive.database.WriteSerializer`. The import
+        statistics of workers are merged into :attr:`import_stats`.
+        """
+        # Make sure workers can see any changes made so far.
+        self.commit_changes()
+        first_error = None
+        with WriteSerializer(engine=self.database_engine):
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                futures = dict(
+                    (pool.submit(self.synchronize_worker, backend_name, account_name), (backend_name, account_name))
+                    for backend_name, account_name in selected
+                )
+                for future in as_completed(futures):
+                    backend_name, account_name = futures[future]
+                    try:
+                        self.import_stats.merge(future.result())
+                    except Exception as e:
+                        logger.exception("Failed to synchronize %r account of %s backend!", account_name, backend_name)
+                        first_error = first_error or e
+        if first_error is not None:
+            raise first_error
+
+    def synchronize_worker(self, backend_name, account_name):
+        """
+        Synchronize a single account in a worker thread.
+
+        :param backend_name: The name of the backend (a string).
+        :param account_name: The name of the account (a string).
+        :returns: The :class:`BackendStats` object of the worker.
+
+        The worker uses a new :class:`ChatArchive` object that shares the
+        :attr:`database_engine` of this object but has its own session and
+        import statistics. Because backends based on :mod:`asyncio` expect the
+        current thread to have an event loop, a new event loop is created for
+        the duration of the synchronization.
+        """
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        worker = type(self)(
+            auto_create_schema=False,
+            auto_upgrade_schema=False,
+            data_directory=self.data_directory,
+            database_engine=self.database_engine,
+            database_file=self.database_file,
+            force=self.force,
+        )
+        try:
+            worker.synchronize_account(backend_name, account_name)
+            worker.commit_changes()
+            return worker.import_stats
+        finally:
+            worker.session.close()
+            asyncio.set_event_loop(None)
+            event_loop.close()
+
+    def update_message_positions(self):
+        """
+        Update the :attr:`.Message.position` values of the messages in :attr:`changed_conversations`.
+
+        Backends import messages in whatever order the chat service provides
+        them (often newest first) so positions can't be assigned when messages
+        are created. Instead new messages (whose position is :data:`None`) are
+        numbered when changes are committed:
+
+        - When all new messages in a conversation are newer than the newest
+          numbered message they are numbered starting after the highest
+          existing position.
+
+        - Otherwise the messages starting from the oldest new message are
+          renumbered (the positions of older messages don't change).
+
+        In both cases a single ``UPDATE`` statement numbers the messages using
+        a ``ROW_NUMBER()`` window function, so the cost depends on the number
+        of new messages and the number of messages following them, not on the
+        length of the conversation. Because this requires SQLite 3.33 or newer
+        (for ``UPDATE ... FROM``) older versions of SQLite and other databases
+        select the affected messages in order and update their positions
+        using ``executemany()`` (refer to :data:`SQLITE_HAS_UPDATE_FROM`).
+        """
+        if self.changed_conversations:
+            timer = Timer()
+            self.session.flush()
+            num_updated = 0
+            use_update_from = SQLITE_HAS_UPDATE_FROM and self.database_engine.dialect.name == "sqlite"
+            for conversation in self.changed_conversations:
+                # The new messages are sorted in Python because an ORDER BY
+                # clause would make SQLite prefer the timestamp index (and scan
+                # the whole conversation) over the position index.
+                oldest_new = min(
+                    (
+                        self.session.query(Message.timestamp, Message.id)
+                        .filter(Message.conversation_id == conversation.id)
+                        .filter(Message.position == None)
+                    ),
+                    default=None,
+                )
+                if oldest_new is None:
+                    continue
+                newest_old = (
+                    self.session.query(Message.timestamp, Message.id, Message.position)
+                    .filter(Message.conversation_id == conversation.id)
+                    .filter(Message.position != None)
+                    .order_by(Message.position.desc())
+                    .first()
+                )
+                if newest_old is None or tuple(oldest_new) > (newest_old.timestamp, newest_old.id):
+                    # Append the new messages to the conversation.
+                    offset = newest_old.position if newest_old else 0
+                    criteria = Message.position == None
+                    criteria_sql = "position IS NULL"
+                    index = "ix_messages_conversation_id_position"
+                    values = ()
+                else:
+                    # Renumber the messages starting from the oldest new message.
+                    offset = (
+                        self.session.query(Message.position)
+                        .filter(Message.conversation_id == conversation.id)
+                        .filter(
+                            or_(
+                                Message.timestamp < oldest_new.timestamp,
+                                and_(Message.timestamp == oldest_new.timestamp, Message.id < oldest_new.id),
+                            )
+                        )
+                        .order_by(Message.timestamp.desc(), Message.id.desc())
+                        .limit(1)
+                        .scalar()
+                    ) or 0
+                    criteria = or_(
+                        Message.timestamp > oldest_new.timestamp,
+                        and_(Message.timestamp == oldest_new.timestamp, Message.id >= oldest_new.id),
+                    )
+                    criteria_sql = "timestamp > :timestamp OR (timestamp = :timestamp AND id >= :message_id)"
+                    index = "ix_messages_conversation_id_timestamp"
+                    values = (
+                        bindparam("message_id", oldest_new.id),
+                        bindparam("timestamp", oldest_new.timestamp, type_=Message.timestamp.type),
+                    )
+                if use_update_from:
+                    statement = text(
+                        "UPDATE messages SET position = numbered.new_position FROM ("
+                        "SELECT id, :offset + ROW_NUMBER() OVER (ORDER BY timestamp, id) AS new_position"
+                        " FROM messages INDEXED BY %s WHERE conversation_id = :conversation_id AND (%s)"
+                        ") AS numbered WHERE messages.id = numbered.id"
+                        " AND messages.position IS NOT numbered.new_position" % (index, criteria_sql)
+                    ).bindparams(*values)
+                    parameters = dict(conversation_id=conversation.id, offset=offset)
+                    num_updated += self.session.execute(statement, parameters).rowcount
+                else:
+                    # This is portable SQL (sorted in Python for the reason explained above).
+                    numbered = sorted(
+                        self.session.query(Message.timestamp, Message.id, Message.position)
+                        .filter(Message.conversation_id == conversation.id)
+                        .filter(criteria)
+                    )
+                    changes = [
+                        dict(message_id=message_id, new_position=new_position)
+                        for new_position, (timestamp, message_id, position) in enumerate(numbered, start=offset + 1)
+                        if position != new_position
+                    ]
+                    if changes:
+                        self.session.execute(
+                            text("UPDATE messages SET position = :new_position WHERE id = :message_id"), changes
+                        )
+                        num_updated += len(changes)
+            logger.verbose(
+                "Updated positions of %s in %s (took %s).",
+                pluralize(num_updated, "message"),
+                pluralize(len(self.changed_conversations), "conversation"),
+                timer,
+            )
+            self.changed_conversations.clear()
+
 
 class BackendStats(object):
 
@@ -361,6 +783,16 @@ class BackendStats(object):
         """Set the value of a counter in the current scope."""
         self.scope[name] = value
 
+    def merge(self, other):
+        """
+        Merge the counters of another :class:`BackendStats` object into the current scope.
+
+        :param other: The :class:`BackendStats` object whose (current scope)
+                      counters should be added to the counters of this object.
+        """
+        for name, value in other.scope.items():
+            self.scope[name] += value
+
     def pop(self):
         """Remove the inner scope and merge its counters into the outer scope."""
         counters = self.stack.pop(-1)
@@ -0,0 +1,57 @@
+"""A database migration to add the position of messages in their conversation (and backfill it)."""
+
+# Standard library modules.
+import itertools
+import sqlite3
+
+# External dependencies.
+import sqlalchemy as sa
+from alembic import op
+
+revision = "1930b0e43ecf"
+down_revision = "d29bb072639b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Add the ``messages.position`` column and number the existing messages."""
+    op.add_column("messages", sa.Column("position", sa.Integer(), nullable=True))
+    op.create_index("ix_messages_conversation_id_position", "messages", ["conversation_id", "position"])
+    # Number the messages in each conversation in chronological order.
+    if sqlite3.sqlite_version_info >= (3, 25, 0):
+        # The positions are computed in a temporary table (indexed by message
+        # id) to avoid evaluating the window function once for every message.
+        op.execute("CREATE TEMPORARY TABLE message_positions (id INTEGER PRIMARY KEY, position INTEGER)")
+        op.execute(
+            """
+            INSERT INTO message_positions (id, position)
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY timestamp, id) FROM messages
+            """
+        )
+        op.execute(
+            """
+            UPDATE messages SET position = (
+                SELECT position FROM message_positions WHERE message_positions.id = messages.id
+            )
+            """
+        )
+        op.execute("DROP TABLE message_positions")
+    else:
+        # Older versions of SQLite don't support window functions.
+        connection = op.get_bind()
+        rows = connection.execute("SELECT conversation_id, id FROM messages ORDER BY conversation_id, timestamp, id")
+        changes = [
+            dict(message_id=message_id, position=position)
+            for conversation_id, group in itertools.groupby(rows, key=lambda row: row[0])
+            for position, (conversation_id, message_id) in enumerate(group, start=1)
+        ]
+        if changes:
+            connection.execute(sa.text("UPDATE messages SET position = :position WHERE id = :message_id"), changes)
+
+
+def downgrade():
+    """Remove the ``messages.position`` column."""
+    op.drop_index("ix_messages_conversation_id_position", "messages")
+    with op.batch_alter_table("messages") as batch_op:
+        batch_op.drop_column("position")
@@ -0,0 +1,31 @@
+"""A database migration to add the statistics table (and populate it)."""
+
+# External dependencies.
+from alembic import op
+
+# Modules included in our package.
+from chat_archive.stats import STATS_STATEMENTS, STATS_TABLE, populate_archive_stats
+
+revision = "297839a65f50"
+down_revision = "eb22932072aa"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create the statistics table and triggers and count the existing messages."""
+    connection = op.get_bind()
+    if connection.dialect.name == "sqlite":
+        for statement in STATS_STATEMENTS:
+            op.execute(statement)
+        populate_archive_stats(connection)
+
+
+def downgrade():
+    """Remove the statistics table and the triggers that maintain it."""
+    connection = op.get_bind()
+    if connection.dialect.name == "sqlite":
+        query = "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name GLOB '*_stats_*'"
+        for (name,) in connection.execute(query).fetchall():
+            op.execute("DROP TRIGGER %s" % name)
+        op.execute("DROP TABLE IF EXISTS %s" % STATS_TABLE)
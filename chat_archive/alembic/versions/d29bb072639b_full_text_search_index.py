@@ -0,0 +1,31 @@
+"""A database migration to add the full-text search index (and backfill it)."""
+
+# External dependencies.
+from alembic import op
+
+# Modules included in our package.
+from chat_archive.search import SEARCH_INDEX_STATEMENTS, SEARCH_INDEX_TABLE, have_fts5_support, populate_search_index
+
+revision = "d29bb072639b"
+down_revision = "96ac1e0e5dac"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create the FTS5 virtual table and triggers and index the existing messages."""
+    connection = op.get_bind()
+    if connection.dialect.name == "sqlite" and have_fts5_support(connection):
+        for statement in SEARCH_INDEX_STATEMENTS:
+            op.execute(statement)
+        populate_search_index(connection)
+
+
+def downgrade():
+    """Remove the FTS5 virtual table and the triggers that maintain it."""
+    connection = op.get_bind()
+    if connection.dialect.name == "sqlite":
+        query = "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name GLOB '*_fts_*'"
+        for (name,) in connection.execute(query).fetchall():
+            op.execute("DROP TRIGGER %s" % name)
+        op.execute("DROP TABLE IF EXISTS %s" % SEARCH_INDEX_TABLE)
@@ -0,0 +1,19 @@
+"""A database migration to add an index that enables keyset pagination of messages."""
+
+# External dependencies.
+from alembic import op
+
+revision = "eb22932072aa"
+down_revision = "1930b0e43ecf"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Create the ``ix_messages_timestamp_id`` index."""
+    op.create_index("ix_messages_timestamp_id", "messages", ["timestamp", "id"])
+
+
+def downgrade():
+    """Drop the ``ix_messages_timestamp_id`` index."""
+    op.drop_index("ix_messages_timestamp_id", "messages")
@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: July 22, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """
@@ -13,20 +13,121 @@ The following chat archive backends have been implemented so far:
 - Google Talk: :mod:`chat_archive.backends.gtalk`
 - Slack: :mod:`chat_archive.backends.slack`
 - Telegram: :mod:`chat_archive.backends.telegram`
+
+Backends are registered as entry points in the group given by
+:data:`ENTRY_POINT_GROUP`, refer to :func:`discover_backends()` for details.
 """
 
+# Standard library modules.
+import ast
+import asyncio
+import functools
+import importlib.util
+import time
+
 # External dependencies.
-from property_manager import PropertyManager, lazy_property, required_property
+from humanfriendly import format_timespan
+from property_manager import PropertyManager, lazy_property, mutable_property, required_property
 from verboselogs import VerboseLogger
 
 # Modules included in our package.
 from chat_archive.html.redirects import RedirectStripper, strip_redirects
 from chat_archive.models import Account, Contact, Conversation, EmailAddress, Message, TelephoneNumber
+from chat_archive.ratelimit import RateLimiter
+
+ENTRY_POINT_GROUP = "chat_archive.backends"
+"""The name of the entry point group in which backends are registered (a string)."""
 
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
 
+@functools.lru_cache()
+def discover_backends():
+    """
+    Discover the available backends.
+
+    :returns: A dictionary with backend names (strings) as keys and the dotted
+              paths of backend modules (strings) as values.
+
+    This uses :mod:`importlib.metadata` to find the entry points registered in
+    :data:`ENTRY_POINT_GROUP`. The module is only imported when this function
+    is first called (so commands that don't need backends don't pay for it)
+    and the result is cached for the lifetime of the process, because
+    scanning the metadata of all installed distributions isn't free either.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from importlib_metadata import entry_points
+    selected = entry_points()
+    if hasattr(selected, "select"):
+        selected = selected.select(group=ENTRY_POINT_GROUP)
+    else:
+        selected = selected.get(ENTRY_POINT_GROUP, [])
+    return dict((ep.name, ep.value.partition(":")[0].strip()) for ep in selected)
+
+
+@functools.lru_cache()
+def find_friendly_name(dotted_path):
+    """
+    Find the friendly name of a backend without importing the backend module.
+
+    :param dotted_path: The dotted path of a backend module (a string).
+    :returns: The value of the ``FRIENDLY_NAME`` variable defined at the top
+              level of the backend module (a string) or :data:`None` when
+              the value can't be determined without importing the module.
+
+    Backend modules import the client libraries of chat services, which can
+    take a second or more. This is fine when synchronizing, but commands like
+    ``search`` and ``list`` only need the friendly name of a backend, so this
+    function gets it from the source code of the backend module instead.
+    """
+    try:
+        spec = importlib.util.find_spec(dotted_path)
+        if spec and spec.origin and spec.origin.endswith(".py"):
+            with open(spec.origin, "rb") as handle:
+                tree = ast.parse(handle.read(), spec.origin)
+            for node in tree.body:
+                if isinstance(node, ast.Assign) and any(
+                    isinstance(target, ast.Name) and target.id == "FRIENDLY_NAME" for target in node.targets
+                ):
+                    value = ast.literal_eval(node.value)
+                    if isinstance(value, str):
+                        return value
+    except Exception as e:
+        logger.debug("Failed to find friendly name of %s without importing it! (%s)", dotted_path, e)
+    return None
+
+
+def pre_process_message(text, html, redirect_stripper):
+    """
+    Pre-process the text and HTML of a chat message.
+
+    :param text: The plain text chat message (a string).
+    :param html: The HTML chat message (a string or :data:`None`).
+    :param redirect_stripper: A :class:`.RedirectStripper` object.
+    :returns: A tuple with the pre-processed text and HTML.
+
+    This function works as follows:
+
+    1. The `text` is pre-processed using :func:`.strip_redirects()`.
+    2. The `html` is pre-processed using `redirect_stripper`.
+    3. When the resulting HTML exactly equals the plain text chat message,
+       :data:`None` is returned instead of the HTML.
+
+    It's used by :func:`ChatArchiveBackend.pre_process_text()` when messages
+    are imported and by backends that re-render messages (in worker
+    processes), so that both store the same HTML for the same message.
+    """
+    text = strip_redirects(text)
+    if html:
+        html = redirect_stripper(html)
+        if html == text:
+            html = None
+    return text, html
+
+
 class ChatArchiveBackend(PropertyManager):
 
     """Abstract base class for ``chat-archive`` backends."""
@@ -81,11 +182,37 @@ class ChatArchiveBackend(PropertyManager):
         """A dictionary mapping external IDs to :class:`.Contact` objects."""
         return {}
 
+    @lazy_property
+    def rate_limiter(self):
+        """
+        A :class:`.RateLimiter` object based on :attr:`request_rate` (used by :func:`call_api()`).
+
+        The rate limiter is shared by all threads and coroutines that use the
+        same backend object, so concurrent requests are limited together.
+        """
+        return RateLimiter(rate=self.request_rate)
+
     @lazy_property
     def redirect_stripper(self):
         """An :class:`.RedirectStripper` object."""
         return RedirectStripper()
 
+    @mutable_property
+    def request_rate(self):
+        """
+        The maximum sustained number of API requests per second (a number, defaults to 10).
+
+        The value of this property can be changed using the ``request-rate``
+        configuration option. Backends override the default based on the
+        rate limits of the chat service that they support.
+        """
+        return float(self.config.get("request-rate", "10"))
+
+    @mutable_property
+    def retry_count(self):
+        """The number of times that a failed API request will be attempted (a number, defaults to 5)."""
+        return 5
+
     @lazy_property
     def session(self):
         """Shortcut for the :attr:`~chat_archive.database.DatabaseClient.session` property of :attr:`archive`."""
@@ -95,6 +222,54 @@ class ChatArchiveBackend(PropertyManager):
     def stats(self):
         """A :class:`~chat_archive.BackendStats` object."""
 
+    def call_api(self, function, *args, **kw):
+        """
+        Call a chat service API with rate limiting and retries.
+
+        :param function: The callable that makes the API request.
+        :param args: Any positional arguments are passed to `function`.
+        :param kw: Any keyword arguments are passed to `function`.
+        :returns: The return value of `function`.
+        :raises: Any exceptions raised by `function` that aren't retryable
+                 (according to :func:`is_retryable()`) or that are raised
+                 by the last attempt (refer to :attr:`retry_count`).
+
+        Before every request a token is taken from :attr:`rate_limiter`.
+        Failed requests are retried after the delay provided by the server
+        (refer to :func:`get_retry_after()`) or after a jittered exponential
+        back off delay.
+        """
+        attempt = 1
+        while True:
+            self.rate_limiter.wait()
+            try:
+                return function(*args, **kw)
+            except Exception as e:
+                time.sleep(self.get_retry_delay(e, attempt))
+                attempt += 1
+
+    async def call_api_async(self, function, *args, **kw):
+        """
+        Call an :mod:`asyncio` based chat service API with rate limiting and retries.
+
+        :param function: The coroutine function that makes the API request.
+        :param args: Any positional arguments are passed to `function`.
+        :param kw: Any keyword arguments are passed to `function`.
+        :returns: The return value of the coroutine.
+
+        This is the :mod:`asyncio` equivalent of :func:`call_api()` (delays
+        are implemented using :func:`asyncio.sleep()` so other coroutines
+        can run while waiting).
+        """
+        attempt = 1
+        while True:
+            await self.rate_limiter.wait_async()
+            try:
+                return await function(*args, **kw)
+            except Exception as e:
+                await asyncio.sleep(self.get_retry_delay(e, attempt))
+                attempt += 1
+
     def find_contact_by_attributes(self, attributes):
         """
         Find a contact based on their external ID, an email address or a telephone number.
@@ -180,6 +355,28 @@ class ChatArchiveBackend(PropertyManager):
             .one_or_none()
         )
 
+    def find_existing_messages(self, conversation, external_ids, batch_size=500):
+        """
+        Find the messages in a conversation that already exist in the local database.
+
+        :param conversation: The :class:`.Conversation` that contains the messages.
+        :param external_ids: An iterable of external message IDs (strings).
+        :param batch_size: The maximum number of external IDs per query (an
+                           integer, defaults to 500 to stay well below SQLite's
+                           limit on the number of query parameters).
+        :returns: A :class:`set` with the external IDs of the existing messages.
+        """
+        external_ids = sorted(set(str(value) for value in external_ids))
+        existing_ids = set()
+        for offset in range(0, len(external_ids), batch_size):
+            query = (
+                self.session.query(Message.external_id)
+                .filter(Message.conversation_id == conversation.id)
+                .filter(Message.external_id.in_(external_ids[offset : offset + batch_size]))
+            )
+            existing_ids.update(row[0] for row in query)
+        return existing_ids
+
     def get_or_create_contact(self, **attributes):
         """
         Get or create a contact object.
@@ -312,8 +509,63 @@ class ChatArchiveBackend(PropertyManager):
                 "Importing message by %s on %s: %s", object.sender, object.timestamp.strftime("%Y-%m-%d"), object.text
             )
             self.stats.messages_added += 1
+            # Make sure the message positions are updated on the next commit.
+            self.archive.changed_conversations.add(conversation)
         return created, object
 
+    def get_or_create_messages(self, conversation, messages):
+        """
+        Import a batch of :class:`.Message` objects at once.
+
+        :param conversation: The :class:`.Conversation` in which the messages originated.
+        :param messages: A list of dictionaries with :class:`.Message` attributes.
+                         Each dictionary is required to contain an
+                         ``external_id`` key (used to find existing messages).
+        :returns: A list of dictionaries with the attributes of the messages
+                  that were created (existing messages are omitted).
+
+        This method is a batched alternative to :func:`get_or_create_message()`
+        that was added because that method costs several SQL statements per
+        message: The external IDs of the given messages are resolved using one
+        ``IN (...)`` query after which the new messages are inserted using a
+        single (``executemany()``) ``INSERT`` statement. Backends that receive
+        messages in pages (most chat APIs work like this) should use this
+        method instead of :func:`get_or_create_message()`.
+        """
+        # Make sure that the conversation and the contacts referenced by the
+        # messages have been assigned primary keys.
+        self.session.flush()
+        new_messages = []
+        known_ids = self.find_existing_messages(conversation, [m["external_id"] for m in messages])
+        for attributes in messages:
+            external_id = str(attributes["external_id"])
+            if external_id not in known_ids:
+                known_ids.add(external_id)
+                attributes = dict(attributes, conversation_id=conversation.id, external_id=external_id)
+                self.pre_process_text(attributes)
+                new_messages.append(attributes)
+        if new_messages:
+            rows = []
+            for attributes in new_messages:
+                logger.info(
+                    "Importing message by %s on %s: %s",
+                    attributes.get("sender"),
+                    attributes["timestamp"].strftime("%Y-%m-%d"),
+                    attributes["text"],
+                )
+                row = dict.fromkeys(("html", "raw", "recipient_id", "sender_id"))
+                row.update((k, v) for k, v in attributes.items() if k not in ("recipient", "sender"))
+                for name in "recipient", "sender":
+                    contact = attributes.get(name)
+                    if contact is not None:
+                        row["%s_id" % name] = contact.id
+                rows.append(row)
+            self.session.execute(Message.__table__.insert(), rows)
+            self.stats.messages_added += len(new_messages)
+            # Make sure the message positions are updated on the next commit.
+            self.archive.changed_conversations.add(conversation)
+        return new_messages
+
     def get_or_create_email_address(self, email_address):
         """
         Get or create an :class:`.EmailAddress` object.
@@ -371,6 +623,49 @@ class ChatArchiveBackend(PropertyManager):
             self.stats.telephone_numbers_added += 1
         return object
 
+    def get_retry_after(self, exception):
+        """
+        Get the delay requested by the server for a failed API request.
+
+        :param exception: The exception raised by the failed request.
+        :returns: The number of seconds to wait (a number) or :data:`None`
+                  when the server didn't specify a delay.
+
+        The default implementation always returns :data:`None`, backends can
+        override this to implement ``Retry-After`` headers and similar
+        mechanisms.
+        """
+        return None
+
+    def get_retry_delay(self, exception, attempt):
+        """
+        Decide whether and when a failed API request should be retried.
+
+        :param exception: The exception raised by the failed request.
+        :param attempt: The number of the failed attempt (an integer, starting at one).
+        :returns: The number of seconds to wait before retrying (a number).
+        :raises: The given exception when the request shouldn't be retried.
+        """
+        if attempt >= self.retry_count or not self.is_retryable(exception):
+            if attempt > 1:
+                logger.warning("Giving up after %i failed requests!", attempt)
+            raise exception
+        retry_after = self.get_retry_after(exception)
+        if retry_after is not None:
+            # Server provided delays apply to all requests.
+            self.rate_limiter.retry_after(retry_after)
+            delay = 0
+        else:
+            delay = self.rate_limiter.backoff_delay(attempt)
+        logger.notice(
+            "Attempt %i/%i failed (%s), retrying in %s ..",
+            attempt,
+            self.retry_count,
+            exception,
+            format_timespan(max(delay, retry_after or 0)),
+        )
+        return delay
+
     def have_message(self, conversation, external_id):
         """
         Check if a message exists in the local database.
@@ -393,33 +688,51 @@ class ChatArchiveBackend(PropertyManager):
             ).scalar()
         )
 
+    def is_retryable(self, exception):
+        """
+        Check whether a failed API request should be retried.
+
+        :param exception: The exception raised by the failed request.
+        :returns: :data:`True` if the request should be retried, :data:`False` otherwise.
+
+        The default implementation always returns :data:`False`, backends
+        can override this to retry network errors, server errors, etc.
+        """
+        return False
+
     def pre_process_text(self, attributes):
         """
         Pre-process the text and HTML of a chat message.
 
         :param attributes: A dictionary with :class:`.Message` attributes.
 
-        This method works as follows:
-
-        1. The `text` is pre-processed using :func:`.strip_redirects()`.
-        2. The `html` is pre-processed using :class:`.RedirectStripper`.
-        3. When the resulting HTML exactly equals the plain text chat message,
-           the `html` key in `attributes` is removed.
-        """
-        # Pre-process the plain text chat message.
-        original_text = attributes["text"]
-        modified_text = strip_redirects(original_text)
-        if modified_text != original_text:
-            attributes["text"] = modified_text
-        # Pre-process the HTML chat message?
-        original_html = attributes.get("html")
-        if original_html:
-            modified_html = self.redirect_stripper(original_html)
-            if modified_html != modified_text:
-                attributes["html"] = modified_html
+        The `text` and `html` are pre-processed using :func:`pre_process_message()`
+        and when the resulting HTML exactly equals the plain text chat message,
+        the `html` key in `attributes` is removed.
+        """
+        attributes["text"], html = pre_process_message(
+            attributes["text"], attributes.get("html"), self.redirect_stripper
+        )
+        if attributes.get("html"):
+            if html:
+                attributes["html"] = html
             else:
                 attributes.pop("html")
 
+    def rerender_messages(self, start_id=0):
+        """
+        Regenerate the HTML and text of messages based on their raw text.
+
+        :param start_id: Only messages whose :attr:`~chat_archive.models.Message.id`
+                         is greater than this value are processed (an integer).
+        :returns: The number of messages that were updated (an integer).
+
+        The default implementation doesn't do anything, backends that store
+        :attr:`~chat_archive.models.Message.raw` values can override this.
+        """
+        logger.verbose("The %s backend doesn't support re-rendering messages.", self.backend_name)
+        return 0
+
     def synchronize(self):
         """This instance method must be implemented by subclasses."""
         raise NotImplementedError
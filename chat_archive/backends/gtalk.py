@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: July 22, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """
@@ -38,13 +38,16 @@ My testing implies that this is the case, because it seems to work fine! :-)
 
 # Standard library modules.
 import codecs
+import collections
 import datetime
 import email
 import email.utils
 import imaplib
 import os
 import re
+import threading
 import xml.etree.ElementTree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # External dependencies.
 from humanfriendly import Timer, format, format_path, pluralize
@@ -55,7 +58,7 @@ from verboselogs import VerboseLogger
 from chat_archive.backends import ChatArchiveBackend
 from chat_archive.html import html_to_text
 from chat_archive.models import Contact, Conversation, EmailAddress, Message
-from chat_archive.utils import get_secret
+from chat_archive.utils import ensure_directory_exists, get_secret
 
 FRIENDLY_NAME = "Google Talk"
 """A user friendly name for the chat service supported by this backend (a string)."""
@@ -66,11 +69,102 @@ NAMESPACED_TAG_PATTERN = re.compile(r"^{[^}]+}(\S+)$")
 BOGUS_EMAIL_PATTERN = re.compile(r"^private-chat(-[0-9a-f]+)+@groupchat.google.com$", re.IGNORECASE)
 """Compiled regular expression to recognize private messages in group conversations."""
 
+FETCH_UID_PATTERN = re.compile(rb"\bUID (\d+)", re.IGNORECASE)
+"""Compiled regular expression to find the UID of an email in an IMAP ``FETCH`` response."""
+
+
+ParsedEmail = collections.namedtuple("ParsedEmail", "uid timestamp is_multipart messages")
+"""
+The result of :func:`parse_cached_email()` (a :func:`~collections.namedtuple`).
+
+The :attr:`messages` field is a list of :class:`ParsedMessage` tuples.
+"""
+
+ParsedMessage = collections.namedtuple("ParsedMessage", "type jid sender recipient html text timestamp")
+"""
+A chat message extracted from an email (a :func:`~collections.namedtuple`).
+
+For single-part emails :attr:`sender` and :attr:`recipient` are the ``From:``
+and ``To:`` headers of the email. For messages embedded in multi-part emails
+:attr:`type`, :attr:`jid`, :attr:`sender` and :attr:`recipient` are the
+``type``, ``jid``, ``from`` and ``to`` attributes of the ``<message>`` node.
+"""
 
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
 
+def parse_cached_email(uid, filename):
+    """
+    Extract the chat messages from a cached email.
+
+    :param uid: The UID of the email (an integer).
+    :param filename: The pathname of the cached email (a string).
+    :returns: A :class:`ParsedEmail` tuple or :data:`None` (when the email body is empty).
+
+    This function does the CPU intensive part of importing emails (parsing
+    the email, the embedded XML and HTML) without touching the database, so
+    that :class:`GoogleTalkBackend` can run it in a pool of worker processes
+    (the resulting tuples are easy to pickle).
+    """
+    with open(filename, encoding="ascii") as handle:
+        email = EmailMessageParser(raw_body=handle.read(), uid=uid)
+    if not email.parsed_body:
+        return None
+    if email.parsed_body.is_multipart():
+        logger.verbose("Parsing multi-part email with UID %s ..", uid)
+        messages = []
+        for nested_message in email.parsed_body.get_payload():
+            if nested_message.get_content_type() == "text/xml":
+                logger.verbose("Parsing embedded text/xml message ..")
+                messages.extend(parse_xml(nested_message.get_payload(decode=True)))
+        return ParsedEmail(uid=uid, timestamp=email.timestamp, is_multipart=True, messages=messages)
+    else:
+        logger.verbose("Parsing single-part email with UID %s ..", uid)
+        binary_html = email.parsed_body.get_payload(decode=True)
+        unicode_html = binary_html.decode(email.parsed_body.get_content_charset())
+        message = ParsedMessage(
+            type=None,
+            jid=None,
+            sender=email.parsed_body["from"],
+            recipient=email.parsed_body["to"],
+            html=unicode_html,
+            text=html_to_text(unicode_html),
+            timestamp=email.timestamp,
+        )
+        return ParsedEmail(uid=uid, timestamp=email.timestamp, is_multipart=False, messages=[message])
+
+
+def parse_xml(xml_body):
+    """
+    Extract chat messages from the ``text/xml`` payload of a multi-part email.
+
+    :param xml_body: The XML payload (a byte string).
+    :returns: A list of :class:`ParsedMessage` tuples.
+    """
+    logger.verbose("Parsing XML fragment:\n%s", xml_body)
+    messages = []
+    tree = xml.etree.ElementTree.fromstring(xml_body)
+    for message_node in tree.findall("{jabber:client}message"):
+        body_node = message_node.find("{jabber:client}body")
+        node_text = getattr(body_node, "text", None)
+        if node_text and not node_text.isspace():
+            node_text = node_text.rstrip()
+            logger.verbose("Parsed XML message node with body text %r:\n%s", node_text, LazyXMLFormatter(message_node))
+            messages.append(
+                ParsedMessage(
+                    type=message_node.attrib.get("type"),
+                    jid=message_node.attrib.get("jid"),
+                    sender=message_node.attrib.get("from"),
+                    recipient=message_node.attrib.get("to"),
+                    html=GoogleTalkBackend.extract_html(message_node),
+                    text=node_text,
+                    timestamp=GoogleTalkBackend.extract_timestamp(message_node),
+                )
+            )
+    return messages
+
+
 class GoogleTalkBackend(ChatArchiveBackend):
 
     """
@@ -78,15 +172,18 @@ class GoogleTalkBackend(ChatArchiveBackend):
 
     This backend supports the following configuration options:
 
-    =================  ==============================================================
-    Option             Description
-    =================  ==============================================================
-    ``chats-folder``   See :attr:`chats_folder`.
-    ``imap-server``    See :attr:`imap_server`.
-    ``email``          The email address used to sign in to your Google Mail account.
-    ``password-name``  The name of a password in ``~/.password-store`` to use.
-    ``password``       See :attr:`password`.
-    =================  ==============================================================
+    =====================  ==============================================================
+    Option                 Description
+    =====================  ==============================================================
+    ``chats-folder``       See :attr:`chats_folder`.
+    ``imap-server``        See :attr:`imap_server`.
+    ``parse-processes``    See :attr:`parse_processes`.
+    ``email``              The email address used to sign in to your Google Mail account.
+    ``fetch-batch-size``   See :attr:`fetch_batch_size`.
+    ``fetch-connections``  See :attr:`fetch_connections`.
+    ``password-name``      The name of a password in ``~/.password-store`` to use.
+    ``password``           See :attr:`password`.
+    =====================  ==============================================================
 
     If you set ``password-name`` then ``password`` doesn't have to be set. If
     ``password`` nor ``password-name`` have been set then you will be prompted
@@ -99,11 +196,60 @@ class GoogleTalkBackend(ChatArchiveBackend):
         return self.config.get("chats-folder", "[Gmail]/Chats")
 
     @lazy_property
+    def cache_directory(self):
+        """The pathname of the directory where downloaded emails are cached (a string)."""
+        directory = os.path.join(self.archive.data_directory, "gtalk", self.account_name)
+        ensure_directory_exists(directory)
+        return directory
+
+    @mutable_property(cached=True)
     def client(self):
         """An IMAP client connection to :attr:`imap_server`."""
         logger.info("Connecting to %s ..", self.imap_server)
         return imaplib.IMAP4_SSL(self.imap_server)
 
+    @mutable_property
+    def client_thread(self):
+        """
+        The thread that owns :attr:`client` (a :class:`threading.Thread` object).
+
+        This is set by :func:`login_to_server()` and defaults to the main
+        thread. Refer to :func:`get_client()` for details.
+        """
+        return threading.main_thread()
+
+    @lazy_property
+    def extra_clients(self):
+        """
+        The additional IMAP client connections used by :func:`download_batches()` (a list).
+
+        The connections are created on demand by :func:`get_client()` and
+        closed at the end of :func:`synchronize()`.
+        """
+        return []
+
+    @mutable_property
+    def fetch_batch_size(self):
+        """
+        The number of emails to download using a single IMAP ``FETCH`` command (an integer, defaults to 200).
+
+        Downloading emails one by one is dominated by network latency, this is
+        why emails are requested in batches. The batch size can be changed
+        using the ``fetch-batch-size`` configuration option.
+        """
+        return int(self.config.get("fetch-batch-size", "200"))
+
+    @mutable_property
+    def fetch_connections(self):
+        """
+        The number of IMAP connections used to download emails (an integer, defaults to 1).
+
+        When this is greater than one batches of emails are downloaded in
+        parallel using additional IMAP connections. The number of connections
+        can be changed using the ``fetch-connections`` configuration option.
+        """
+        return int(self.config.get("fetch-connections", "1"))
+
     @lazy_property
     def conversation_map(self):
         """A mapping of conversations."""
@@ -114,6 +260,24 @@ class GoogleTalkBackend(ChatArchiveBackend):
         """The domain name of the Google Mail IMAP server (a string, defaults to 'imap.gmail.com')."""
         return self.config.get("imap-server", "imap.gmail.com")
 
+    @lazy_property
+    def local_clients(self):
+        """Thread local storage for the IMAP client connections of download threads."""
+        return threading.local()
+
+    @mutable_property
+    def parse_processes(self):
+        """
+        The number of worker processes used to parse emails (an integer, defaults to 1).
+
+        Starting a pool of worker processes only pays off when a lot of emails
+        need to be parsed (e.g. during the initial synchronization) so this
+        can be enabled using the ``parse-processes`` configuration option.
+        When the value is one the emails are parsed in the current process,
+        refer to :func:`parse_batches()` for details.
+        """
+        return int(self.config.get("parse-processes", "1"))
+
     @lazy_property
     def password(self):
         """The password used to sign in to the Google Mail account (a string)."""
@@ -127,34 +291,47 @@ class GoogleTalkBackend(ChatArchiveBackend):
     def synchronize(self):
         """Download RFC822 encoded Google Talk conversations using IMAP and import the embedded chat messages."""
         self.login_to_server()
-        self.select_chats_folder()
-        # Check for emails to download and/or import.
-        to_download = self.find_uids_to_download()
-        to_import = self.find_uids_to_import()
-        to_process = to_download | to_import
-        to_import |= to_download
-        if to_process:
-            summary = []
-            if to_download:
-                summary.append("downloading %s" % pluralize(len(to_download), "email"))
-            if to_import:
-                summary.append("importing %s" % pluralize(len(to_import), "email"))
-            logger.info("%s ..", ", ".join(summary).capitalize())
-            for i, uid in enumerate(sorted(to_process), start=1):
-                logger.info("Processing email with UID %s (%.2f%%) ..", uid, i / (len(to_process) / 100.0))
-                email = self.get_email_body(uid)
-                if email.parsed_body:
-                    with self.stats:
-                        if email.parsed_body.is_multipart():
-                            self.parse_multipart_email(email)
+        try:
+            self.select_chats_folder()
+            # Check for emails to download and/or import.
+            to_download = self.find_uids_to_download()
+            to_import = self.find_uids_to_import()
+            to_process = to_download | to_import
+            to_import |= to_download
+            if to_process:
+                summary = []
+                if to_download:
+                    summary.append("downloading %s" % pluralize(len(to_download), "email"))
+                if to_import:
+                    summary.append("importing %s" % pluralize(len(to_import), "email"))
+                logger.info("%s ..", ", ".join(summary).capitalize())
+                batches = self.download_batches(sorted(to_process))
+                parsed_emails = self.parse_batches(batches)
+                try:
+                    for i, parsed_email in enumerate(parsed_emails, start=1):
+                        logger.info(
+                            "Processing email with UID %s (%.2f%%) ..",
+                            parsed_email.uid,
+                            i / (len(to_process) / 100.0),
+                        )
+                        if parsed_email.messages is not None:
+                            with self.stats:
+                                if parsed_email.is_multipart:
+                                    self.import_multipart_email(parsed_email)
+                                else:
+                                    self.import_singlepart_email(parsed_email)
                         else:
-                            self.parse_singlepart_email(email)
-                else:
-                    logger.verbose("Skipping conversation %s with empty mail body.", uid)
-                self.archive.commit_changes()
-        else:
-            logger.info("Nothing to do! (no new messages)")
-        self.client.logout()
+                            logger.verbose("Skipping conversation %s with empty mail body.", parsed_email.uid)
+                        self.archive.commit_changes()
+                finally:
+                    # Wait for the download threads before their connections are closed.
+                    parsed_emails.close()
+                    batches.close()
+            else:
+                logger.info("Nothing to do! (no new messages)")
+        finally:
+            for client in [self.client] + self.extra_clients:
+                client.logout()
 
     def login_to_server(self):
         """Log-in to the Google Mail account."""
@@ -163,6 +340,7 @@ class GoogleTalkBackend(ChatArchiveBackend):
             "Failed to authenticate with IMAP server! (%s)",
             self.imap_server,
         )
+        self.client_thread = threading.current_thread()
 
     def select_chats_folder(self):
         """Select the IMAP folder with chat messages."""
@@ -216,112 +394,273 @@ class GoogleTalkBackend(ChatArchiveBackend):
             )
         )
 
-    def get_email_body(self, uid):
-        """Get the body of an email from the local cache or the server."""
-        local_copy = os.path.join(self.archive.data_directory, "gtalk", self.account_name, "%i.eml" % uid)
-        formatted_path = format_path(local_copy)
-        if os.path.isfile(local_copy):
-            logger.verbose("Reading email with UID %s from %s ..", uid, formatted_path)
-            with open(local_copy, encoding="ascii") as handle:
-                return EmailMessageParser(raw_body=handle.read(), uid=uid)
+    def download_batches(self, uids):
+        """
+        Make sure the given emails are available in the local cache.
+
+        :param uids: A sorted list of UIDs.
+        :returns: A generator of lists of UIDs. Each list is yielded once
+                  the emails it refers to have been downloaded and contains
+                  only the UIDs of emails that are available in the local
+                  cache (refer to :func:`download_batch()`).
+
+        The UIDs are split into batches of :attr:`fetch_batch_size` emails
+        that are downloaded by :func:`download_batch()`. When
+        :attr:`fetch_connections` is greater than one the batches are
+        downloaded in parallel, up to :attr:`fetch_connections` batches ahead
+        of the caller processing the batches (which are still yielded in
+        order). The look-ahead is bounded so that a caller that stops early
+        doesn't have to wait for the whole mailbox to be downloaded.
+        """
+        batches = [uids[i : i + self.fetch_batch_size] for i in range(0, len(uids), self.fetch_batch_size)]
+        if self.fetch_connections > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=self.fetch_connections) as pool:
+                pending = collections.deque()
+                for batch in batches:
+                    pending.append(pool.submit(self.download_batch, batch))
+                    if len(pending) > self.fetch_connections:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        else:
+            for batch in batches:
+                yield self.download_batch(batch)
+
+    def download_batch(self, uids):
+        """
+        Download the emails with the given UIDs that are not yet in the local cache.
+
+        :param uids: A list of UIDs.
+        :returns: A list with the UIDs of the emails that are available in the
+                  local cache (emails that the IMAP server didn't return are
+                  omitted, so they're retried on the next synchronization).
+
+        The emails are downloaded using a single ``UID FETCH`` command (using
+        the connection provided by :func:`get_client()`) and each email is
+        saved in the local cache as soon as the response has been received.
+        """
+        missing = [uid for uid in uids if not os.path.isfile(self.get_cache_file(uid))]
+        if missing:
+            timer = Timer()
+            logger.verbose("Downloading %s ..", pluralize(len(missing), "email"))
+            response = self.get_client().uid("fetch", ",".join(map(str, missing)), "(UID RFC822)")
+            data = self.check_response(response, "Failed to download %s!", pluralize(len(missing), "email"))
+            downloaded = self.parse_fetch_response(data)
+            for uid in missing:
+                if uid in downloaded:
+                    self.save_email(uid, downloaded[uid])
+                else:
+                    logger.warning("IMAP server didn't return email with UID %s!", uid)
+            logger.verbose("Downloaded %s (took %s).", pluralize(len(downloaded), "email"), timer)
+        return [uid for uid in uids if os.path.isfile(self.get_cache_file(uid))]
+
+    def get_cache_file(self, uid):
+        """
+        Get the pathname of the local copy of an email.
+
+        :param uid: The UID of the email (an integer).
+        :returns: The pathname of an ``*.eml`` file in :attr:`cache_directory` (a string).
+        """
+        return os.path.join(self.cache_directory, "%i.eml" % uid)
+
+    def get_client(self):
+        """
+        Get an IMAP client connection for the current thread.
+
+        :returns: An :class:`imaplib.IMAP4_SSL` object.
+
+        The thread that logged in :attr:`client` (see :attr:`client_thread`)
+        uses that connection, other threads get their own connection (which is
+        logged in and has :attr:`chats_folder` selected) because IMAP
+        connections can't be shared between threads. Note that the owner isn't
+        necessarily the main thread: When accounts are synchronized in
+        parallel (see :attr:`.ChatArchive.jobs`) :func:`synchronize()` runs in
+        a worker thread.
+        """
+        if threading.current_thread() is self.client_thread:
+            return self.client
+        client = getattr(self.local_clients, "client", None)
+        if client is None:
+            logger.verbose("Opening additional connection to %s ..", self.imap_server)
+            client = imaplib.IMAP4_SSL(self.imap_server)
+            self.check_response(
+                client.login(self.config["email"], self.password),
+                "Failed to authenticate with IMAP server! (%s)",
+                self.imap_server,
+            )
+            self.check_response(
+                client.select(self.chats_folder, readonly=True),
+                "Failed to select chats folder! (%s)",
+                self.chats_folder,
+            )
+            self.local_clients.client = client
+            self.extra_clients.append(client)
+        return client
+
+    def parse_fetch_response(self, data):
+        """
+        Parse the response to a ``UID FETCH ... (UID RFC822)`` command.
+
+        :param data: The response data returned by :mod:`imaplib` (a list).
+        :returns: A dictionary with UIDs (integers) as keys and raw email
+                  bodies (byte strings) as values.
+
+        Each email in the response is represented by a tuple with the
+        response line (which includes the UID, unless the server reports it
+        after the message body) and the message body, followed by a byte
+        string that closes the response (and may contain the UID).
+        """
+        emails = {}
+        for i, item in enumerate(data):
+            if isinstance(item, tuple):
+                match = FETCH_UID_PATTERN.search(item[0])
+                if not match and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+                    match = FETCH_UID_PATTERN.search(data[i + 1])
+                if match:
+                    emails[int(match.group(1))] = item[1]
+                else:
+                    logger.warning("Failed to find UID in IMAP response! (%r)", item[0])
+        return emails
+
+    def save_email(self, uid, raw_body):
+        """
+        Save a downloaded email in the local cache.
+
+        :param uid: The UID of the email (an integer).
+        :param raw_body: The raw email body (a byte string).
+
+        The email is written to a temporary file that is renamed into place,
+        so that an interrupted download never leaves a truncated ``*.eml``
+        file in the local cache.
+        """
+        local_copy = self.get_cache_file(uid)
+        logger.verbose("Saving email with UID %s to %s ..", uid, format_path(local_copy))
+        temporary_file = "%s.tmp-%i" % (local_copy, threading.get_ident())
+        with open(temporary_file, "w") as handle:
+            handle.write(raw_body.decode("ascii"))
+        os.rename(temporary_file, local_copy)
+
+    def parse_batches(self, batches):
+        """
+        Parse cached emails using a pool of worker processes.
+
+        :param batches: An iterable of lists of UIDs (refer to :func:`download_batches()`).
+        :returns: A generator of :class:`ParsedEmail` tuples (in the order of the given UIDs).
+
+        Parsing emails is CPU bound, so when :attr:`parse_processes` is greater
+        than one the emails are parsed by :func:`parse_cached_email()` in a
+        :class:`~concurrent.futures.ProcessPoolExecutor`. This isn't done when
+        multiple accounts are synchronized in parallel (see
+        :attr:`.ChatArchive.jobs`) because forking a process while other
+        threads may be holding locks isn't safe. The next batch is
+        submitted to the pool before the results of the previous batch are
+        yielded, so parsing overlaps with importing. Emails with an empty body
+        are reported as a :class:`ParsedEmail` whose :attr:`messages` is
+        :data:`None`.
+        """
+        def empty_email(uid):
+            return ParsedEmail(uid=uid, timestamp=None, is_multipart=False, messages=None)
+
+        use_pool = self.parse_processes > 1
+        if use_pool and self.archive.jobs > 1:
+            logger.verbose("Not starting worker processes because accounts are synchronized in parallel.")
+            use_pool = False
+        if use_pool:
+            with ProcessPoolExecutor(max_workers=self.parse_processes) as pool:
+                pending = collections.deque()
+                for batch in batches:
+                    num_previous = len(pending)
+                    for uid in batch:
+                        pending.append((uid, pool.submit(parse_cached_email, uid, self.get_cache_file(uid))))
+                    for _ in range(num_previous):
+                        uid, future = pending.popleft()
+                        yield future.result() or empty_email(uid)
+                while pending:
+                    uid, future = pending.popleft()
+                    yield future.result() or empty_email(uid)
         else:
-            logger.verbose("Downloading email with UID %s to ..", uid, formatted_path)
-            response = self.client.uid("fetch", str(uid), "(RFC822)")
-            data = self.check_response(response, "Failed to download conversation with UID %s!", uid)
-            raw_body = data[0][1].decode("ascii")
-            with open(local_copy, "w") as handle:
-                handle.write(raw_body)
-            return EmailMessageParser(raw_body=raw_body, uid=uid)
-
-    def parse_singlepart_email(self, email):
-        """Extract a chat message from a single-part email downloaded from :attr:`chats_folder`."""
-        logger.verbose("Parsing single-part email with UID %s ..", email.uid)
+            for batch in batches:
+                for uid in batch:
+                    yield parse_cached_email(uid, self.get_cache_file(uid)) or empty_email(uid)
+
+    def import_singlepart_email(self, parsed_email):
+        """
+        Import the chat message in a single-part email downloaded from :attr:`chats_folder`.
+
+        :param parsed_email: A :class:`ParsedEmail` tuple.
+        """
+        message = parsed_email.messages[0]
         # Determine the sender and recipient.
-        sender = self.contact_from_header(email.parsed_body["from"])
-        recipient = self.contact_from_header(email.parsed_body["to"])
+        sender = self.contact_from_header(message.sender)
+        recipient = self.contact_from_header(message.recipient)
         # Look for an existing conversation to add the message to.
         conversation = self.find_conversation(sender, recipient)
         # Create a new conversation if we didn't find one.
         if not conversation:
             conversation = Conversation(account=self.account)
             self.session.add(conversation)
-        # Get the message text.
-        binary_html = email.parsed_body.get_payload(decode=True)
-        unicode_html = binary_html.decode(email.parsed_body.get_content_charset())
+            # Assign a primary key to the conversation (get_or_create_message()
+            # looks up existing messages by conversation without autoflush).
+            self.session.flush()
         # Import the message.
         self.get_or_create_message(
             conversation=conversation,
-            external_id=email.uid,
-            html=unicode_html,
+            external_id=parsed_email.uid,
+            html=message.html,
             recipient=recipient,
             sender=sender,
-            text=html_to_text(unicode_html),
-            timestamp=email.timestamp,
+            text=message.text,
+            timestamp=message.timestamp,
         )
 
-    def parse_multipart_email(self, email):
-        """Find the ``text/xml`` payload in an RFC 822 multi-part email message."""
-        conversation = self.get_or_create_conversation(external_id=email.uid, last_modified=email.timestamp)
+    def import_multipart_email(self, parsed_email):
+        """
+        Import the chat messages embedded in a multi-part email downloaded from :attr:`chats_folder`.
+
+        :param parsed_email: A :class:`ParsedEmail` tuple.
+        """
+        conversation = self.get_or_create_conversation(
+            external_id=parsed_email.uid, last_modified=parsed_email.timestamp
+        )
         # Delete any existing messages in the conversation
         # so that repeated importing of the email doesn't
         # create duplicate messages.
         conversation.delete_messages()
         # Now we're ready to import the embedded messages.
-        logger.verbose("Parsing multi-part email with UID %s ..", conversation.external_id)
-        for nested_message in email.parsed_body.get_payload():
-            nested_payload = nested_message.get_payload(decode=True)
-            content_type = nested_message.get_content_type()
-            if content_type == "text/xml":
-                logger.verbose("Parsing embedded text/xml message ..")
-                self.parse_xml(nested_payload, conversation)
-        conversation.import_complete = True
-
-    def parse_xml(self, xml_body, conversation):
-        """Extract chat messages from the ``text/xml`` payload."""
-        logger.verbose("Parsing XML fragment:\n%s", xml_body)
-        tree = xml.etree.ElementTree.fromstring(xml_body)
-        for message_node in tree.findall("{jabber:client}message"):
-            body_node = message_node.find("{jabber:client}body")
-            node_text = getattr(body_node, "text", None)
-            if node_text and not node_text.isspace():
-                node_text = node_text.rstrip()
-                attributes = dict(
-                    conversation=conversation,
-                    html=self.extract_html(message_node),
-                    text=node_text,
-                    timestamp=self.extract_timestamp(message_node),
-                )
-                logger.verbose(
-                    "Importing XML message node with body text %r:\n%s", node_text, LazyXMLFormatter(message_node)
-                )
-                if message_node.attrib.get("type") == "groupchat":
-                    conversation.is_group_conversation = True
-                    if message_node.attrib.get("jid"):
-                        logger.verbose("Importing group message based on 'jid' attribute ..")
-                        attributes["sender"] = self.contact_from_jid(message_node.attrib["jid"])
-                    elif message_node.attrib.get("from"):
-                        logger.verbose("Importing group message based on 'from' attribute ('jid' not available) ..")
-                        attributes["sender"] = self.contact_from_jid(message_node.attrib["from"])
-                    else:
-                        logger.warning("Importing group message without sender information ..")
-                elif conversation.is_group_conversation and message_node.attrib.get("jid"):
-                    # This is a somewhat weird edge case that I encountered in
-                    # a group conversation from 2011 whose IMAP representation
-                    # contained mostly group messages, but also some private
-                    # messages (that were sent inside of the group conversation
-                    # but to an individual). It's funny to note that the
-                    # rudimentary Google Talk archive available in Google Mail
-                    # using the in:chat label renders these messages wrong. I
-                    # actually looked into personal laptop backups from 2011 to
-                    # verify my recollection of how that conversation went :-).
-                    logger.verbose("Importing private message in group conversation based on 'jid' attribute ..")
-                    attributes["sender"] = self.contact_from_jid(message_node.attrib["jid"])
-                    attributes["recipient"] = self.contact_from_jid(message_node.attrib["to"])
+        logger.verbose("Importing multi-part email with UID %s ..", conversation.external_id)
+        for message in parsed_email.messages:
+            attributes = dict(
+                conversation=conversation, html=message.html, text=message.text, timestamp=message.timestamp
+            )
+            if message.type == "groupchat":
+                conversation.is_group_conversation = True
+                if message.jid:
+                    logger.verbose("Importing group message based on 'jid' attribute ..")
+                    attributes["sender"] = self.contact_from_jid(message.jid)
+                elif message.sender:
+                    logger.verbose("Importing group message based on 'from' attribute ('jid' not available) ..")
+                    attributes["sender"] = self.contact_from_jid(message.sender)
                 else:
-                    logger.verbose("Importing private message based on 'from' and 'to' attributes ..")
-                    attributes["sender"] = self.contact_from_jid(message_node.attrib["from"])
-                    attributes["recipient"] = self.contact_from_jid(message_node.attrib["to"])
-                self.get_or_create_message(**attributes)
+                    logger.warning("Importing group message without sender information ..")
+            elif conversation.is_group_conversation and message.jid:
+                # This is a somewhat weird edge case that I encountered in
+                # a group conversation from 2011 whose IMAP representation
+                # contained mostly group messages, but also some private
+                # messages (that were sent inside of the group conversation
+                # but to an individual). It's funny to note that the
+                # rudimentary Google Talk archive available in Google Mail
+                # using the in:chat label renders these messages wrong. I
+                # actually looked into personal laptop backups from 2011 to
+                # verify my recollection of how that conversation went :-).
+                logger.verbose("Importing private message in group conversation based on 'jid' attribute ..")
+                attributes["sender"] = self.contact_from_jid(message.jid)
+                attributes["recipient"] = self.contact_from_jid(message.recipient)
+            else:
+                logger.verbose("Importing private message based on 'from' and 'to' attributes ..")
+                attributes["sender"] = self.contact_from_jid(message.sender)
+                attributes["recipient"] = self.contact_from_jid(message.recipient)
+            self.get_or_create_message(**attributes)
+        conversation.import_complete = True
 
     def find_conversation(self, *participants):
         """Find a conversation (without an external ID) that involves the given participants."""
@@ -337,7 +676,8 @@ class GoogleTalkBackend(ChatArchiveBackend):
                     self.conversation_map[participants] = conversation
                     return conversation
 
-    def extract_timestamp(self, message_node):
+    @staticmethod
+    def extract_timestamp(message_node):
         """
         Extract a timestamp from a ``<message>`` node.
 
@@ -348,7 +688,8 @@ class GoogleTalkBackend(ChatArchiveBackend):
         timestamp_as_float = float(timestamp_node.attrib["ms"]) / 1000
         return datetime.datetime.utcfromtimestamp(timestamp_as_float)
 
-    def extract_html(self, message_node):
+    @staticmethod
+    def extract_html(message_node):
         """
         Try to extract HTML from a ``<message>`` node.
 
@@ -358,7 +699,7 @@ class GoogleTalkBackend(ChatArchiveBackend):
         html_node = message_node.find("{http://jabber.org/protocol/xhtml-im}html")
         if html_node is not None:
             # Remove XML name spaces from the HTML node and its children.
-            for nested_node in html_node.getiterator():
+            for nested_node in html_node.iter():
                 match = NAMESPACED_TAG_PATTERN.match(nested_node.tag)
                 if match:
                     nested_node.tag = match.group(1)
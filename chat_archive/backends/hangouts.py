@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: August 2, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """Synchronization logic for the Google Hangouts backend of the `chat-archive` program."""
@@ -11,7 +11,6 @@ import asyncio
 import getpass
 import html
 import os
-import time
 
 # External dependencies.
 import hangups
@@ -20,7 +19,7 @@ from hangups.auth import RefreshTokenCache, get_auth
 from hangups.conversation_event import ChatMessageEvent
 from hangups.hangouts_pb2 import CONVERSATION_TYPE_GROUP
 from hangups.user import DEFAULT_NAME
-from humanfriendly import Timer, concatenate, format_timespan, pluralize
+from humanfriendly import Timer, concatenate, pluralize
 from property_manager import PropertyManager, lazy_property, mutable_property, required_property
 from verboselogs import VerboseLogger
 
@@ -45,9 +44,11 @@ class HangoutsBackend(ChatArchiveBackend):
     =================  =========================================================
     Option             Description
     =================  =========================================================
+    ``concurrency``    See :attr:`concurrency`.
     ``email-address``  The email address used to sign in to your Google account.
     ``password-name``  The name of a password in ``~/.password-store`` to use.
     ``password``       The password used to sign in to your Google account.
+    ``request-rate``   See :attr:`request_rate`.
     =================  =========================================================
 
     If you set ``password-name`` then ``password` doesn't have to be set. If
@@ -60,6 +61,17 @@ class HangoutsBackend(ChatArchiveBackend):
         """A :class:`set` of strings with 'gaia_id' values of "bogus" users."""
         return set()
 
+    @mutable_property
+    def concurrency(self):
+        """
+        The maximum number of conversations that are downloaded at the same time (an integer, defaults to 4).
+
+        The value of this property can be changed using the ``concurrency``
+        configuration option. Refer to :func:`download_all_conversations()`
+        for details.
+        """
+        return int(self.config.get("concurrency", "4"))
+
     @mutable_property
     def cookie_file(self):
         """The pathname of the ``*.json`` file with cached credentials (a string)."""
@@ -86,9 +98,14 @@ class HangoutsBackend(ChatArchiveBackend):
         )
 
     @mutable_property
-    def retry_count(self):
-        """The number of times that a batch of messages will be requested (a number, defaults to 5)."""
-        return 5
+    def request_rate(self):
+        """
+        The maximum sustained number of API requests per second (a number, defaults to 2).
+
+        The value of this property can be changed using the ``request-rate``
+        configuration option.
+        """
+        return float(self.config.get("request-rate", "2"))
 
     def synchronize(self):
         """Download chat contacts and messages and store them in the local archive."""
@@ -134,15 +151,32 @@ class HangoutsBackend(ChatArchiveBackend):
                 )
 
     async def download_all_conversations(self, conversation_list):
-        """Download conversations from Google Hangouts."""
+        """
+        Download conversations from Google Hangouts.
+
+        Up to :attr:`concurrency` conversations are downloaded at the same time
+        (using :func:`asyncio.gather()` and an :class:`asyncio.Semaphore`) so
+        that network round trips of different conversations overlap. Database
+        access doesn't need further synchronization because the coroutines run
+        in a single thread and never await in the middle of database changes.
+        The scopes of :attr:`stats` can interleave (which doesn't affect the
+        totals) so statistics are reported once all conversations have been
+        downloaded, not per conversation.
+        """
         timer = Timer()
-        for conversation in conversation_list.get_all(include_archived=True):
-            try:
-                await self.download_conversation(conversation)
-            except Exception:
-                logger.warning("Skipping conversation due to synchronization error ..", exc_info=True)
-                self.stats.failed_conversations += 1
-            self.stats.show()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def download_with_semaphore(conversation):
+            async with semaphore:
+                try:
+                    await self.download_conversation(conversation)
+                except Exception:
+                    logger.warning("Skipping conversation due to synchronization error ..", exc_info=True)
+                    self.stats.failed_conversations += 1
+
+        await asyncio.gather(
+            *(download_with_semaphore(c) for c in conversation_list.get_all(include_archived=True))
+        )
         summary = []
         if self.stats.conversations_added > 0:
             summary.append(pluralize(self.stats.conversations_added, "conversation"))
@@ -225,7 +259,6 @@ class HangoutsBackend(ChatArchiveBackend):
         """Download the messages in a specific Hangouts conversation."""
         while True:
             downloaded_messages = []
-            new_messages = []
             # Filter out message types that we're not interested in.
             for event in await self.download_message_batch(conversation, event_id):
                 if isinstance(event, ChatMessageEvent):
@@ -235,9 +268,9 @@ class HangoutsBackend(ChatArchiveBackend):
             # Process the messages in reverse chronological order because this
             # is how the Google Hangouts API works and staying as consistent
             # as possible with that should guarantee that we don't cause gaps.
-            for event in sorted(downloaded_messages, key=lambda e: event.timestamp, reverse=True):
+            batch = []
+            for event in sorted(downloaded_messages, key=lambda e: e.timestamp, reverse=True):
                 attributes = dict(
-                    conversation=conversation_in_db,
                     external_id=event.id_,
                     html=self.get_message_html(event),
                     text=event.text,
@@ -247,52 +280,27 @@ class HangoutsBackend(ChatArchiveBackend):
                 # are stored in the local database without an associated contact.
                 if event.user_id.gaia_id not in self.bogus_user_ids:
                     attributes["sender"] = self.find_contact_by_external_id(event.user_id.gaia_id)
-                created, message = self.get_or_create_message(**attributes)
-                if created:
-                    new_messages.append(message)
+                batch.append(attributes)
+            new_messages = self.get_or_create_messages(conversation_in_db, batch)
             if not new_messages:
                 return
             # Continue searching for older messages based on the event id
             # of the oldest message in the set of new messages that we've
             # just downloaded.
-            new_messages = sorted(new_messages, key=lambda m: m.timestamp)
-            event_id = new_messages[0].external_id
+            event_id = min(new_messages, key=lambda m: m["timestamp"])["external_id"]
             logger.verbose("Searching for new messages older than %s ..", event_id)
             # Commit every set of newly downloaded chat messages to disk
             # immediately, so that we don't have to download messages more
             # than once when we crash due to rate limiting or other API
             # errors emitted by the Hangouts API.
             self.archive.commit_changes()
-            # FIXME Poor man's rate limiting :-).
-            logger.info("Sleeping for a second ..")
-            time.sleep(1)
 
     async def download_message_batch(self, conversation, event_id):
-        """Try to download a batch of messages (retrying according to :attr:`retry_count`)."""
-        back_off = 0.5
-        for request_nr in range(1, self.retry_count):
-            try:
-                logger.verbose(
-                    "Attempt %i/%i: Requesting messages in conversation (%s) before given message id (%s) ..",
-                    request_nr,
-                    self.retry_count,
-                    conversation.id_,
-                    event_id,
-                )
-                return await conversation.get_events(event_id=event_id)
-            except hangups.exceptions.NetworkError:
-                if request_nr < self.retry_count:
-                    logger.notice(
-                        "Attempt %i/%i: Sleeping for %s before retrying failed request ..",
-                        request_nr,
-                        self.retry_count + 1,
-                        format_timespan(back_off),
-                    )
-                    time.sleep(back_off)
-                    back_off = min(back_off * 2, 10)
-                else:
-                    logger.warning("Giving up on conversation after %i failed requests!", request_nr)
-                    raise
+        """Download a batch of messages (with rate limiting and retries, refer to :func:`call_api_async()`)."""
+        logger.verbose(
+            "Requesting messages in conversation (%s) before given message id (%s) ..", conversation.id_, event_id
+        )
+        return await self.call_api_async(conversation.get_events, event_id=event_id)
 
     def get_message_html(self, event):
         """Get the formatted text of a chat message as HTML."""
@@ -324,6 +332,10 @@ class HangoutsBackend(ChatArchiveBackend):
         else:
             return False
 
+    def is_retryable(self, exception):
+        """Retry requests that failed due to network errors."""
+        return isinstance(exception, hangups.exceptions.NetworkError)
+
 
 class GoogleAccountCredentials(PropertyManager):
 
@@ -1,39 +1,93 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: July 21, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """Synchronization logic for the Slack backend of the `chat-archive` program."""
 
 # Standard library modules.
+import collections
 import datetime
 import decimal
 import html
+import queue
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # External dependencies.
-from humanfriendly import Spinner
+from humanfriendly import Spinner, Timer, pluralize
 from humanfriendly.terminal import HIGHLIGHT_COLOR, ansi_wrap
 from property_manager import lazy_property, mutable_property
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 from requests.sessions import Session
 from slacker import Slacker
+from sqlalchemy import bindparam, select
 from verboselogs import VerboseLogger
 
 # Modules included in our package.
-from chat_archive.backends import ChatArchiveBackend
+from chat_archive.backends import ChatArchiveBackend, pre_process_message
 from chat_archive.html import html_to_text
+from chat_archive.html.redirects import RedirectStripper
+from chat_archive.models import Contact, Conversation, Message
+from chat_archive.ratelimit import parse_retry_after
 from chat_archive.utils import get_secret
 
 FRIENDLY_NAME = "Slack"
 """A user friendly name for the chat service supported by this backend (a string)."""
 
+PREFORMATTED_TOKEN_PATTERN = re.compile(r"[&<]")
+"""A compiled regular expression that matches the characters that start tokens in pre-formatted text."""
+
+TOKEN_PATTERN = re.compile(r"[&*<_`~]")
+"""A compiled regular expression that matches the characters that (may) start mrkdwn tokens."""
+
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
+# The MessageRenderer object used by worker processes (see initialize_renderer()).
+worker_renderer = None
+
+
+def initialize_renderer(contact_names):
+    """
+    Initialize a worker process used by :func:`SlackBackend.rerender_messages()`.
+
+    :param contact_names: Refer to :class:`MessageRenderer`.
+    """
+    global worker_renderer
+    worker_renderer = MessageRenderer(contact_names)
+
+
+def render_batch(rows):
+    """
+    Re-render a batch of messages in a worker process.
+
+    :param rows: Refer to :func:`MessageRenderer.__call__()`.
+    :returns: Refer to :func:`MessageRenderer.__call__()`.
+    """
+    return worker_renderer(rows)
+
 
 class SlackBackend(ChatArchiveBackend):
 
-    """Container for the Slack chat archive backend."""
+    """
+    Container for the Slack chat archive backend.
+
+    This backend supports the following configuration options:
+
+    ====================  =========================================================
+    Option                Description
+    ====================  =========================================================
+    ``api-token``         The Slack API token (see :attr:`api_token`).
+    ``api-token-name``    The name of an API token in ``~/.password-store`` to use.
+    ``concurrency``       See :attr:`concurrency`.
+    ``render-processes``  See :attr:`render_processes`.
+    ``request-rate``      See :attr:`request_rate`.
+    ====================  =========================================================
+    """
 
     @lazy_property
     def api_token(self):
@@ -44,8 +98,26 @@ class SlackBackend(ChatArchiveBackend):
 
     @lazy_property
     def client(self):
-        """A ``slacker.Slacker`` instance initialized with :attr:`api_token` and :attr:`http_session`."""
-        return Slacker(self.api_token, session=self.http_session)
+        """
+        A ``slacker.Slacker`` instance initialized with :attr:`api_token` and :attr:`http_session`.
+
+        Slacker's own handling of HTTP 429 responses (which blocks only the
+        calling thread) is disabled in favor of :func:`call_api()`.
+        """
+        return Slacker(self.api_token, session=self.http_session, rate_limit_retries=0)
+
+    @mutable_property
+    def concurrency(self):
+        """
+        The maximum number of channels whose history is downloaded at the same time (an integer, defaults to 4).
+
+        The history of channels is downloaded by a pool of threads while the
+        downloaded messages are imported by a single thread (refer to
+        :func:`import_conversations()`). Slack's rate limits apply per
+        method, so the default is conservative. It can be changed using the
+        ``concurrency`` configuration option.
+        """
+        return int(self.config.get("concurrency", "4"))
 
     @mutable_property
     def is_limited(self):
@@ -59,8 +131,47 @@ class SlackBackend(ChatArchiveBackend):
 
     @lazy_property
     def http_session(self):
-        """A ``requests.Session`` object used for HTTP connection re-use."""
-        return Session()
+        """
+        A ``requests.Session`` object used for HTTP connection re-use.
+
+        The connection pool of the session is sized according to
+        :attr:`concurrency` because the session is shared by the threads
+        that download channel history.
+        """
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.concurrency, 10))
+        session.mount("https://", adapter)
+        return session
+
+    @mutable_property
+    def render_batch_size(self):
+        """The number of messages processed at once by :func:`rerender_messages()` (an integer, defaults to 1000)."""
+        return 1000
+
+    @mutable_property
+    def render_processes(self):
+        """
+        The number of worker processes used by :func:`rerender_messages()` (an integer, defaults to 1).
+
+        Rendering messages in a pool of worker processes can be enabled using
+        the ``render-processes`` configuration option. When the value is one
+        the messages are rendered in the main process.
+        """
+        return int(self.config.get("render-processes", "1"))
+
+    @mutable_property
+    def request_rate(self):
+        """
+        The maximum sustained number of API requests per second (a number, defaults to 0.8).
+
+        Slack's `rate limits`_ are defined per API method and workspace. The
+        methods used by this backend are in tier 3 (50+ requests per minute).
+        The value of this property can be changed using the ``request-rate``
+        configuration option.
+
+        .. _rate limits: https://api.slack.com/docs/rate-limits
+        """
+        return float(self.config.get("request-rate", "0.8"))
 
     @lazy_property
     def spinner(self):
@@ -77,7 +188,7 @@ class SlackBackend(ChatArchiveBackend):
     def synchronize_users(self):
         """Download information about the users in the organization on Slack."""
         logger.verbose("Synchronizing users ..")
-        response = self.client.users.list()
+        response = self.call_api(self.client.users.list)
         for user in response.body["members"]:
             profile = user.get("profile", {})
             self.get_or_create_contact(
@@ -91,59 +202,172 @@ class SlackBackend(ChatArchiveBackend):
     def synchronize_direct_messages(self):
         """Download the latest direct messages from Slack."""
         logger.verbose("Importing direct messages ..")
-        response = self.client.im.list()
-        num_ims = len(response.body["ims"])
-        for i, dm in enumerate(response.body["ims"], start=1):
-            progress = "%i/%i" % (i, num_ims)
-            logger.verbose("Synchronizing direct message channel %s (%s) ..", progress, dm["id"])
-            self.spinner.label = "Synchronizing direct message channel %s" % progress
-            self.import_messages(
-                self.client.im, self.get_or_create_conversation(external_id=dm["id"], is_group_conversation=False)
-            )
+        response = self.call_api(self.client.im.list)
+        self.import_conversations(
+            (self.client.im, self.get_or_create_conversation(external_id=dm["id"], is_group_conversation=False))
+            for dm in response.body["ims"]
+        )
 
     def synchronize_channels(self):
         """Download messages from named channels."""
-        response = self.client.channels.list()
-        num_channels = len(response.body["channels"])
-        for i, channel in enumerate(response.body["channels"], start=1):
-            logger.verbose("Synchronizing #%s channel (%s) ..", channel["name"], channel["id"])
-            self.spinner.label = "Synchronizing channel %s: %s" % (
-                "%i/%i" % (i, num_channels),
-                ansi_wrap("#%s" % channel["name"], color=HIGHLIGHT_COLOR),
-            )
-            self.import_messages(
+        response = self.call_api(self.client.channels.list)
+        self.import_conversations(
+            (
                 self.client.channels,
                 self.get_or_create_conversation(
                     external_id=channel["id"], is_group_conversation=True, name=("#" + channel["name"])
                 ),
             )
+            for channel in response.body["channels"]
+        )
+
+    def import_conversations(self, conversations):
+        """
+        Import the history of multiple Slack channels.
+
+        :param conversations: An iterable of tuples with two values each:
+
+                              1. The Slacker API object for the type of channel.
+                              2. The :class:`.Conversation` object of the channel.
+
+        The history of up to :attr:`concurrency` channels is downloaded at
+        the same time by a pool of threads (which don't touch the database)
+        while the current thread imports the downloaded pages one at a time
+        (using :func:`import_page()`) as soon as they become available.
+        """
+        conversations = list(conversations)
+        if not conversations:
+            return
+        # The queue is bounded to limit the number of pages held in memory.
+        pages = queue.Queue(maxsize=self.concurrency * 2)
+        cancelled = threading.Event()
+
+        def put(item):
+            # Give up when the consumer stops, so that threads blocked
+            # on a full queue don't prevent the pool from shutting down.
+            while not cancelled.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def download_history(index, source, channel_id, oldest):
+            if cancelled.is_set():
+                return
+            try:
+                for page in self.get_history_pages(source, channel_id, oldest=oldest):
+                    if not put((index, page, None)):
+                        return
+            except Exception as e:
+                put((index, None, e))
+            else:
+                put((index, None, None))
+
+        # Make sure the conversations have been assigned a primary key.
+        self.session.flush()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for index, (source, conversation) in enumerate(conversations):
+                oldest = self.get_oldest_timestamp(conversation)
+                pool.submit(download_history, index, source, conversation.external_id, oldest)
+            try:
+                num_remaining = len(conversations)
+                while num_remaining > 0:
+                    index, page, error = pages.get()
+                    conversation = conversations[index][1]
+                    if page is not None:
+                        self.spinner.label = "Synchronizing %s" % ansi_wrap(
+                            conversation.name or conversation.external_id, color=HIGHLIGHT_COLOR
+                        )
+                        self.import_page(conversation, page)
+                    else:
+                        num_remaining -= 1
+                        if error is not None:
+                            logger.warning("Failed to download history of %s!", conversation.external_id)
+                            raise error
+                        logger.verbose(
+                            "Synchronized %s (%i/%i).",
+                            conversation.name or conversation.external_id,
+                            len(conversations) - num_remaining,
+                            len(conversations),
+                        )
+                        if not conversation.import_complete:
+                            conversation.import_complete = True
+            finally:
+                # Stop the download threads (also when the
+                # import fails or the user interrupts us).
+                cancelled.set()
 
     def import_messages(self, source, conversation_in_db):
-        """Import the history of the given Slack channel."""
-        # Page backward on the initial synchronization, forward afterwards.
-        oldest = 0
+        """Import the history of the given Slack channel (refer to :func:`import_conversations()`)."""
+        self.import_conversations([(source, conversation_in_db)])
+
+    def import_page(self, conversation_in_db, page):
+        """
+        Import a page of messages downloaded by :func:`get_history_pages()`.
+
+        :param conversation_in_db: The :class:`.Conversation` object of the Slack channel.
+        :param page: A list of dictionaries with Slack messages.
+        """
+        # We perform a lightweight check for previously imported messages
+        # (one query per page) before processing the message text to avoid
+        # unnecessary work.
+        known_ids = self.find_existing_messages(conversation_in_db, [m["ts"] for m in page])
+        new_messages = []
+        for message in page:
+            self.spinner.step()
+            if message["ts"] not in known_ids:
+                html = self.mrkdwn_to_html(message["text"])
+                new_messages.append(
+                    dict(
+                        external_id=message["ts"],
+                        html=html,
+                        raw=message["text"],
+                        sender=self.get_or_create_contact(external_id=message["user"]),
+                        text=html_to_text(html),
+                        timestamp=datetime.datetime.utcfromtimestamp(float(message["ts"])),
+                    )
+                )
+        self.get_or_create_messages(conversation_in_db, new_messages)
+
+    def get_oldest_timestamp(self, conversation_in_db):
+        """
+        Determine where to start downloading the history of a Slack channel.
+
+        :param conversation_in_db: The :class:`.Conversation` object of the Slack channel.
+        :returns: The timestamp of the newest message in the local archive
+                  (a string) or 0 (when the initial synchronization hasn't
+                  completed yet).
+
+        We page backward on the initial synchronization, forward afterwards.
+        """
         if conversation_in_db.import_complete and conversation_in_db.newest_message:
             oldest = conversation_in_db.newest_message.external_id
             logger.verbose("Searching for messages newer than %s ..", oldest)
-        for message in self.get_history(source, conversation_in_db.external_id, oldest=oldest):
-            # We perform a lightweight check for previously imported messages
-            # before processing the message text to avoid unnecessary work.
-            if not self.have_message(conversation_in_db, message["ts"]):
-                html = self.mrkdwn_to_html(message["text"])
-                self.get_or_create_message(
-                    conversation=conversation_in_db,
-                    external_id=message["ts"],
-                    html=html,
-                    raw=message["text"],
-                    sender=self.get_or_create_contact(external_id=message["user"]),
-                    text=html_to_text(html),
-                    timestamp=datetime.datetime.utcfromtimestamp(float(message["ts"])),
-                )
-        if not conversation_in_db.import_complete:
-            conversation_in_db.import_complete = True
+            return oldest
+        return 0
 
     def get_history(self, source, channel_id, latest=None, oldest=0, page_size=100):
-        """Get the history of the given Slack channel."""
+        """Get the history of the given Slack channel (refer to :func:`get_history_pages()`)."""
+        for page in self.get_history_pages(source, channel_id, latest=latest, oldest=oldest, page_size=page_size):
+            for message in page:
+                yield message
+
+    def get_history_pages(self, source, channel_id, latest=None, oldest=0, page_size=100):
+        """
+        Get the history of the given Slack channel, one page at a time.
+
+        :param source: The Slacker API object for the type of channel.
+        :param channel_id: The ID of the Slack channel (a string).
+        :param latest: The timestamp of the newest message to request (a string or :data:`None`).
+        :param oldest: The timestamp of the oldest message to request (a string or 0).
+        :param page_size: The number of messages to request at once (an integer, defaults to 100).
+        :returns: A generator of lists with messages (dictionaries).
+
+        This method doesn't touch the database or the terminal, so it can be
+        used from the download threads started by :func:`import_conversations()`.
+        """
         while True:
             logger.verbose(
                 "Requesting history (channel=%s, latest=%s, oldest=%s, count=%s) ..",
@@ -152,9 +376,9 @@ class SlackBackend(ChatArchiveBackend):
                 oldest,
                 page_size,
             )
-            self.spinner.step()
-            response = source.history(channel=channel_id, latest=latest, oldest=oldest, count=page_size)
+            response = self.call_api(source.history, channel=channel_id, latest=latest, oldest=oldest, count=page_size)
             logger.verbose("Processing response with %s message(s) ..", len(response.body["messages"]))
+            page = []
             for message in response.body["messages"]:
                 # We use decimals instead of floats to avoid rounding errors.
                 message_ts = decimal.Decimal(message["ts"])
@@ -168,14 +392,144 @@ class SlackBackend(ChatArchiveBackend):
                         latest = message["ts"]
                 # Only user generated messages are import.
                 if message["type"] == "message" and message.get("subtype") != "bot_message":
-                    self.spinner.step()
-                    yield message
+                    page.append(message)
+            if page:
+                yield page
             if not self.is_limited and response.body.get("is_limited", False):
                 logger.notice("Conversation history is being limited by Slack's free plan.")
                 self.is_limited = True
             if not response.body["has_more"]:
                 break
 
+    def get_retry_after(self, exception):
+        """Get the delay requested by the ``Retry-After`` header of an HTTP 429 response."""
+        if isinstance(exception, HTTPError) and exception.response is not None:
+            if exception.response.status_code == 429:
+                return parse_retry_after(exception.response.headers.get("Retry-After")) or 1
+
+    def is_retryable(self, exception):
+        """Retry connection errors, timeouts, rate limited requests and server errors."""
+        if isinstance(exception, HTTPError) and exception.response is not None:
+            return exception.response.status_code == 429 or exception.response.status_code >= 500
+        return isinstance(exception, (ConnectionError, Timeout))
+
+    def get_contact_names(self):
+        """
+        Get the names used to expand ``@references`` to the contacts of this account.
+
+        :returns: A dictionary that maps external IDs (strings) to the
+                  :attr:`~chat_archive.models.Contact.unambiguous_name` of
+                  the contacts in this account (strings).
+
+        The names are computed using two queries (instead of two queries per
+        contact) so that they can be passed to worker processes up front.
+        """
+        ambiguous_first_names = Contact.find_ambiguous_first_names(self.session)
+        query = self.session.query(Contact).filter(Contact.account == self.account, Contact.external_id != None)
+        return {contact.external_id: contact.get_unambiguous_name(ambiguous_first_names) for contact in query}
+
+    def get_raw_batches(self, start_id=0):
+        """
+        Get the raw text of the messages in this account in batches.
+
+        :param start_id: Only messages whose :attr:`~chat_archive.models.Message.id`
+                         is greater than this value are selected (an integer).
+        :returns: A generator of lists with up to :attr:`render_batch_size`
+                  tuples with four values each: The id, raw text, HTML and
+                  plain text of a message.
+
+        Messages are selected in order of their id using a separate query per
+        batch (keyset pagination), so only one batch is held in memory.
+        """
+        query = (
+            select([Message.id, Message.raw, Message.html, Message.text])
+            .select_from(Message.__table__.join(Conversation.__table__))
+            .where(Conversation.account_id == self.account.id)
+            .where(Message.raw != None)
+            .order_by(Message.id)
+            .limit(self.render_batch_size)
+        )
+        while True:
+            batch = self.session.execute(query.where(Message.id > start_id)).fetchall()
+            if not batch:
+                break
+            yield [tuple(row) for row in batch]
+            start_id = batch[-1][0]
+
+    def rerender_messages(self, start_id=0):
+        """
+        Regenerate the HTML and text of messages based on their raw mrkdwn text.
+
+        :param start_id: Refer to :func:`get_raw_batches()`.
+        :returns: The number of messages that were updated (an integer).
+
+        Batches of messages are rendered by :class:`MessageRenderer` in a pool
+        of :attr:`render_processes` worker processes (the next batch is
+        submitted before the results of the previous batch are processed).
+        Only messages whose HTML or text changed are written back to the
+        database, using a single ``UPDATE`` statement with multiple parameter
+        sets per batch, after which the changes are committed. Because batches
+        are processed in order of message id, an interrupted run can be
+        resumed by passing the last reported message id as `start_id`.
+        """
+        timer = Timer()
+        num_processed = 0
+        num_updated = 0
+        contact_names = self.get_contact_names()
+        for last_id, num_rows, changes in self.render_batches(self.get_raw_batches(start_id), contact_names):
+            if changes:
+                self.session.execute(
+                    Message.__table__.update()
+                    .where(Message.id == bindparam("message_id"))
+                    .values(html=bindparam("new_html"), text=bindparam("new_text")),
+                    [dict(message_id=i, new_html=h, new_text=t) for i, h, t in changes],
+                )
+                self.archive.commit_changes()
+            num_processed += num_rows
+            num_updated += len(changes)
+            logger.verbose(
+                "Re-rendered %s (%i updated), resume from message id %i.",
+                pluralize(num_processed, "message"),
+                num_updated,
+                last_id,
+            )
+        logger.info(
+            "Updated %s out of %s in %r account (took %s).",
+            pluralize(num_updated, "message"),
+            pluralize(num_processed, "message"),
+            self.account_name,
+            timer,
+        )
+        return num_updated
+
+    def render_batches(self, batches, contact_names):
+        """
+        Render batches of messages (refer to :func:`rerender_messages()`).
+
+        :param batches: An iterable of lists of tuples (refer to :func:`get_raw_batches()`).
+        :param contact_names: Refer to :class:`MessageRenderer`.
+        :returns: A generator of tuples with three values each: The id of the
+                  last message in the batch, the number of messages in the
+                  batch and the changes (refer to :func:`MessageRenderer.__call__()`).
+        """
+        if self.render_processes > 1:
+            with ProcessPoolExecutor(
+                max_workers=self.render_processes, initializer=initialize_renderer, initargs=(contact_names,)
+            ) as pool:
+                pending = collections.deque()
+                for batch in batches:
+                    pending.append((batch[-1][0], len(batch), pool.submit(render_batch, batch)))
+                    if len(pending) > self.render_processes:
+                        last_id, num_rows, future = pending.popleft()
+                        yield last_id, num_rows, future.result()
+                while pending:
+                    last_id, num_rows, future = pending.popleft()
+                    yield last_id, num_rows, future.result()
+        else:
+            renderer = MessageRenderer(contact_names)
+            for batch in batches:
+                yield batch[-1][0], len(batch), renderer(batch)
+
     def expand_reference_callback(self, external_id):
         """Expand a ``@reference`` to a Slack user in a chat message with the name of that user."""
         contact = self.find_contact_by_external_id(external_id)
@@ -187,6 +541,12 @@ class HTMLConverter(object):
     """
     Convert Slack chat messages from mrkdwn_ format to HTML.
 
+    The input is scanned for the characters that can start a token (using
+    :data:`TOKEN_PATTERN`) and runs of plain text in between tokens are
+    encoded as HTML in bulk. Nested formatting is parsed in place, bounded by
+    the `start` and `end` indexes of the enclosing token (instead of slicing
+    the input and recursing on the copy).
+
     .. _mrkdwn: https://api.slack.com/docs/message-formatting#message_formatting
     """
 
@@ -213,87 +573,75 @@ class HTMLConverter(object):
         self.parse_text(text, 0, len(text), output)
         return "".join(output)
 
-    def followed_by_alphanumeric(self, input, index, limit):
+    def followed_by_alphanumeric(self, input, index, end):
         """Check if the given position is followed by an alphanumeric character."""
-        return index + 1 < limit and input[index + 1].isalnum()
+        return index + 1 < end and input[index + 1].isalnum()
 
-    def parse_bold(self, input, index, length, output):
+    def parse_bold(self, input, start, index, end, output):
         """Parse *bold* text."""
-        if not self.preceded_by_alphanumeric(input, index):
-            match = input.find("*", index + 1)
-            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
-                output.append("<b>")
-                nested = input[index + 1 : match]
-                self.parse_text(nested, 0, len(nested), output)
-                output.append("</b>")
-                return match + 1
+        return self.parse_span(input, start, index, end, output, "b")
 
-    def parse_entity(self, input, index, length, output):
+    def parse_entity(self, input, start, index, end, output):
         """Parse an HTML entity."""
-        match = input.find(";", index + 1)
+        match = input.find(";", index + 1, end)
         if match > 0:
             output.append(input[index : match + 1])
             return match + 1
 
-    def parse_italic(self, input, index, length, output):
+    def parse_italic(self, input, start, index, end, output):
         """Parse _italic_ text."""
-        if not self.preceded_by_alphanumeric(input, index):
-            match = input.find("_", index + 1)
-            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
-                output.append("<i>")
-                nested = input[index + 1 : match]
-                self.parse_text(nested, 0, len(nested), output)
-                output.append("</i>")
-                return match + 1
+        return self.parse_span(input, start, index, end, output, "i")
 
-    def parse_preformatted(self, input, index, length, output):
+    def parse_preformatted(self, input, start, index, end, output):
         """Parse `pre-formatted` text."""
-        if not self.preceded_by_alphanumeric(input, index):
-            if index + 2 < length and input[index + 1] == "`" and input[index + 2] == "`":
-                match = input.find("```", index + 3)
-                if match > 0 and not self.followed_by_alphanumeric(input, match + 2, length):
+        if not self.preceded_by_alphanumeric(input, start, index):
+            if index + 2 < end and input[index + 1] == "`" and input[index + 2] == "`":
+                match = input.find("```", index + 3, end)
+                if match > 0 and not self.followed_by_alphanumeric(input, match + 2, end):
                     output.append("<pre>")
-                    nested = input[index + 3 : match].strip("\r\n")
-                    self.parse_preformatted_body(nested, 0, len(nested), output)
+                    self.parse_preformatted_body(input[index + 3 : match].strip("\r\n"), output)
                     output.append("</pre>")
                     return match + 3
             else:
-                match = input.find("`", index + 1)
-                if match > 0 and not self.followed_by_alphanumeric(input, match, length):
+                match = input.find("`", index + 1, end)
+                if match > 0 and not self.followed_by_alphanumeric(input, match, end):
                     output.append("<code>")
-                    nested = input[index + 1 : match]
-                    self.parse_preformatted_body(nested, 0, len(nested), output)
+                    self.parse_preformatted_body(input[index + 1 : match], output)
                     output.append("</code>")
                     return match + 1
 
-    def parse_preformatted_body(self, input, index, length, output):
+    def parse_preformatted_body(self, input, output):
         """Parse the body of a pre-formatted text fragment."""
-        while index < length:
-            character = input[index]
-            if character == "<":
+        index = plain = 0
+        while True:
+            token = PREFORMATTED_TOKEN_PATTERN.search(input, index)
+            if not token:
+                break
+            index = token.start()
+            match = input.find(">" if input[index] == "<" else ";", index + 1)
+            if match < 0:
+                # Unterminated tokens are treated as plain text.
+                index += 1
+                continue
+            output.append(html.escape(input[plain:index], quote=False))
+            if input[index] == "<":
                 # Replace references with their visible text. Why does
                 # Slack embed these in pre-formatted text?! Argh! 😋
-                match = input.find(">", index + 1)
                 url, _, label = input[index + 1 : match].partition("|")
                 output.append(html.escape(label or url, quote=False))
-                index = match + 1
-            elif character == "&":
+            else:
                 # HTML entities pass through unchanged.
-                match = input.find(";", index + 1)
                 output.append(input[index : match + 1])
-                index = match + 1
-            else:
-                # Plain text is encoded as HTML.
-                output.append(html.escape(input[index], quote=False))
-                index += 1
+            index = plain = match + 1
+        # Plain text is encoded as HTML.
+        output.append(html.escape(input[plain:], quote=False))
 
-    def parse_reference(self, input, index, length, output):
+    def parse_reference(self, input, start, index, end, output):
         """Parse a reference to a URL, user or channel."""
-        if not self.preceded_by_alphanumeric(input, index):
-            match = input.find(">", index + 1)
-            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
-                nested = input[index + 1 : match]
-                url, _, label = nested.partition("|")
+        if not self.preceded_by_alphanumeric(input, start, index):
+            match = input.find(">", index + 1, end)
+            if match > 0 and not self.followed_by_alphanumeric(input, match, end):
+                url, _, label = input[index + 1 : match].partition("|")
                 if url.startswith("@"):
                     # Convert internal references to bold text.
                     url = url.lstrip("@")
@@ -309,31 +657,91 @@ class HTMLConverter(object):
                     output.append("</a>")
                 return match + 1
 
-    def parse_strike_through(self, input, index, length, output):
-        """Parse ~strike-through~ text."""
-        if not self.preceded_by_alphanumeric(input, index):
-            match = input.find("~", index + 1)
-            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
-                output.append("<s>")
-                nested = input[index + 1 : match]
-                self.parse_text(nested, 0, len(nested), output)
-                output.append("</s>")
+    def parse_span(self, input, start, index, end, output, tag):
+        """Parse text enclosed in a pair of formatting characters (used for bold, italic and strike-through)."""
+        if not self.preceded_by_alphanumeric(input, start, index):
+            match = input.find(input[index], index + 1, end)
+            if match > 0 and not self.followed_by_alphanumeric(input, match, end):
+                output.append("<%s>" % tag)
+                self.parse_text(input, index + 1, match, output)
+                output.append("</%s>" % tag)
                 return match + 1
 
-    def parse_text(self, input, index, length, output):
-        """Parse inline text."""
-        while index < length:
-            character = input[index]
-            method = self.parse_methods.get(character)
-            if method:
-                result = method(input, index, length, output)
-                if result:
-                    index = result
-                    continue
-            # Consume one character when no token could be matched.
-            output.append(html.escape(character, quote=False))
-            index += 1
-
-    def preceded_by_alphanumeric(self, input, index):
+    def parse_strike_through(self, input, start, index, end, output):
+        """Parse ~strike-through~ text."""
+        return self.parse_span(input, start, index, end, output, "s")
+
+    def parse_text(self, input, start, end, output):
+        """
+        Parse inline text.
+
+        :param input: The text of a Slack message (a string).
+        :param start: The index in `input` where parsing starts (an integer).
+        :param end: The index in `input` where parsing ends (an integer).
+        :param output: A list of strings to which the generated HTML is appended.
+        """
+        index = plain = start
+        while True:
+            token = TOKEN_PATTERN.search(input, index, end)
+            if not token:
+                break
+            index = token.start()
+            if index > plain:
+                output.append(html.escape(input[plain:index], quote=False))
+                plain = index
+            result = self.parse_methods[input[index]](input, start, index, end, output)
+            if result:
+                index = plain = result
+            else:
+                # Consume one character when no token could be matched.
+                index += 1
+        if end > plain:
+            output.append(html.escape(input[plain:end], quote=False))
+
+    def preceded_by_alphanumeric(self, input, start, index):
         """Check if the given position is preceded by an alphanumeric character."""
-        return index > 0 and input[index - 1].isalnum()
+        return index > start and input[index - 1].isalnum()
+
+
+class MessageRenderer(object):
+
+    """
+    Regenerate the HTML and plain text of Slack messages based on their raw text.
+
+    This applies the same steps as the import of new messages (conversion from
+    mrkdwn to HTML, from HTML to plain text and the expansion of redirect URLs)
+    without database access, so that it can be used in worker processes.
+    """
+
+    def __init__(self, contact_names):
+        """
+        Initialize a :class:`MessageRenderer` object.
+
+        :param contact_names: A dictionary that maps the external IDs of Slack
+                              users to their names (refer to
+                              :func:`SlackBackend.get_contact_names()`).
+        """
+        self.contact_names = contact_names
+        self.mrkdwn_to_html = HTMLConverter(expand_reference_callback=self.expand_reference_callback)
+        self.redirect_stripper = RedirectStripper()
+
+    def __call__(self, rows):
+        """
+        Re-render a batch of messages.
+
+        :param rows: A list of tuples with four values each: The id, raw
+                     text, HTML and plain text of a message.
+        :returns: A list of tuples with three values each: The id, new HTML
+                  and new plain text of the messages that changed.
+        """
+        changes = []
+        for message_id, raw, old_html, old_text in rows:
+            new_html = self.mrkdwn_to_html(raw)
+            new_text, new_html = pre_process_message(html_to_text(new_html), new_html, self.redirect_stripper)
+            if new_html != old_html or new_text != old_text:
+                changes.append((message_id, new_html, new_text))
+        return changes
+
+    def expand_reference_callback(self, external_id):
+        """Expand a ``@reference`` to a Slack user with the name of that user (or their external ID)."""
+        return self.contact_names.get(external_id, external_id)
@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 27, 2020
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """
@@ -17,8 +17,9 @@ import asyncio
 import os
 
 # External dependencies.
-from property_manager import lazy_property, mutable_property, required_property
+from property_manager import mutable_property, required_property
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError, ServerError
 from telethon.extensions.html import unparse
 from verboselogs import VerboseLogger
 
@@ -78,13 +79,48 @@ class TelegramBackend(ChatArchiveBackend):
             )
         )
 
-    @lazy_property
+    @mutable_property
+    def batch_size(self):
+        """
+        The number of messages to download (and commit to disk) at once (an integer, defaults to 100).
+
+        This is the maximum number of messages that the Telegram API returns
+        in response to a single request.
+        """
+        return 100
+
+    @mutable_property(cached=True)
     def client(self):
         """
         A :class:`telethon.TelegramClient` object constructed based on
         :attr:`api_id`,:attr:`api_hash` and :attr:`session_file`.
+
+        Telethon's own handling of flood wait errors is disabled because it
+        only delays the request that triggered the error. Instead these errors
+        are handled by :func:`.call_api_async()` which delays all requests.
+        """
+        return TelegramClient(self.session_file, self.api_id, self.api_hash, flood_sleep_threshold=0)
+
+    @mutable_property
+    def concurrency(self):
+        """
+        The maximum number of conversations that are synchronized at the same time (an integer, defaults to 4).
+
+        The value of this property can be changed using the ``concurrency``
+        configuration option. Refer to :func:`synchronize_dialogs()` for
+        details.
         """
-        return TelegramClient(self.session_file, self.api_id, self.api_hash)
+        return int(self.config.get("concurrency", "4"))
+
+    @mutable_property
+    def request_rate(self):
+        """
+        The maximum sustained number of API requests per second (a number, defaults to 5).
+
+        The value of this property can be changed using the ``request-rate``
+        configuration option.
+        """
+        return float(self.config.get("request-rate", "5"))
 
     @mutable_property
     def session_file(self):
@@ -105,7 +141,8 @@ class TelegramBackend(ChatArchiveBackend):
         options = dict(phone=phone_number) if phone_number else {}
         await self.client.start(**options)
         # Discover available conversations (called 'dialogs' in the Telegram API).
-        async for dialog in self.client.iter_dialogs():
+        dialogs = []
+        for dialog in await self.call_api_async(self.client.get_dialogs, limit=None):
             if not self.dialog_to_ignore(dialog):
                 is_group_conversation = self.is_group_conversation(dialog)
                 conversation_in_db = self.get_or_create_conversation(
@@ -120,14 +157,14 @@ class TelegramBackend(ChatArchiveBackend):
                     name=dialog.name if is_group_conversation else None,
                 )
                 if not conversation_in_db.import_complete:
-                    await self.perform_initial_sync(dialog, conversation_in_db)
+                    dialogs.append((dialog, conversation_in_db))
                 elif strip_tzinfo(dialog.date) > strip_tzinfo(conversation_in_db.last_modified):
                     logger.info("Conversation was updated (%s) ..", dialog.id)
-                    await self.update_conversation(dialog, conversation_in_db)
-                    conversation_in_db.last_modified = dialog.date
+                    dialogs.append((dialog, conversation_in_db))
                 else:
                     logger.info("Conversation hasn't changed (%s).", dialog.id)
-                self.stats.show()
+        await self.synchronize_dialogs(dialogs)
+        self.stats.show()
 
     def dialog_to_ignore(self, dialog):
         """
@@ -170,35 +207,136 @@ class TelegramBackend(ChatArchiveBackend):
         """Check if the given dialog is the dialog with the "Telegram" user, containing service messages."""
         return dialog.is_user and dialog.entity.first_name == "Telegram" and not dialog.entity.last_name
 
-    async def perform_initial_sync(self, dialog, conversation_in_db):
-        """Start or resume the initial synchronization."""
+    def get_download_options(self, dialog, conversation_in_db):
+        """
+        Prepare the (initial or incremental) synchronization of a conversation.
+
+        :param dialog: The Telegram dialog that is about to be synchronized.
+        :param conversation_in_db: The :class:`.Conversation` object of the dialog.
+        :returns: A dictionary with keyword arguments for :func:`get_message_pages()`.
+        """
         options = dict()
-        oldest_message = conversation_in_db.oldest_message
-        if oldest_message:
-            logger.info("Resuming initial synchronization of conversation %s ..", dialog.id)
-            options["max_id"] = int(oldest_message.external_id)
+        if conversation_in_db.import_complete:
+            newest_message = conversation_in_db.newest_message
+            if newest_message:
+                options["min_id"] = int(newest_message.external_id)
         else:
-            logger.info("Starting initial synchronization of conversation %s ..", dialog.id)
-        if dialog.is_user:
-            # TODO Would it be better to explicitly associate contacts to conversations?
-            self.sender_to_contact(dialog.entity)
-        await self.download_messages(dialog, conversation_in_db, **options)
-        conversation_in_db.import_complete = True
+            oldest_message = conversation_in_db.oldest_message
+            if oldest_message:
+                logger.info("Resuming initial synchronization of conversation %s ..", dialog.id)
+                options["max_id"] = int(oldest_message.external_id)
+            else:
+                logger.info("Starting initial synchronization of conversation %s ..", dialog.id)
+            if dialog.is_user:
+                # TODO Would it be better to explicitly associate contacts to conversations?
+                self.sender_to_contact(dialog.entity)
+        return options
+
+    async def synchronize_dialogs(self, dialogs):
+        """
+        Download and import the messages in multiple conversations.
+
+        :param dialogs: A list of tuples with two values each:
+
+                        1. The Telegram dialog to synchronize.
+                        2. The :class:`.Conversation` object of the dialog.
+
+        The messages of up to :attr:`concurrency` dialogs are downloaded at
+        the same time (using :func:`asyncio.gather()` and an
+        :class:`asyncio.Semaphore`) by coroutines that don't touch the
+        database. The downloaded pages are passed through a queue to the
+        current coroutine which imports them one at a time (using
+        :func:`import_messages()`) and commits the changes to disk, so
+        database writes are never interleaved.
+        """
+        if not dialogs:
+            return
+        # Prepare the downloads before any of them start.
+        options = [self.get_download_options(d, c) for d, c in dialogs]
         self.archive.commit_changes()
+        # The queue is bounded to limit the number of pages held in memory.
+        pages = asyncio.Queue(maxsize=self.concurrency * 2)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        cancelled = asyncio.Event()
+
+        async def download_messages(index):
+            async with semaphore:
+                try:
+                    if not cancelled.is_set():
+                        async for page in self.get_message_pages(dialogs[index][0], **options[index]):
+                            await pages.put((index, page, None))
+                            if cancelled.is_set():
+                                break
+                except Exception as e:
+                    await pages.put((index, None, e))
+                else:
+                    await pages.put((index, None, None))
+
+        downloads = asyncio.gather(*(download_messages(i) for i in range(len(dialogs))))
+        try:
+            num_remaining = len(dialogs)
+            while num_remaining > 0:
+                index, page, error = await pages.get()
+                dialog, conversation_in_db = dialogs[index]
+                if page is not None:
+                    self.import_messages(conversation_in_db, page)
+                    self.archive.commit_changes()
+                else:
+                    num_remaining -= 1
+                    if error is not None:
+                        logger.warning("Failed to synchronize conversation %s!", dialog.id)
+                        raise error
+                    conversation_in_db.import_complete = True
+                    conversation_in_db.last_modified = dialog.date
+                    self.archive.commit_changes()
+                    self.stats.show()
+        finally:
+            # Stop the downloads (also when the import fails) and wait
+            # for them to finish so that no task is left pending.
+            cancelled.set()
+            downloads.cancel()
+            await asyncio.gather(downloads, return_exceptions=True)
+
+    async def get_message_pages(self, dialog, min_id=0, max_id=0):
+        """
+        Download the messages in the given conversation, newest messages first.
+
+        :param dialog: The Telegram dialog whose messages should be downloaded.
+        :param min_id: Only download messages newer than this message ID (an integer).
+        :param max_id: Only download messages older than this message ID (an integer).
+        :returns: An asynchronous generator of lists with up to :attr:`batch_size`
+                  :class:`telethon.tl.custom.message.Message` objects.
 
-    async def update_conversation(self, dialog, conversation_in_db):
-        """Download new messages in an existing conversation."""
-        min_id = int(conversation_in_db.newest_message.external_id)
-        await self.download_messages(dialog, conversation_in_db, min_id=min_id)
-
-    async def download_messages(self, dialog, conversation_in_db, min_id=0, max_id=0):
-        """Download messages in the given conversation."""
-        options = dict(max_id=max_id, min_id=min_id)
-        async for message in self.client.iter_messages(dialog, **options):
-            # Ignore service messages like `User X was added to chat Y'.
-            if message.message:
-                self.get_or_create_message(
-                    conversation=conversation_in_db,
+        Every page is requested using :func:`.call_api_async()` so that
+        :attr:`request_rate` is respected and flood wait errors are honoured.
+        """
+        offset_id = 0
+        while True:
+            page = await self.call_api_async(
+                self.client.get_messages,
+                dialog,
+                limit=self.batch_size,
+                max_id=max_id,
+                min_id=min_id,
+                offset_id=offset_id,
+            )
+            if page:
+                yield page
+                offset_id = page[-1].id
+            if len(page) < self.batch_size:
+                break
+
+    def import_messages(self, conversation_in_db, messages):
+        """
+        Import messages downloaded by :func:`get_message_pages()`.
+
+        :param conversation_in_db: The :class:`.Conversation` object of the dialog.
+        :param messages: A list of :class:`telethon.tl.custom.message.Message` objects.
+        """
+        self.get_or_create_messages(
+            conversation_in_db,
+            [
+                dict(
                     external_id=message.id,
                     html=unparse(message.message, message.entities),
                     recipient=self.recipient_to_contact(message.to_id),
@@ -206,9 +344,19 @@ class TelegramBackend(ChatArchiveBackend):
                     text=message.message,
                     timestamp=message.date,
                 )
-                # Commit changes to disk every now and then.
-                if self.stats.messages_added % 100 == 0:
-                    self.archive.commit_changes()
+                for message in messages
+                # Ignore service messages like `User X was added to chat Y'.
+                if message.message
+            ],
+        )
+
+    def get_retry_after(self, exception):
+        """Get the delay requested by a Telegram flood wait error (refer to :func:`.get_retry_after()`)."""
+        return exception.seconds if isinstance(exception, FloodWaitError) else None
+
+    def is_retryable(self, exception):
+        """Retry flood wait errors, internal server errors and connection errors."""
+        return isinstance(exception, (ConnectionError, FloodWaitError, ServerError))
 
     def sender_to_contact(self, user):
         """Create a contact in our local database for the given Telegram user."""
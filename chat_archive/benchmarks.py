@@ -0,0 +1,512 @@
+# Easy to use offline chat archive.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-chat-archive
+
+"""
+Benchmarks for performance sensitive code in the `chat-archive` program.
+
+Each benchmark verifies that an optimized implementation produces the same
+output as a (simpler) reference implementation and then compares the speed of
+the two implementations. You can run the benchmarks using ``make benchmark``
+or ``python -m chat_archive.benchmarks``.
+"""
+
+# Standard library modules.
+import html
+import os
+import re
+import timeit
+
+# External dependencies.
+import coloredlogs
+import emoji
+import humanfriendly.terminal
+from humanfriendly import format_timespan, pluralize
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from chat_archive import ChatArchive
+from chat_archive.backends.slack import HTMLConverter
+from chat_archive.cli import FORMATTING_TEMPLATES
+from chat_archive.emoji import (
+    TEXT_TO_EMOJI_PATTERN,
+    WHITE_TO_EMOJI_PATTERN,
+    normalize_emoji,
+    text_to_emoji_callback,
+    white_to_emoji_callback,
+)
+from chat_archive.html import HTMLStripper, html_to_text, text_to_html
+from chat_archive.html.keywords import KeywordHighlighter
+from chat_archive.html.redirects import RedirectStripper
+from chat_archive.html.terminal import TerminalRenderer
+from chat_archive.models import Account, Conversation, Message
+
+BENCHMARK_KEYWORDS = ["build", "slack", "the"]
+"""The search keywords highlighted by :func:`benchmark_terminal_renderer()` (a list of strings)."""
+
+SLACK_CORPUS = [
+    "Good morning everyone!",
+    "Did anyone else notice that the build is broken? :sweat_smile:",
+    "<@U024BE7LH> can you take a look at <https://github.com/xolox/python-chat-archive/pull/12|this PR>?",
+    "The deploy to *production* failed with `ImportError: No module named &#39;slacker&#39;` :thinking_face:",
+    "```\n$ chat-archive sync slack\nTraceback (most recent call last):\n  File \"&lt;stdin&gt;\", line 1\n```",
+    "I _think_ the problem is in `get_history_pages()`, see <https://api.slack.com/methods/conversations.history>",
+    "~Meeting at 3pm~ Meeting moved to 4pm, sorry for the confusion",
+    "Please join <#C024BE7LR|general> for the announcement :tada:",
+    "snake_case_names and 2*3*4 shouldn't be formatted, but *this* should",
+    "Price: 5 &lt; 10 &amp;&amp; 10 &gt; 5, obviously",
+    "*Release notes*\n• Fixed _unicode_ bugs\n• Improved ~speed~ *performance*\n• See <https://example.com/news>",
+    "Here's the config:\n```[slack]\napi-token-name = slack/work\nconcurrency = 4```",
+    "lol",
+    "ok :+1:",
+    "<!channel> the office will be closed tomorrow",
+    "Thanks <@U0G9QF9C6|alice>! That fixed it :pray:",
+    "Nested *bold with _italic_ inside* and `code with *stars*`",
+    "Unbalanced *bold and _italic markers should be left alone",
+    "https://example.com/a_b_c?x=1&amp;y=2 without brackets",
+    "I'll be AFK for ~30 minutes",
+]
+"""
+A list of Slack messages in mrkdwn format that's used by :func:`get_slack_corpus()`.
+
+These messages exercise the different types of formatting supported by
+:class:`.HTMLConverter` in roughly the proportions in which they occur in
+real chat archives: Mostly plain text, some references and occasional
+emphasis and pre-formatted text.
+"""
+
+TEXT_CORPUS = [
+    "hey, are you around? :-)",
+    "See https://www.google.com/url?q=https://github.com/xolox/python-chat-archive&sa=D for the code",
+    "The build is green again, thanks!",
+    "Meeting notes: http://example.com/notes?id=42&view=full <- please read them before 3pm",
+    "ok ;)",
+    "I've uploaded the slides to https://example.com/slides (the last version, I promise) :D",
+    "Multi-line messages\n  keep their\n    indentation <3",
+    "5 < 10 && 10 > 5",
+]
+"""
+A list of plain text chat messages that's used by :func:`get_message_corpus()`.
+
+These messages resemble those imported by the Google Hangouts and Telegram
+backends, including textual smilies and Google redirect URLs.
+"""
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+def main():
+    """Command line interface for the benchmarks."""
+    coloredlogs.install()
+    slack_corpus = get_slack_corpus()
+    benchmark_slack_converter(slack_corpus)
+    html_corpus = get_html_corpus(slack_corpus)
+    benchmark_html_to_text(html_corpus)
+    message_corpus = get_message_corpus(html_corpus)
+    benchmark_normalize_emoji([text for html_text, text in message_corpus])
+    benchmark_terminal_renderer(message_corpus)
+
+
+def benchmark_html_to_text(corpus, repeat=5):
+    """
+    Compare :func:`.html_to_text()` to :func:`parse_html_to_text()`.
+
+    :param corpus: A list of HTML fragments (strings).
+    :param repeat: Refer to :func:`compare_implementations()`.
+    :returns: Refer to :func:`compare_implementations()`.
+    :raises: Refer to :func:`compare_implementations()`.
+    """
+    return compare_implementations(
+        "Converted %s from HTML to text" % pluralize(len(corpus), "message"),
+        parse_html_to_text,
+        html_to_text,
+        corpus,
+        repeat,
+    )
+
+
+def benchmark_normalize_emoji(corpus, repeat=5):
+    """
+    Compare :func:`.normalize_emoji()` to :func:`reference_normalize_emoji()`.
+
+    :param corpus: A list of texts (strings).
+    :param repeat: Refer to :func:`compare_implementations()`.
+    :returns: Refer to :func:`compare_implementations()`.
+    :raises: Refer to :func:`compare_implementations()`.
+    """
+    return compare_implementations(
+        "Normalized emoji in %s" % pluralize(len(corpus), "message"),
+        reference_normalize_emoji,
+        normalize_emoji,
+        corpus,
+        repeat,
+    )
+
+
+def benchmark_slack_converter(corpus, repeat=5):
+    """
+    Compare :class:`.HTMLConverter` to :class:`ReferenceHTMLConverter`.
+
+    :param corpus: A list of Slack messages in mrkdwn format (strings).
+    :param repeat: Refer to :func:`compare_implementations()`.
+    :returns: Refer to :func:`compare_implementations()`.
+    :raises: Refer to :func:`compare_implementations()`.
+    """
+    return compare_implementations(
+        "Converted %s from mrkdwn to HTML" % pluralize(len(corpus), "Slack message"),
+        ReferenceHTMLConverter(),
+        HTMLConverter(),
+        corpus,
+        repeat,
+    )
+
+
+def benchmark_terminal_renderer(corpus, repeat=5):
+    """
+    Compare :class:`.TerminalRenderer` to :class:`ReferenceTerminalRenderer`.
+
+    :param corpus: A list of tuples with two values each: The HTML and text
+                   of a chat message (refer to :func:`get_message_corpus()`).
+    :param repeat: Refer to :func:`compare_implementations()`.
+    :returns: Refer to :func:`compare_implementations()`.
+    :raises: Refer to :func:`compare_implementations()`.
+    """
+    renderer = TerminalRenderer(
+        callback=normalize_emoji,
+        highlight_template=FORMATTING_TEMPLATES["keyword_highlight"],
+        keywords=BENCHMARK_KEYWORDS,
+    )
+    return compare_implementations(
+        "Rendered %s on the terminal" % pluralize(len(corpus), "message"),
+        ReferenceTerminalRenderer(BENCHMARK_KEYWORDS),
+        lambda message: (
+            renderer.render_html(message[0], expand_redirects=True) if message[0] else renderer.render_text(message[1])
+        ),
+        corpus,
+        repeat,
+    )
+
+
+def compare_implementations(description, reference, optimized, corpus, repeat=5):
+    """
+    Verify that two implementations are equivalent and compare their speed.
+
+    :param description: A description of the benchmark (a string).
+    :param reference: The reference implementation (a callable).
+    :param optimized: The optimized implementation (a callable).
+    :param corpus: A list of inputs for the two implementations.
+    :param repeat: The number of times to time the processing of the corpus (an integer).
+    :returns: A tuple with two numbers: The time it took the reference and
+              optimized implementations to process the corpus (in seconds).
+    :raises: :exc:`~exceptions.AssertionError` when the output of the two
+             implementations differs.
+    """
+    for input in corpus:
+        expected = reference(input)
+        actual = optimized(input)
+        if actual != expected:
+            raise AssertionError("Output differs for %r! (expected %r, got %r)" % (input, expected, actual))
+    reference_time = measure(reference, corpus, repeat)
+    optimized_time = measure(optimized, corpus, repeat)
+    logger.info(
+        "%s in %s (reference implementation took %s, %.1fx speedup).",
+        description,
+        format_timespan(optimized_time),
+        format_timespan(reference_time),
+        reference_time / optimized_time,
+    )
+    return reference_time, optimized_time
+
+
+def get_slack_corpus():
+    """
+    Get a corpus of Slack messages for benchmarking.
+
+    :returns: A list of Slack messages in mrkdwn format (strings).
+
+    When the local chat archive contains Slack messages their raw text is
+    used, otherwise :data:`SLACK_CORPUS` is repeated a thousand times.
+    """
+    archive = ChatArchive(auto_create_schema=False, auto_upgrade_schema=False)
+    if os.path.isfile(archive.database_file):
+        query = (
+            archive.session.query(Message.raw)
+            .join(Message.conversation)
+            .join(Conversation.account)
+            .filter(Account.backend == "slack")
+            .filter(Message.raw != None)
+        )
+        corpus = [raw for raw, in query]
+        if corpus:
+            logger.verbose("Using %s from %s.", pluralize(len(corpus), "Slack message"), archive.database_file)
+            return corpus
+    return SLACK_CORPUS * 1000
+
+
+def get_html_corpus(slack_corpus):
+    """
+    Get a corpus of HTML formatted chat messages for benchmarking.
+
+    :param slack_corpus: A list of Slack messages in mrkdwn format (strings).
+    :returns: A list of HTML fragments (strings).
+
+    The HTML is generated from the Slack messages using :class:`.HTMLConverter`.
+    """
+    converter = HTMLConverter()
+    return [converter(text) for text in slack_corpus]
+
+
+def get_message_corpus(html_corpus, size=100000):
+    """
+    Get a corpus of chat messages for benchmarking.
+
+    :param html_corpus: A list of HTML fragments (strings).
+    :param size: The number of messages in the corpus (an integer).
+    :returns: A list of tuples with two values each: The HTML of a chat
+              message (a string or :data:`None`) and its text (a string).
+
+    The corpus alternates between the HTML fragments and the plain text
+    messages in :data:`TEXT_CORPUS`, both are repeated as needed to fill
+    the corpus.
+    """
+    corpus = []
+    for i in range(size):
+        if i % 2 == 0:
+            html_text = html_corpus[(i // 2) % len(html_corpus)]
+            corpus.append((html_text, html_to_text(html_text)))
+        else:
+            corpus.append((None, TEXT_CORPUS[(i // 2) % len(TEXT_CORPUS)]))
+    return corpus
+
+
+def measure(function, corpus, repeat):
+    """
+    Measure how long it takes to apply a function to a corpus of inputs.
+
+    :param function: The function to call for every input.
+    :param corpus: A list of inputs.
+    :param repeat: The number of times to repeat the measurement (an integer).
+    :returns: The fastest of the measurements (in seconds).
+    """
+    return min(timeit.repeat(lambda: [function(input) for input in corpus], number=1, repeat=repeat))
+
+
+def parse_html_to_text(html_text):
+    """
+    Convert HTML to plain text using :class:`.HTMLStripper` (the reference implementation of :func:`.html_to_text()`).
+
+    :param html_text: A fragment of HTML (a string).
+    :returns: The plain text (a string).
+    """
+    parser = HTMLStripper()
+    parser.feed(html_text)
+    parser.close()
+    return parser.output.getvalue()
+
+
+def reference_normalize_emoji(text):
+    """
+    Translate smilies and emoji macros (the reference implementation of :func:`.normalize_emoji()`).
+
+    :param text: The text to translate (a string).
+    :returns: The translated text (a string).
+    """
+    text = re.sub(TEXT_TO_EMOJI_PATTERN, text_to_emoji_callback, text)
+    text = re.sub(WHITE_TO_EMOJI_PATTERN, white_to_emoji_callback, text)
+    return emoji.emojize(text, use_aliases=True)
+
+
+class ReferenceTerminalRenderer(object):
+
+    """
+    Multi-pass implementation of :class:`.TerminalRenderer`.
+
+    This is how the ``chat-archive`` program rendered messages on the terminal
+    before :class:`.TerminalRenderer` was introduced: HTML is generated and
+    parsed again by every step in the pipeline.
+    """
+
+    def __init__(self, keywords):
+        """Initialize a :class:`ReferenceTerminalRenderer` object."""
+        self.html_to_ansi = humanfriendly.terminal.HTMLConverter(callback=normalize_emoji)
+        self.keyword_highlighter = KeywordHighlighter(
+            highlight_template=FORMATTING_TEMPLATES["keyword_highlight"], keywords=keywords
+        )
+        self.redirect_stripper = RedirectStripper()
+
+    def __call__(self, message):
+        """
+        Render a chat message on the terminal.
+
+        :param message: A tuple with the HTML and text of a chat message.
+        :returns: The rendered text (a string).
+        """
+        html_text, text = message
+        html_text = self.redirect_stripper(html_text or text_to_html(text, callback=normalize_emoji))
+        return self.html_to_ansi(self.keyword_highlighter(html_text))
+
+
+class ReferenceHTMLConverter(object):
+
+    """
+    Character at a time implementation of :class:`.HTMLConverter`.
+
+    This is the original implementation of the Slack mrkdwn to HTML
+    conversion. It's kept here as a reference to verify that the
+    optimized implementation produces the same output.
+    """
+
+    def __init__(self, expand_reference_callback=None):
+        """Initialize a :class:`ReferenceHTMLConverter` object."""
+        self.expand_reference_callback = expand_reference_callback
+        self.parse_methods = {
+            "&": self.parse_entity,
+            "*": self.parse_bold,
+            "<": self.parse_reference,
+            "_": self.parse_italic,
+            "`": self.parse_preformatted,
+            "~": self.parse_strike_through,
+        }
+
+    def __call__(self, text):
+        """
+        Convert a Slack chat message to HTML.
+
+        :param text: The text of a Slack message (a string).
+        :returns: The generated HTML (a string).
+        """
+        output = []
+        self.parse_text(text, 0, len(text), output)
+        return "".join(output)
+
+    def followed_by_alphanumeric(self, input, index, limit):
+        """Check if the given position is followed by an alphanumeric character."""
+        return index + 1 < limit and input[index + 1].isalnum()
+
+    def parse_bold(self, input, index, length, output):
+        """Parse *bold* text."""
+        if not self.preceded_by_alphanumeric(input, index):
+            match = input.find("*", index + 1)
+            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
+                output.append("<b>")
+                nested = input[index + 1 : match]
+                self.parse_text(nested, 0, len(nested), output)
+                output.append("</b>")
+                return match + 1
+
+    def parse_entity(self, input, index, length, output):
+        """Parse an HTML entity."""
+        match = input.find(";", index + 1)
+        if match > 0:
+            output.append(input[index : match + 1])
+            return match + 1
+
+    def parse_italic(self, input, index, length, output):
+        """Parse _italic_ text."""
+        if not self.preceded_by_alphanumeric(input, index):
+            match = input.find("_", index + 1)
+            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
+                output.append("<i>")
+                nested = input[index + 1 : match]
+                self.parse_text(nested, 0, len(nested), output)
+                output.append("</i>")
+                return match + 1
+
+    def parse_preformatted(self, input, index, length, output):
+        """Parse `pre-formatted` text."""
+        if not self.preceded_by_alphanumeric(input, index):
+            if index + 2 < length and input[index + 1] == "`" and input[index + 2] == "`":
+                match = input.find("```", index + 3)
+                if match > 0 and not self.followed_by_alphanumeric(input, match + 2, length):
+                    output.append("<pre>")
+                    nested = input[index + 3 : match].strip("\r\n")
+                    self.parse_preformatted_body(nested, 0, len(nested), output)
+                    output.append("</pre>")
+                    return match + 3
+            else:
+                match = input.find("`", index + 1)
+                if match > 0 and not self.followed_by_alphanumeric(input, match, length):
+                    output.append("<code>")
+                    nested = input[index + 1 : match]
+                    self.parse_preformatted_body(nested, 0, len(nested), output)
+                    output.append("</code>")
+                    return match + 1
+
+    def parse_preformatted_body(self, input, index, length, output):
+        """Parse the body of a pre-formatted text fragment."""
+        while index < length:
+            character = input[index]
+            if character == "<":
+                # Replace references with their visible text. Why does
+                # Slack embed these in pre-formatted text?! Argh! 😋
+                match = input.find(">", index + 1)
+                url, _, label = input[index + 1 : match].partition("|")
+                output.append(html.escape(label or url, quote=False))
+                index = match + 1
+            elif character == "&":
+                # HTML entities pass through unchanged.
+                match = input.find(";", index + 1)
+                output.append(input[index : match + 1])
+                index = match + 1
+            else:
+                # Plain text is encoded as HTML.
+                output.append(html.escape(input[index], quote=False))
+                index += 1
+
+    def parse_reference(self, input, index, length, output):
+        """Parse a reference to a URL, user or channel."""
+        if not self.preceded_by_alphanumeric(input, index):
+            match = input.find(">", index + 1)
+            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
+                nested = input[index + 1 : match]
+                url, _, label = nested.partition("|")
+                if url.startswith("@"):
+                    # Convert internal references to bold text.
+                    url = url.lstrip("@")
+                    if self.expand_reference_callback is not None:
+                        label = self.expand_reference_callback(url)
+                    else:
+                        label = label or url
+                    output.append("<b>@%s</b>" % html.escape(label, quote=False))
+                else:
+                    # Convert external references to hyperlinks.
+                    output.append('<a href="%s">' % html.escape(url, quote=True))
+                    output.append(html.escape(label or url, quote=False))
+                    output.append("</a>")
+                return match + 1
+
+    def parse_strike_through(self, input, index, length, output):
+        """Parse ~strike-through~ text."""
+        if not self.preceded_by_alphanumeric(input, index):
+            match = input.find("~", index + 1)
+            if match > 0 and not self.followed_by_alphanumeric(input, match, length):
+                output.append("<s>")
+                nested = input[index + 1 : match]
+                self.parse_text(nested, 0, len(nested), output)
+                output.append("</s>")
+                return match + 1
+
+    def parse_text(self, input, index, length, output):
+        """Parse inline text."""
+        while index < length:
+            character = input[index]
+            method = self.parse_methods.get(character)
+            if method:
+                result = method(input, index, length, output)
+                if result:
+                    index = result
+                    continue
+            # Consume one character when no token could be matched.
+            output.append(html.escape(character, quote=False))
+            index += 1
+
+    def preceded_by_alphanumeric(self, input, index):
+        """Check if the given position is preceded by an alphanumeric character."""
+        return index > 0 and input[index - 1].isalnum()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: August 1, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """
@@ -20,7 +20,13 @@ Supported commands:
 
 - The 'list' command lists all messages in the local archive.
 
-- The 'stats' command shows statistics about the local archive.
+- The 'stats' command shows statistics about the local archive. These
+  statistics are maintained incrementally, use the --recompute option
+  to compute them from scratch.
+
+- The 'rerender' command regenerates the HTML and plain text of Slack
+  messages from their original (mrkdwn) text, to apply fixes to the
+  conversion. When given a message id it resumes after that message.
 
 - The 'unknown' command searches for conversations that contain messages from
   an unknown sender and allows you to enter the name of a new contact to
@@ -42,6 +48,18 @@ Supported options:
     specific conversations and I didn't want to keep seeing each of those
     errors during every synchronization run :-).
 
+  -j, --jobs=COUNT
+
+    Synchronize up to COUNT accounts at the same time during 'chat-archive
+    sync'. Each account is synchronized in its own worker thread while
+    database changes are still written one transaction at a time. The
+    default value of COUNT is 1 (accounts are synchronized one by one).
+
+  --recompute
+
+    Recompute the statistics shown by 'chat-archive stats' from scratch
+    (this requires a full scan of all messages in the local archive).
+
   -c, --color=CHOICE, --colour=CHOICE
 
     Specify whether ANSI escape sequences for text and background colors and
@@ -89,18 +107,19 @@ import sys
 import coloredlogs
 from humanfriendly import coerce_boolean, compact, concatenate, format_path, format_size, parse_path, pluralize
 from humanfriendly.prompts import prompt_for_input
-from humanfriendly.terminal import HTMLConverter, connected_to_terminal, find_terminal_size, output, usage, warning
+from humanfriendly.terminal import connected_to_terminal, find_terminal_size, output, usage, warning
 from property_manager import lazy_property, mutable_property
-from sqlalchemy import func
+from sqlalchemy import and_, func, or_, select, union
+from sqlalchemy.orm import joinedload, selectinload
 from verboselogs import VerboseLogger
 
 # Modules included in our package.
 from chat_archive import ChatArchive
 from chat_archive.emoji import normalize_emoji
 from chat_archive.html import HTMLStripper, text_to_html
-from chat_archive.html.keywords import KeywordHighlighter
 from chat_archive.html.redirects import RedirectStripper
-from chat_archive.models import Contact, Conversation, Message
+from chat_archive.html.terminal import TerminalRenderer
+from chat_archive.models import UNKNOWN_CONTACT_LABEL, Account, Contact, Conversation, Message
 from chat_archive.utils import utc_to_local
 
 FORMATTING_TEMPLATES = dict(
@@ -114,9 +133,6 @@ FORMATTING_TEMPLATES = dict(
 )
 """The formatting of output, specified as HTML with placeholders."""
 
-UNKNOWN_CONTACT_LABEL = "Unknown"
-"""The label for contacts without a name or email address (a string)."""
-
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
@@ -131,14 +147,16 @@ def main():
     try:
         options, arguments = getopt.gnu_getopt(
             sys.argv[1:],
-            "C:fl:c:p:vqh",
+            "C:fj:l:c:p:vqh",
             [
                 "context=",
                 "force",
+                "jobs=",
                 "log-file=",
                 "color=",
                 "colour=",
                 "profile=",
+                "recompute",
                 "verbose",
                 "quiet",
                 "help",
@@ -149,6 +167,8 @@ def main():
                 program_opts["context"] = int(value)
             elif option in ("-f", "--force"):
                 program_opts["force"] = True
+            elif option in ("-j", "--jobs"):
+                program_opts["jobs"] = int(value)
             elif option in ("-l", "--log-file"):
                 handler = logging.FileHandler(parse_path(value))
                 handler.setFormatter(
@@ -164,6 +184,8 @@ def main():
                 program_opts["use_colors"] = mapping[value] if value in mapping else coerce_boolean(value)
             elif option in ("-p", "--profile"):
                 program_opts["profile_file"] = parse_path(value)
+            elif option == "--recompute":
+                program_opts["recompute"] = True
             elif option in ("-v", "--verbose"):
                 coloredlogs.increase_verbosity()
             elif option in ("-q", "--quiet"):
@@ -183,7 +205,7 @@ def main():
     try:
         # We extract any search keywords from the command line arguments before
         # initializing an instance of the UserInterface class, to enable
-        # initialization of the KeywordHighlighter class.
+        # initialization of the TerminalRenderer class.
         if arguments[0] == "search":
             program_opts["keywords"] = arguments[1:]
         # Initialize the chat archive.
@@ -209,6 +231,42 @@ class UserInterface(ChatArchive):
 
     """The Python API for the command line interface for the ``chat-archive`` program."""
 
+    @lazy_property
+    def ambiguous_first_names(self):
+        """
+        The first names that are shared by contacts with different last names (a set of strings).
+
+        This is used by :func:`get_unambiguous_name()` to avoid the query
+        performed by :attr:`.Contact.first_name_is_unambiguous` for every
+        rendered contact.
+        """
+        return Contact.find_ambiguous_first_names(self.session)
+
+    @lazy_property
+    def cached_contacts(self):
+        """
+        A dictionary with the :class:`.Contact` objects loaded by
+        :func:`prefetch_related()` (keys are contact ids).
+        """
+        return {}
+
+    @lazy_property
+    def cached_conversations(self):
+        """
+        A dictionary with the :class:`.Conversation` objects loaded by
+        :func:`prefetch_related()` (keys are conversation ids).
+        """
+        return {}
+
+    @lazy_property
+    def cached_participants(self):
+        """
+        A dictionary with the contact ids of the participants in conversations
+        loaded by :func:`prefetch_related()` (keys are conversation ids and
+        values are sets of contact ids).
+        """
+        return {}
+
     @mutable_property
     def context(self):
         """The number of messages of output context to print during searches (defaults to 3)."""
@@ -219,14 +277,6 @@ class UserInterface(ChatArchive):
         """Whether to output ANSI escape sequences for text colors and styles (a boolean)."""
         return connected_to_terminal()
 
-    @lazy_property
-    def html_to_ansi(self):
-        """
-        An :class:`~humanfriendly.terminal.HTMLConverter` object that uses
-        :func:`.normalize_emoji()` as a text pre-processing callback.
-        """
-        return HTMLConverter(callback=normalize_emoji)
-
     @lazy_property
     def redirect_stripper(self):
         """An :class:`.RedirectStripper` object."""
@@ -237,16 +287,52 @@ class UserInterface(ChatArchive):
         """An :class:`.HTMLStripper` object."""
         return HTMLStripper()
 
-    @lazy_property
-    def keyword_highlighter(self):
-        """A :class:`.KeywordHighlighter` object based on :attr:`keywords`."""
-        return KeywordHighlighter(highlight_template=FORMATTING_TEMPLATES["keyword_highlight"], keywords=self.keywords)
-
     @mutable_property
     def keywords(self):
         """A list of strings with search keywords."""
         return []
 
+    @mutable_property
+    def page_size(self):
+        """The number of messages fetched per query by :func:`stream_messages()` (an integer, defaults to 1000)."""
+        return 1000
+
+    @mutable_property
+    def prefetch_size(self):
+        """The number of messages for which related objects are loaded at once (an integer, defaults to 500)."""
+        return 500
+
+    @mutable_property
+    def recompute(self):
+        """:data:`True` if 'chat-archive stats' should recompute the statistics from scratch (a boolean)."""
+        return False
+
+    @lazy_property
+    def significant_backends(self):
+        """
+        The names of the backends that have multiple accounts (a set of strings).
+
+        This is used by :func:`render_conversation_summary()` to avoid the
+        query performed by :attr:`.Account.name_is_significant` for every
+        rendered conversation.
+        """
+        query = self.session.query(Account.backend).group_by(Account.backend).having(func.count(Account.id) > 1)
+        return set(backend for backend, in query)
+
+    @lazy_property
+    def terminal_renderer(self):
+        """
+        A :class:`.TerminalRenderer` object based on :attr:`keywords`.
+
+        This expands redirect URLs, highlights search keywords and converts
+        HTML to ANSI escape sequences in a single pass over the text.
+        """
+        return TerminalRenderer(
+            callback=normalize_emoji,
+            highlight_template=FORMATTING_TEMPLATES["keyword_highlight"],
+            keywords=self.keywords,
+        )
+
     @mutable_property
     def timestamp_format(self):
         """The format of timestamps (defaults to ``%Y-%m-%d %H:%M:%S``)."""
@@ -254,7 +340,11 @@ class UserInterface(ChatArchive):
 
     def list_cmd(self, arguments):
         """List all messages in the local archive."""
-        self.render_messages(self.session.query(Message).order_by(Message.timestamp))
+        self.render_messages(self.stream_messages(), expunge=True)
+
+    def rerender_cmd(self, arguments):
+        """Regenerate the HTML and plain text of messages based on their raw text."""
+        self.rerender_messages(start_id=int(arguments[0]) if arguments else 0)
 
     def search_cmd(self, arguments):
         """Search the chat messages in the local archive for the given keyword(s)."""
@@ -265,20 +355,23 @@ class UserInterface(ChatArchive):
 
     def stats_cmd(self, arguments):
         """Show some statistics about the local chat archive."""
+        if self.recompute:
+            self.recompute_archive_stats()
+        stats = self.get_archive_stats()
         logger.info("Statistics about %s:", format_path(self.database_file))
         logger.info(" - Number of contacts: %i", self.num_contacts)
         logger.info(" - Number of conversations: %i", self.num_conversations)
-        logger.info(" - Number of messages: %i", self.num_messages)
+        logger.info(" - Number of messages: %i", stats["num_messages"])
         logger.info(" - Database file size: %s", format_size(os.path.getsize(self.database_file)))
         logger.info(
             " - Size of %s: %s",
-            pluralize(self.num_messages, "plain text chat message"),
-            format_size(self.session.query(func.coalesce(func.sum(func.length(Message.text)), 0)).scalar()),
+            pluralize(stats["num_messages"], "plain text chat message"),
+            format_size(stats["text_size"]),
         )
         logger.info(
             " - Size of %s: %s",
-            pluralize(self.num_html_messages, "HTML formatted chat message"),
-            format_size(self.session.query(func.coalesce(func.sum(func.length(Message.html)), 0)).scalar()),
+            pluralize(stats["num_html_messages"], "HTML formatted chat message"),
+            format_size(stats["html_size"]),
         )
 
     def sync_cmd(self, arguments):
@@ -292,22 +385,37 @@ class UserInterface(ChatArchive):
         to associate the messages with.
         """
         logger.info("Searching for private conversations with unknown sender ..")
-        for conversation in self.session.query(Conversation).filter(Conversation.is_group_conversation == False):
-            if conversation.have_unknown_senders:
-                logger.info("Private conversation %i includes messages from unknown senders:", conversation.id)
-                self.render_messages(conversation.messages[:10])
-                full_name = prompt_for_input("Name for new contact (leave empty to skip): ")
-                if full_name:
-                    words = full_name.split()
-                    kw = dict(account=conversation.account, first_name=words.pop(0))
-                    if words:
-                        kw["last_name"] = " ".join(words)
-                    contact = Contact(**kw)
-                    self.session.add(contact)
-                    for message in conversation.messages:
-                        if not message.sender:
-                            message.sender = contact
-                    self.commit_changes()
+        # Find the candidate conversations using a single aggregate query.
+        query = (
+            self.session.query(Conversation)
+            .join(Message, Message.conversation_id == Conversation.id)
+            .filter(Conversation.is_group_conversation == False)
+            .group_by(Conversation.id)
+            .having(func.count(Message.id) > func.count(Message.sender_id))
+            .order_by(Conversation.id)
+        )
+        for conversation in query.all():
+            logger.info("Private conversation %i includes messages from unknown senders:", conversation.id)
+            self.render_messages(
+                self.session.query(Message)
+                .filter(Message.conversation_id == conversation.id)
+                .order_by(Message.timestamp)
+                .limit(10)
+            )
+            full_name = prompt_for_input("Name for new contact (leave empty to skip): ")
+            if full_name:
+                words = full_name.split()
+                kw = dict(account=conversation.account, first_name=words.pop(0))
+                if words:
+                    kw["last_name"] = " ".join(words)
+                contact = Contact(**kw)
+                self.session.add(contact)
+                self.session.flush()
+                # Assign the messages to the new contact using a single bulk update.
+                self.session.query(Message).filter(
+                    Message.conversation_id == conversation.id, Message.sender_id == None
+                ).update({Message.sender_id: contact.id}, synchronize_session=False)
+                self.commit_changes()
 
     def generate_html(self, name, text):
         """
@@ -325,45 +433,209 @@ class UserInterface(ChatArchive):
         return template.format(text=text)
 
     def gather_context(self, messages):
-        """Enhance search results with context (surrounding messages)."""
-        related = []
-        for msg in messages:
-            # Gather older messages.
-            older_query = msg.older_messages.order_by(Message.timestamp.desc()).limit(self.context)
-            logger.debug("Querying older messages: %s", older_query)
-            for other_msg in reversed(older_query.all()):
-                if other_msg not in related:
-                    related.append(other_msg)
+        """
+        Enhance search results with context (surrounding messages).
+
+        :param messages: An SQLAlchemy query that produces the :class:`.Message`
+                         objects matched by a search.
+        :returns: A generator of :class:`.Message` objects.
+
+        All search results and their surrounding messages are fetched using a
+        single query: A ``ROW_NUMBER()`` window function numbers the messages
+        in each of the matching conversations after which the search results
+        are joined to the messages whose row numbers are within :attr:`context`
+        of each search result. The overlapping windows are then merged (in the
+        order of the search results) using a set of the messages that were
+        already emitted.
+        """
+        matches = messages.with_entities(Message.id).subquery()
+        conversations = messages.with_entities(Message.conversation_id).subquery()
+        numbered = (
+            select(
+                [
+                    Message.id,
+                    Message.conversation_id,
+                    func.row_number()
+                    .over(partition_by=Message.conversation_id, order_by=(Message.timestamp, Message.id))
+                    .label("position"),
+                ]
+            )
+            .where(Message.conversation_id.in_(select([conversations.c.conversation_id])))
+            .alias("numbered")
+        )
+        hits = select([numbered.c.conversation_id, numbered.c.position]).where(
+            numbered.c.id.in_(select([matches.c.id]))
+        ).alias("hits")
+        query = (
+            self.session.query(Message, numbered.c.position, numbered.c.id.in_(select([matches.c.id])))
+            .join(numbered, numbered.c.id == Message.id)
+            .join(
+                hits,
+                and_(
+                    hits.c.conversation_id == numbered.c.conversation_id,
+                    numbered.c.position.between(hits.c.position - self.context, hits.c.position + self.context),
+                ),
+            )
+            .distinct()
+        )
+        logger.debug("Querying search results with context: %s", query)
+        results = []
+        window = {}
+        for msg, position, is_match in query:
+            window[(msg.conversation_id, position)] = msg
+            if is_match:
+                results.append((msg, position))
+        # Emit the search results in chronological order, each surrounded by
+        # its context, skipping messages that were already emitted as part of
+        # an overlapping window.
+        emitted = set()
+        for msg, position in sorted(results, key=lambda r: (r[0].timestamp, r[0].id)):
+            for other_position in range(position - self.context, position + self.context + 1):
+                other_msg = window.get((msg.conversation_id, other_position))
+                if other_msg is not None and other_msg.id not in emitted:
+                    emitted.add(other_msg.id)
                     yield other_msg
-            # Yield one of the given messages.
-            if msg not in related:
-                related.append(msg)
+
+    def prefetch_messages(self, messages, expunge=False):
+        """
+        Prefetch the objects related to messages in batches.
+
+        :param messages: An iterable of :class:`.Message` objects.
+        :param expunge: :data:`True` to expunge the messages in each batch from
+                        the session once the caller has processed them,
+                        :data:`False` otherwise.
+        :returns: A generator of :class:`.Message` objects.
+
+        The given messages are processed in batches of :attr:`prefetch_size`
+        messages which are passed to :func:`prefetch_related()` before they
+        are yielded to the caller.
+        """
+        batch = []
+        for msg in messages:
+            batch.append(msg)
+            if len(batch) >= self.prefetch_size:
+                self.prefetch_related(batch)
+                yield from batch
+                if expunge:
+                    for msg in batch:
+                        self.session.expunge(msg)
+                batch = []
+        if batch:
+            self.prefetch_related(batch)
+            yield from batch
+            if expunge:
+                for msg in batch:
+                    self.session.expunge(msg)
+
+    def prefetch_related(self, messages):
+        """
+        Load the objects required to render the given messages.
+
+        :param messages: A list of :class:`.Message` objects.
+
+        This loads the conversations (and their accounts) and contacts (and
+        their email addresses) that :func:`render_messages()` needs using a
+        constant number of queries, regardless of the number of messages. The
+        loaded objects are kept in :attr:`cached_conversations`,
+        :attr:`cached_contacts` and :attr:`cached_participants` so that they
+        stay in the identity map of the session, which enables SQLAlchemy to
+        resolve the relationships of the messages without issuing queries.
+        """
+        self.prefetch_conversations(set(msg.conversation_id for msg in messages))
+        self.prefetch_contacts(set(msg.sender_id for msg in messages) | set(msg.recipient_id for msg in messages))
+
+    def prefetch_contacts(self, contact_ids):
+        """
+        Load contacts (and their email addresses) into :attr:`cached_contacts`.
+
+        :param contact_ids: A set of contact ids (:data:`None` is ignored).
+        """
+        contact_ids = set(contact_ids) - set(self.cached_contacts) - {None}
+        if contact_ids:
+            query = self.session.query(Contact).options(selectinload(Contact.email_addresses))
+            for contact in query.filter(Contact.id.in_(contact_ids)):
+                self.cached_contacts[contact.id] = contact
+
+    def prefetch_conversations(self, conversation_ids):
+        """
+        Load conversations (their accounts and participants) into :attr:`cached_conversations`.
+
+        :param conversation_ids: A set of conversation ids.
+        """
+        conversation_ids = set(conversation_ids) - set(self.cached_conversations)
+        if conversation_ids:
+            query = self.session.query(Conversation).options(joinedload(Conversation.account))
+            for conversation in query.filter(Conversation.id.in_(conversation_ids)):
+                self.cached_conversations[conversation.id] = conversation
+                self.cached_participants[conversation.id] = set()
+            senders = select([Message.conversation_id, Message.sender_id])
+            recipients = select([Message.conversation_id, Message.recipient_id])
+            participants = union(
+                senders.where(Message.conversation_id.in_(conversation_ids)),
+                recipients.where(Message.conversation_id.in_(conversation_ids)),
+            )
+            for conversation_id, contact_id in self.session.execute(participants):
+                if contact_id is not None:
+                    self.cached_participants[conversation_id].add(contact_id)
+            self.prefetch_contacts(set().union(*(self.cached_participants.get(i, ()) for i in conversation_ids)))
+
+    def stream_messages(self):
+        """
+        Stream all messages in the local archive in chronological order.
+
+        :returns: A generator of :class:`.Message` objects.
+
+        Messages are fetched in pages of :attr:`page_size` messages using
+        keyset pagination on ``(timestamp, id)``, so the first page is
+        available immediately and each page is fetched using an indexed range
+        scan. To keep memory usage constant regardless of the size of the
+        archive the caller should expunge the messages from the session once
+        it's done with them (:func:`list_cmd()` does so by passing
+        `expunge=True` to :func:`render_messages()`).
+        """
+        query = self.session.query(Message).order_by(Message.timestamp, Message.id)
+        page = query.limit(self.page_size).yield_per(self.page_size)
+        while True:
+            num_messages = 0
+            for msg in page:
+                last_timestamp, last_id = msg.timestamp, msg.id
+                num_messages += 1
                 yield msg
-            # Gather newer messages.
-            newer_query = msg.newer_messages.order_by(Message.timestamp).limit(self.context)
-            logger.debug("Querying newer messages: %s", newer_query)
-            for other_msg in newer_query.all():
-                if other_msg not in related:
-                    related.append(other_msg)
-                    yield other_msg
+            if num_messages < self.page_size:
+                break
+            page = query.filter(
+                Message.timestamp >= last_timestamp,
+                or_(Message.timestamp > last_timestamp, Message.id > last_id),
+            )
+            page = page.limit(self.page_size).yield_per(self.page_size)
+
+    def render_messages(self, messages, expunge=False):
+        """
+        Render the given message(s) on the terminal.
+
+        :param messages: An iterable of :class:`.Message` objects.
+        :param expunge: :data:`True` to expunge the messages from the session
+                        once they have been rendered, :data:`False` otherwise.
 
-    def render_messages(self, messages):
-        """Render the given message(s) on the terminal."""
-        previous_conversation = None
+        The objects related to the messages are loaded in batches using
+        :func:`prefetch_messages()`.
+        """
+        previous_conversation_id = None
         previous_message = None
         # Render a horizontal bar as a delimiter between conversations.
         num_rows, num_columns = find_terminal_size()
         conversation_delimiter = self.generate_html("conversation_delimiter", "─" * num_columns)
-        for i, msg in enumerate(messages):
-            if msg.conversation != previous_conversation:
+        for msg in self.prefetch_messages(messages, expunge=expunge):
+            if msg.conversation_id != previous_conversation_id:
                 # Mark context switches between conversations.
                 logger.verbose("Rendering conversation #%i ..", msg.conversation.id)
                 self.render_output(conversation_delimiter)
                 self.render_output(self.render_conversation_summary(msg.conversation))
                 self.render_output(conversation_delimiter)
             elif previous_message and self.keywords:
-                # Mark gaps in conversations. This (find_distance()) is a rather
-                # heavy check so we only do this when rendering search results.
+                # Mark gaps in conversations. Gaps can only occur when rendering
+                # search results and find_distance() can fall back to a rather
+                # heavy query (for messages without a known position).
                 distance = msg.find_distance(previous_message)
                 if distance > 0:
                     message_delimiter = "── %s omitted " % pluralize(distance, "message")
@@ -382,10 +654,10 @@ class UserInterface(ChatArchive):
                     ]
                 )
             )
-            message_contents = self.normalize_whitespace(self.prepare_output(self.render_text(msg)))
+            message_contents = self.normalize_whitespace(self.render_contents(msg))
             output(message_metadata + " " + message_contents)
             # Keep track of the previous conversation and message.
-            previous_conversation = msg.conversation
+            previous_conversation_id = msg.conversation_id
             previous_message = msg
 
     def normalize_whitespace(self, text):
@@ -426,10 +698,10 @@ class UserInterface(ChatArchive):
         # know who they are 😇).
         participants = sorted(
             set(
-                contact.unambiguous_name
+                self.get_unambiguous_name(contact)
                 if conversation.is_group_conversation
                 else (contact.full_name or UNKNOWN_CONTACT_LABEL)
-                for contact in conversation.participants
+                for contact in self.get_participants(conversation)
                 if conversation.is_group_conversation or not self.is_operator(contact)
             )
         )
@@ -447,7 +719,7 @@ class UserInterface(ChatArchive):
             parts.append("(%s)" % participants_html)
         else:
             parts.append(self.generate_html("conversation_name", participants_html))
-        if conversation.account.name_is_significant:
+        if conversation.account.backend in self.significant_backends:
             parts.append("in %s account" % conversation.account.name)
         return " ".join(parts)
 
@@ -467,10 +739,9 @@ class UserInterface(ChatArchive):
         :param text: The HTML text to render (a string).
         :returns: The rendered text (a string).
 
-        When :attr:`use_colors` is :data:`True` this method first uses
-        :attr:`keyword_highlighter` to highlight search matches in the given
-        text and then it converts the string from HTML to ANSI escape sequences
-        using :attr:`html_to_ansi`.
+        When :attr:`use_colors` is :data:`True` this method uses
+        :attr:`terminal_renderer` to highlight search matches in the given
+        text and convert the string from HTML to ANSI escape sequences.
 
         When :attr:`use_colors` is :data:`False` then :attr:`html_to_text` is
         used to convert the given HTML to plain text. In this case keyword
@@ -480,10 +751,7 @@ class UserInterface(ChatArchive):
         # the HTML to ANSI conversion process (it's rather nontrivial).
         logger.debug("Rendering HTML output: %r", text)
         if self.use_colors:
-            if self.keywords:
-                text = self.keyword_highlighter(text)
-                logger.debug("HTML with keywords highlighted: %r", text)
-            text = self.html_to_ansi(text)
+            text = self.terminal_renderer.render_html(text)
             logger.debug("Text with ANSI escape sequences: %r", text)
         else:
             text = self.html_to_text(text)
@@ -505,7 +773,7 @@ class UserInterface(ChatArchive):
         """
         Get a short string describing a contact (preferably their first name,
         but if that is not available then their email address will have to do).
-        If no useful information is available :data:`UNKNOWN_CONTACT_LABEL` is
+        If no useful information is available :data:`.UNKNOWN_CONTACT_LABEL` is
         returned so as to explicitly mark the absence of more information.
         """
         if contact:
@@ -515,6 +783,48 @@ class UserInterface(ChatArchive):
                 return html.escape(email_address.value)
         return UNKNOWN_CONTACT_LABEL
 
+    def get_participants(self, conversation):
+        """
+        Get the contacts that have participated in a conversation.
+
+        :param conversation: A :class:`.Conversation` object.
+        :returns: A list of :class:`.Contact` objects.
+
+        This is the equivalent of :attr:`.Conversation.participants` based on
+        the objects loaded by :func:`prefetch_related()`.
+        """
+        self.prefetch_conversations({conversation.id})
+        return [self.cached_contacts[contact_id] for contact_id in self.cached_participants[conversation.id]]
+
+    def get_unambiguous_name(self, contact):
+        """
+        Get the shortest unambiguous name of a contact.
+
+        :param contact: A :class:`.Contact` object.
+        :returns: A string.
+
+        This is the equivalent of :attr:`.Contact.unambiguous_name` based on
+        :attr:`ambiguous_first_names`.
+        """
+        return contact.get_unambiguous_name(self.ambiguous_first_names)
+
+    def render_contents(self, message):
+        """
+        Render the contents of a chat message for the terminal.
+
+        :param message: A :class:`.Message` object.
+        :returns: The rendered text (a string).
+
+        When :attr:`use_colors` is :data:`True` the text of the message is
+        rendered by :attr:`terminal_renderer` in a single pass, otherwise
+        :func:`render_text()` and :func:`prepare_output()` are used.
+        """
+        if self.use_colors:
+            if message.html:
+                return self.terminal_renderer.render_html(message.html, expand_redirects=True)
+            return self.terminal_renderer.render_text(message.text)
+        return self.prepare_output(self.render_text(message))
+
     def render_text(self, message):
         """Prepare the text of a chat message for rendering on the terminal."""
         return self.redirect_stripper(message.html or text_to_html(message.text, callback=normalize_emoji))
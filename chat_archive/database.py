@@ -1,23 +1,27 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: December 31, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """SQLAlchemy based database helpers."""
 
 # Standard library modules.
 import os
+import threading
 
 # External dependencies.
-from alembic.command import stamp, upgrade
-from alembic.config import Config
-from alembic.migration import MigrationContext
-from alembic.script import ScriptDirectory
 from coloredlogs import get_level, set_level
 from humanfriendly import Timer
-from property_manager import PropertyManager, cached_property, lazy_property, required_property, writable_property
-from sqlalchemy import create_engine
+from property_manager import (
+    PropertyManager,
+    cached_property,
+    lazy_property,
+    mutable_property,
+    required_property,
+    writable_property,
+)
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 from verboselogs import VerboseLogger
 
@@ -25,10 +29,60 @@ from verboselogs import VerboseLogger
 from chat_archive.profiling import ProfileManager
 from chat_archive.utils import ensure_directory_exists
 
+SQLITE_PROFILES = dict(
+    default=dict(),
+    fast=dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-65536,
+        mmap_size=268435456,
+        temp_store="MEMORY",
+        busy_timeout=5000,
+    ),
+    safe=dict(journal_mode="WAL", synchronous="FULL", busy_timeout=5000),
+)
+"""
+Named sets of SQLite pragmas (a dictionary of dictionaries).
+
+The following profiles are available:
+
+``default``
+ Don't change any pragmas (SQLite's own defaults are used).
+
+``fast``
+ Use write-ahead logging with ``synchronous=NORMAL`` (which avoids an fsync on
+ every commit while keeping the database consistent), a 64 MiB page cache, 256
+ MiB of memory mapped I/O, in-memory temporary tables and a busy timeout of five
+ seconds. This is the default profile.
+
+``safe``
+ Use write-ahead logging with ``synchronous=FULL`` (every commit is durable).
+
+Refer to https://www.sqlite.org/pragma.html for details about these pragmas.
+"""
+
+VERSION_TABLE = "alembic_version"
+"""The name of the table in which Alembic stores the schema revision (a string)."""
+
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
 
+def get_sqlite_profile(name):
+    """
+    Get the SQLite pragmas for a named profile.
+
+    :param name: The name of a profile in :data:`SQLITE_PROFILES` (a string).
+    :returns: A dictionary with pragma names and values.
+    :raises: :exc:`~exceptions.ValueError` when the profile doesn't exist.
+    """
+    try:
+        return dict(SQLITE_PROFILES[name])
+    except KeyError:
+        msg = "Invalid SQLite profile %r! (supported profiles are %s)"
+        raise ValueError(msg % (name, ", ".join(sorted(SQLITE_PROFILES))))
+
+
 class DatabaseClient(ProfileManager):
 
     """Simple wrapper for SQLAlchemy that makes it easy to use with SQLite."""
@@ -41,13 +95,23 @@ class DatabaseClient(ProfileManager):
         documentation for details about the handling of arguments.
         """
         super(DatabaseClient, self).__init__(*args, **kw)
-        if self.database_file:
+        if self.database_file and os.path.dirname(self.database_file):
             ensure_directory_exists(os.path.dirname(self.database_file))
 
-    @lazy_property
+    @mutable_property(cached=True)
     def database_engine(self):
-        """An SQLAlchemy database engine connected to :attr:`database_url`."""
-        return create_engine(self.database_url, echo=self.echo_queries)
+        """
+        An SQLAlchemy database engine connected to :attr:`database_url`.
+
+        When the engine uses SQLite :func:`configure_connection()` is called
+        for every new database connection to apply :attr:`sqlite_pragmas`.
+        An existing engine can be provided by the caller to share a connection
+        pool between multiple :class:`DatabaseClient` objects.
+        """
+        engine = create_engine(self.database_url, echo=self.echo_queries)
+        if engine.dialect.name == "sqlite" and self.sqlite_pragmas:
+            event.listen(engine, "connect", self.configure_connection)
+        return engine
 
     @writable_property
     def database_file(self):
@@ -81,6 +145,20 @@ class DatabaseClient(ProfileManager):
         """An SQLAlchemy session factory connected to :attr:`database_engine`."""
         return sessionmaker(bind=self.database_engine)
 
+    @writable_property
+    def sqlite_pragmas(self):
+        """
+        The SQLite pragmas applied to new database connections (a dictionary).
+
+        This defaults to the pragmas of the profile given by :attr:`sqlite_profile`.
+        """
+        return get_sqlite_profile(self.sqlite_profile)
+
+    @writable_property
+    def sqlite_profile(self):
+        """The name of a profile in :data:`SQLITE_PROFILES` (a string, defaults to 'fast')."""
+        return "fast"
+
     def __exit__(self, exc_type=None, exc_value=None, traceback=None):
         """Automatically commit database changes when the :keyword:`with` block ends."""
         # Save database changes.
@@ -89,6 +167,24 @@ class DatabaseClient(ProfileManager):
         # Save profile data.
         return super(DatabaseClient, self).__exit__(exc_type, exc_value, traceback)
 
+    def configure_connection(self, dbapi_connection, connection_record):
+        """
+        Apply :attr:`sqlite_pragmas` to a new SQLite database connection.
+
+        :param dbapi_connection: A DB-API connection object.
+        :param connection_record: A :class:`sqlalchemy.pool._ConnectionRecord` object.
+
+        This is an event listener for the SQLAlchemy ``connect`` event, refer
+        to :attr:`database_engine` for details.
+        """
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in sorted(self.sqlite_pragmas.items()):
+                logger.debug("Setting SQLite pragma %s to %s ..", name, value)
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        finally:
+            cursor.close()
+
     def commit_changes(self):
         """Commit database changes to disk."""
         # Commit the changes to disk and adjust the log verbosity of
@@ -104,7 +200,13 @@ class DatabaseClient(ProfileManager):
 
 class SchemaManager(DatabaseClient):
 
-    """Easy to use database schema upgrades based on Alembic."""
+    """
+    Easy to use database schema upgrades based on Alembic.
+
+    Alembic is only imported when the database schema needs to be created or
+    upgraded (or when :attr:`schema_revision` isn't set). When the schema is
+    up to date a single query is used to check the schema revision.
+    """
 
     def __init__(self, *args, **kw):
         """
@@ -136,6 +238,8 @@ class SchemaManager(DatabaseClient):
 
         :raises: :exc:`~exceptions.ValueError` when :attr:`alembic_directory` isn't set.
         """
+        from alembic.config import Config
+
         if not self.alembic_directory:
             raise ValueError("The 'alembic_directory' option hasn't been set!")
         config = Config()
@@ -167,11 +271,25 @@ class SchemaManager(DatabaseClient):
 
     @cached_property
     def current_schema_revision(self):
-        """The current database schema revision in the database that we're connected to (a string or :data:`None`)."""
-        logger.debug("Finding Alembic current revision ..")
-        with CustomVerbosity(level="warning"):
-            context = MigrationContext.configure(self.database_engine.connect())
-            revision = context.get_current_revision()
+        """
+        The current database schema revision in the database that we're connected to (a string or :data:`None`).
+
+        The revision is selected from :data:`VERSION_TABLE` directly, Alembic
+        is only used when the table contains multiple revisions (so that it
+        can report the problem).
+        """
+        logger.debug("Finding current schema revision ..")
+        with self.database_engine.connect() as connection:
+            revisions = []
+            if self.database_engine.dialect.has_table(connection, VERSION_TABLE):
+                revisions = [row[0] for row in connection.execute(text("SELECT version_num FROM %s" % VERSION_TABLE))]
+        revision = revisions[0] if revisions else None
+        if len(revisions) > 1:
+            from alembic.migration import MigrationContext
+
+            with CustomVerbosity(level="warning"):
+                context = MigrationContext.configure(self.database_engine.connect())
+                revision = context.get_current_revision()
         if revision:
             logger.verbose("Schema revision in database is %s.", revision)
             return revision
@@ -184,13 +302,33 @@ class SchemaManager(DatabaseClient):
 
     @lazy_property
     def latest_schema_revision(self):
-        """The current schema revision according to Alembic's migration scripts (a string)."""
+        """
+        The current schema revision according to Alembic's migration scripts (a string).
+
+        When :attr:`schema_revision` is set its value is used, otherwise the
+        head revision is found using Alembic.
+        """
+        if self.schema_revision:
+            return self.schema_revision
+        from alembic.script import ScriptDirectory
+
         logger.debug("Finding Alembic head revision ..")
         migrations = ScriptDirectory.from_config(self.alembic_config)
         revision = migrations.get_current_head()
         logger.verbose("Current head (code base) database schema revision is %s.", revision)
         return revision
 
+    @writable_property
+    def schema_revision(self):
+        """
+        The head revision of the migration scripts in :attr:`alembic_directory` (a string or :data:`None`).
+
+        When this is set the schema revision in the database can be checked
+        without importing Alembic and parsing its migration scripts. It's the
+        responsibility of the caller to keep this value in sync with the
+        migration scripts.
+        """
+
     @property
     def schema_up_to_date(self):
         """:data:`True` if the database schema is up to date, :data:`False` otherwise."""
@@ -228,6 +366,8 @@ class SchemaManager(DatabaseClient):
             timer = Timer()
             logger.verbose("Checking whether database needs upgrading ..")
             if not self.current_schema_revision:
+                from alembic.command import stamp
+
                 logger.verbose("Stamping empty database with current schema revision ..")
                 with CustomVerbosity(level="warning"):
                     stamp(self.alembic_config, "head")
@@ -235,6 +375,8 @@ class SchemaManager(DatabaseClient):
                 # Invalidate cached property.
                 del self.current_schema_revision
             elif not self.schema_up_to_date:
+                from alembic.command import upgrade
+
                 logger.info("Running database migrations ..")
                 with CustomVerbosity(level="info"):
                     upgrade(self.alembic_config, "head")
@@ -245,6 +387,59 @@ class SchemaManager(DatabaseClient):
                 logger.verbose("Database schema already up to date! (took %s to check)", timer)
 
 
+class WriteSerializer(PropertyManager):
+
+    """
+    Allow only one write transaction at a time on a shared database engine.
+
+    SQLite supports a single writer at a time. When multiple threads write to
+    the same database concurrently they run into "database is locked" errors
+    (the busy timeout doesn't help when a reader tries to upgrade its
+    transaction while another connection is writing). This context manager
+    installs SQLAlchemy event listeners on :attr:`engine` that acquire
+    :attr:`lock` before a connection executes its first data modification
+    statement and release it when that connection commits or rolls back,
+    which funnels all writes through a single writer while reads stay
+    concurrent.
+    """
+
+    @required_property
+    def engine(self):
+        """The SQLAlchemy database engine whose write transactions should be serialized."""
+
+    @lazy_property
+    def lock(self):
+        """The lock that is held while a connection has a write transaction in progress (a :class:`threading.RLock`)."""
+        return threading.RLock()
+
+    def __enter__(self):
+        """Install the event listeners when entering the :keyword:`with` block."""
+        event.listen(self.engine, "before_cursor_execute", self.acquire_lock)
+        event.listen(self.engine, "commit", self.release_lock)
+        event.listen(self.engine, "rollback", self.release_lock)
+        return self
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        """Remove the event listeners when leaving the :keyword:`with` block."""
+        event.remove(self.engine, "before_cursor_execute", self.acquire_lock)
+        event.remove(self.engine, "commit", self.release_lock)
+        event.remove(self.engine, "rollback", self.release_lock)
+
+    def acquire_lock(self, connection, cursor, statement, parameters, context, executemany):
+        """Acquire :attr:`lock` before the first data modification statement of a connection."""
+        if not connection.info.get("holds_write_lock"):
+            keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+            if keyword in ("DELETE", "INSERT", "REPLACE", "UPDATE"):
+                logger.debug("Waiting for exclusive write access to the database ..")
+                self.lock.acquire()
+                connection.info["holds_write_lock"] = True
+
+    def release_lock(self, connection):
+        """Release :attr:`lock` when a connection that holds it commits or rolls back."""
+        if connection.info.pop("holds_write_lock", False):
+            self.lock.release()
+
+
 class CustomVerbosity(PropertyManager):
 
     """
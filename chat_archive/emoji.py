@@ -1,17 +1,26 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: July 15, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
-"""Utility functions to translate between various forms of smilies and emoji."""
+"""
+Utility functions to translate between various forms of smilies and emoji.
+
+The :func:`normalize_emoji()` function is called for every fragment of text
+that's rendered on the terminal, so it's optimized for the common case where a
+fragment doesn't contain any smilies or emoji macros: A single regular
+expression search decides whether translation is needed at all. Short
+fragments (such as "ok :-)") are often repeated, so their translations are
+cached. The :mod:`emoji` module (whose alias table is rather big) is only
+imported when a fragment actually contains something that looks like an
+emoji macro.
+"""
 
 # Standard library modules.
+import functools
 import re
 
-# External dependencies.
-import emoji
-
 # Public identifiers that require documentation.
 __all__ = ("normalize_emoji",)
 
@@ -40,16 +49,42 @@ TEXT_TO_EMOJI_PATTERN = re.compile(
     r"(?:^|(?<=\s))(?:%s)(?=(?:\s|$))" % "|".join(map(re.escape, TEXT_TO_EMOJI_MAPPING)), re.IGNORECASE
 )
 WHITE_TO_EMOJI_PATTERN = re.compile("|".join(WHITE_TO_EMOJI_MAPPING))
+SMILEY_PATTERN = re.compile("%s|%s" % (TEXT_TO_EMOJI_PATTERN.pattern, WHITE_TO_EMOJI_PATTERN.pattern), re.IGNORECASE)
+
+EMOJI_MACRO_PATTERN = re.compile(r":[^\s:]+:")
+"""
+A compiled regular expression pattern that matches (a superset of) the
+``:alias:`` macros recognized by :func:`emoji.emojize()`.
+"""
+
+TRIGGER_CHARACTERS = {":"} | {key[0] for key in TEXT_TO_EMOJI_MAPPING} | {key[0] for key in WHITE_TO_EMOJI_MAPPING}
+TRIGGER_PATTERN = re.compile("[%s]" % re.escape("".join(sorted(TRIGGER_CHARACTERS))))
+"""
+A compiled regular expression pattern that matches the characters that
+smilies, hollow smilies and emoji macros start with. When this pattern
+doesn't match a text, :func:`normalize_emoji()` leaves the text unchanged.
+"""
+
+CACHE_SIZE = 4096
+"""The maximum number of translations cached by :func:`normalize_emoji()` (an integer)."""
+
+CACHE_TEXT_LENGTH = 100
+"""The maximum length of texts whose translations are cached by :func:`normalize_emoji()` (an integer)."""
 
 
 def normalize_emoji(text):
     """Translate textual smilies, hollow smilies and macros to color emoji."""
-    # Translate textual smilies to color emoji.
-    text = re.sub(TEXT_TO_EMOJI_PATTERN, text_to_emoji_callback, text)
-    # Translate hollow smilies to color emoji.
-    text = re.sub(WHITE_TO_EMOJI_PATTERN, white_to_emoji_callback, text)
-    # Translate text macros to color emoji.
-    return emoji.emojize(text, use_aliases=True)
+    if not TRIGGER_PATTERN.search(text):
+        return text
+    if len(text) <= CACHE_TEXT_LENGTH:
+        return translate_emoji_cached(text)
+    return translate_emoji(text)
+
+
+def smiley_to_emoji_callback(match):
+    """Translate a textual or white smiley to a color emoji."""
+    smiley = match.group(0)
+    return WHITE_TO_EMOJI_MAPPING.get(smiley) or TEXT_TO_EMOJI_MAPPING[smiley.lower()]
 
 
 def text_to_emoji_callback(match):
@@ -60,3 +95,19 @@ def text_to_emoji_callback(match):
 def white_to_emoji_callback(match):
     """Translate a white smiley to a color emoji."""
     return WHITE_TO_EMOJI_MAPPING[match.group(0)]
+
+
+def translate_emoji(text):
+    """Translate textual smilies, hollow smilies and macros to color emoji (without caching)."""
+    # Translate textual and hollow smilies to color emoji.
+    text = SMILEY_PATTERN.sub(smiley_to_emoji_callback, text)
+    # Translate text macros to color emoji.
+    if EMOJI_MACRO_PATTERN.search(text):
+        import emoji
+
+        text = emoji.emojize(text, use_aliases=True)
+    return text
+
+
+translate_emoji_cached = functools.lru_cache(maxsize=CACHE_SIZE)(translate_emoji)
+"""A version of :func:`translate_emoji()` that caches up to :data:`CACHE_SIZE` translations."""
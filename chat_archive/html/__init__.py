@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: August 1, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """Utility functions for working with the HTML encoded text."""
@@ -21,8 +21,10 @@ from verboselogs import VerboseLogger
 __all__ = (
     "BLOCK_TAGS",
     "HTMLStripper",
+    "SIMPLE_TAG_PATTERN",
     "URL_PATTERN",
     "html_to_text",
+    "strip_simple_html",
     "text_to_html",
 )
 
@@ -33,6 +35,14 @@ A list of strings with HTML tags that are considered block-level elements. The
 element that it encounters.
 """
 
+SIMPLE_TAG_PATTERN = re.compile(r'<(?:/?(?:a|b|code|i|s|u)|a\s+href="[^"<>]*"|(br)\s*/?)>', re.IGNORECASE)
+"""
+A compiled regular expression pattern that matches the HTML tags supported by
+:func:`strip_simple_html()`: The inline formatting tags ``<a>`` (optionally
+with an ``href`` attribute), ``<b>``, ``<code>``, ``<i>``, ``<s>`` and
+``<u>`` and line breaks (``<br>``).
+"""
+
 URL_PATTERN = re.compile("(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)")
 """
 A compiled regular expression pattern to find URLs in text
@@ -50,15 +60,54 @@ def html_to_text(html_text):
     :param html_text: A fragment of HTML (a string).
     :returns: The plain text (a string).
 
-    This function uses the :class:`HTMLStripper` class that builds on top of
-    the :class:`html.parser.HTMLParser` class in the Python standard library.
+    This function uses :func:`strip_simple_html()` when possible and falls
+    back to the :class:`HTMLStripper` class that builds on top of the
+    :class:`html.parser.HTMLParser` class in the Python standard library.
     """
+    text = strip_simple_html(html_text)
+    if text is not None:
+        return text
     parser = HTMLStripper()
     parser.feed(html_text)
     parser.close()
     return parser.output.getvalue()
 
 
+def strip_simple_html(html_text):
+    """
+    Convert HTML that only uses a few simple tags to plain text.
+
+    :param html_text: A fragment of HTML (a string).
+    :returns: The plain text (a string) or :data:`None` when the HTML contains
+              tags that don't match :data:`SIMPLE_TAG_PATTERN` (in which case
+              :class:`HTMLStripper` should be used instead).
+
+    Most chat messages contain no HTML tags at all or only inline formatting
+    tags, which don't affect the plain text. Such messages are converted using
+    a single compiled regular expression and :func:`html.unescape()`, which is
+    a lot faster than :class:`html.parser.HTMLParser` and gives the same
+    result (character references are decoded per text segment, just like
+    :class:`html.parser.HTMLParser` does).
+    """
+    if "<" not in html_text:
+        return html.unescape(html_text) if "&" in html_text else html_text
+    output = []
+    position = 0
+    for match in SIMPLE_TAG_PATTERN.finditer(html_text):
+        segment = html_text[position : match.start()]
+        if "<" in segment:
+            return None
+        output.append(html.unescape(segment) if "&" in segment else segment)
+        if match.group(1):
+            output.append("\n")
+        position = match.end()
+    segment = html_text[position:]
+    if "<" in segment:
+        return None
+    output.append(html.unescape(segment) if "&" in segment else segment)
+    return "".join(output)
+
+
 def text_to_html(text, callback=None):
     """
     Convert plain text to HTML.
@@ -98,12 +147,15 @@ class HTMLStripper(html.parser.HTMLParser):
         This method calls :func:`~humanfriendly.text.compact_empty_lines()`
         on the converted text to normalize superfluous empty lines caused
         by vertical whitespace emitted around block level elements like
-        ``<div>``, ``<p>`` and ``<pre>``.
+        ``<div>``, ``<p>`` and ``<pre>``. Simple HTML is converted using
+        :func:`strip_simple_html()` instead of parsing it.
         """
-        self.reset()
-        self.feed(data)
-        self.close()
-        text = self.output.getvalue()
+        text = strip_simple_html(data)
+        if text is None:
+            self.reset()
+            self.feed(data)
+            self.close()
+            text = self.output.getvalue()
         return compact_empty_lines(text)
 
     def handle_charref(self, value):
@@ -1,20 +1,20 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: July 22, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """Utility functions for working with the HTML encoded text."""
 
 # Standard library modules.
+import collections
 import html
 import html.entities
 import html.parser
 import io
-import re
 
 # Public identifiers that require documentation.
-__all__ = ("KeywordHighlighter",)
+__all__ = ("KeywordHighlighter", "KeywordMatcher")
 
 
 class KeywordHighlighter(html.parser.HTMLParser):
@@ -32,9 +32,8 @@ class KeywordHighlighter(html.parser.HTMLParser):
         """
         # Hide keyword arguments from our superclass.
         self.highlight_template = kw.pop("highlight_template")
-        # Generate a regular expression to find keywords.
-        regex = "(%s)" % "|".join(map(re.escape, kw.pop("keywords")))
-        self.pattern = re.compile(regex, re.IGNORECASE)
+        # Build an automaton to find keywords.
+        self.matcher = KeywordMatcher(kw.pop("keywords"))
         # Initialize our superclass.
         super(KeywordHighlighter, self).__init__(*args, **kw)
 
@@ -56,12 +55,12 @@ class KeywordHighlighter(html.parser.HTMLParser):
 
     def handle_data(self, data):
         """Process textual data."""
-        for token in self.pattern.split(data):
-            escaped = html.escape(token)
-            if self.pattern.match(token):
-                self.output.write(self.highlight_template.format(text=escaped))
-            else:
-                self.output.write(escaped)
+        position = 0
+        for start, end in self.matcher.find_spans(data):
+            self.output.write(html.escape(data[position:start]))
+            self.output.write(self.highlight_template.format(text=html.escape(data[start:end])))
+            position = end
+        self.output.write(html.escape(data[position:]))
 
     def handle_endtag(self, tag):
         """Process an end tag."""
@@ -100,3 +99,93 @@ class KeywordHighlighter(html.parser.HTMLParser):
         super(KeywordHighlighter, self).reset()
         # Clear the output buffer.
         self.output = io.StringIO()
+
+
+class KeywordMatcher(object):
+
+    """
+    Case insensitive multi-pattern string search using the Aho-Corasick_ algorithm.
+
+    The automaton is built once (when the :class:`KeywordMatcher` object is
+    created) and afterwards :func:`find_spans()` finds all occurrences of all
+    keywords in a single linear scan of the text, regardless of the number of
+    keywords. Keywords and text are compared after case folding.
+
+    .. _Aho-Corasick: https://en.wikipedia.org/wiki/Aho%E2%80%93Corasick_algorithm
+    """
+
+    def __init__(self, keywords):
+        """
+        Initialize a :class:`KeywordMatcher` object.
+
+        :param keywords: An iterable of strings with keywords to find.
+        """
+        # The transitions, failure links and the length of the longest keyword
+        # that ends in each state of the automaton (state zero is the root).
+        self.transitions = [{}]
+        self.failure_links = [0]
+        self.match_lengths = [0]
+        for keyword in keywords:
+            folded = keyword.casefold()
+            if folded:
+                state = 0
+                for character in folded:
+                    next_state = self.transitions[state].get(character)
+                    if next_state is None:
+                        next_state = len(self.transitions)
+                        self.transitions.append({})
+                        self.failure_links.append(0)
+                        self.match_lengths.append(0)
+                        self.transitions[state][character] = next_state
+                    state = next_state
+                self.match_lengths[state] = len(folded)
+        # Compute the failure links in breadth first order, so that the
+        # failure link of each state points to a state that's already done.
+        pending = collections.deque(self.transitions[0].values())
+        while pending:
+            state = pending.popleft()
+            for character, next_state in self.transitions[state].items():
+                pending.append(next_state)
+                fallback = self.failure_links[state]
+                while fallback and character not in self.transitions[fallback]:
+                    fallback = self.failure_links[fallback]
+                self.failure_links[next_state] = self.transitions[fallback].get(character, 0)
+                if not self.match_lengths[next_state]:
+                    self.match_lengths[next_state] = self.match_lengths[self.failure_links[next_state]]
+
+    def find_spans(self, text):
+        """
+        Find the keywords in the given text.
+
+        :param text: The text to search (a string).
+        :returns: A list of ``(start, end)`` tuples with the indexes of the
+                  keyword matches in `text`, in ascending order. Overlapping
+                  matches are merged into a single span.
+        """
+        if len(self.transitions) == 1:
+            return []
+        folded = text.casefold()
+        # Case folding can expand a character into multiple characters (e.g.
+        # 'ß' becomes 'ss') in which case we need to map indexes back.
+        if len(folded) != len(text):
+            offsets = [i for i, c in enumerate(text) for _ in c.casefold()]
+        else:
+            offsets = None
+        spans = []
+        state = 0
+        transitions = self.transitions
+        failure_links = self.failure_links
+        match_lengths = self.match_lengths
+        for index, character in enumerate(folded):
+            while state and character not in transitions[state]:
+                state = failure_links[state]
+            state = transitions[state].get(character, 0)
+            length = match_lengths[state]
+            if length:
+                start = index + 1 - length
+                while spans and start < spans[-1][1]:
+                    start = min(start, spans.pop()[0])
+                spans.append((start, index + 1))
+        if offsets is not None:
+            spans = [(offsets[start], offsets[end - 1] + 1) for start, end in spans]
+        return spans
@@ -0,0 +1,299 @@
+# Easy to use offline chat archive.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-chat-archive
+
+"""
+Single pass rendering of chat messages on a terminal.
+
+Before a chat message is rendered on the terminal its text goes through
+several transformations:
+
+1. Plain text is converted to HTML using :func:`.text_to_html()`.
+2. Redirect URLs are expanded using :class:`.RedirectStripper`.
+3. Search keywords are highlighted using :class:`.KeywordHighlighter`.
+4. HTML is converted to ANSI escape sequences using
+   :class:`~humanfriendly.terminal.HTMLConverter`.
+
+Implemented as separate passes each step generates HTML that the next step
+parses again. The :class:`TerminalRenderer` class parses the HTML once (or
+not at all, in the case of plain text) into a list of events, applies steps
+two and three to the events and feeds the result to the event handlers of
+:class:`~humanfriendly.terminal.HTMLConverter`. The output is identical to
+that of the separate passes.
+
+Events are tuples whose first element is one of the strings 'data', 'start',
+'startend' or 'end', followed by the arguments of the corresponding
+:class:`html.parser.HTMLParser` event handler.
+"""
+
+# Standard library modules.
+import html.parser
+
+# External dependencies.
+from humanfriendly.terminal import HTMLConverter
+from humanfriendly.text import compact_empty_lines
+
+# Modules included in our package.
+from chat_archive.html import URL_PATTERN
+from chat_archive.html.keywords import KeywordHighlighter, KeywordMatcher
+from chat_archive.html.redirects import GOOGLE_REDIRECT_URL, RedirectStripper, expand_url
+from chat_archive.html.redirects import URL_PATTERN as REDIRECT_URL_PATTERN
+
+# Public identifiers that require documentation.
+__all__ = ("EventRecorder", "TerminalRenderer", "merge_data_events")
+
+
+def merge_data_events(events):
+    """
+    Merge adjacent data events.
+
+    :param events: A list of events.
+    :returns: A list of events.
+
+    When HTML is generated and parsed again, adjacent text fragments become
+    a single data event. This function has the same effect on a list of
+    events (empty data events are dropped because they don't survive a
+    round trip either).
+    """
+    merged = []
+    for event in events:
+        if event[0] == "data":
+            if not event[1]:
+                continue
+            if merged and merged[-1][0] == "data":
+                merged[-1] = ("data", merged[-1][1] + event[1])
+                continue
+        merged.append(event)
+    return merged
+
+
+class EventRecorder(html.parser.HTMLParser):
+
+    """Parse HTML into a list of events (refer to the module documentation)."""
+
+    def __call__(self, data):
+        """
+        Parse the given HTML fragment.
+
+        :param data: The HTML to parse (a string).
+        :returns: A list of events.
+        """
+        self.reset()
+        self.feed(data)
+        self.close()
+        return self.events
+
+    def handle_data(self, data):
+        """Record textual data."""
+        self.events.append(("data", data))
+
+    def handle_endtag(self, tag):
+        """Record an end tag."""
+        self.events.append(("end", tag))
+
+    def handle_starttag(self, tag, attrs):
+        """Record a start tag."""
+        self.events.append(("start", tag, attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        """Record a start tag without end tag."""
+        self.events.append(("startend", tag, attrs))
+
+    def reset(self):
+        """Reset the state of the :class:`EventRecorder`."""
+        super(EventRecorder, self).reset()
+        self.events = []
+
+
+class TerminalRenderer(HTMLConverter):
+
+    """
+    Render HTML and plain text with expanded redirects and highlighted keywords on a terminal.
+
+    This is a subclass of :class:`~humanfriendly.terminal.HTMLConverter`
+    that can be used in the same way (as a callable that converts HTML to
+    text with ANSI escape sequences), but :func:`render_html()` and
+    :func:`render_text()` also take care of redirect expansion and
+    keyword highlighting.
+    """
+
+    def __init__(self, *args, **kw):
+        """
+        Initialize a :class:`TerminalRenderer` object.
+
+        :param keywords: A list of strings with keywords to highlight (optional).
+        :param highlight_template: A template string with the ``{text}``
+                                   placeholder that's used to highlight keyword
+                                   matches (required when `keywords` is given).
+
+        Other arguments are passed on to :class:`~humanfriendly.terminal.HTMLConverter`.
+        """
+        # Hide keyword arguments from our superclass.
+        self.keywords = kw.pop("keywords", None)
+        self.highlight_template = kw.pop("highlight_template", "{text}")
+        # Build an automaton to find keywords.
+        self.keyword_matcher = KeywordMatcher(self.keywords) if self.keywords else None
+        # Parse the template used to highlight keywords.
+        self.recorder = EventRecorder()
+        prefix, _, suffix = self.highlight_template.partition("{text}")
+        self.highlight_prefix = self.recorder(prefix)
+        self.highlight_suffix = self.recorder(suffix)
+        super(TerminalRenderer, self).__init__(*args, **kw)
+
+    def expand_redirects(self, events):
+        """
+        Expand redirect URLs in a list of events.
+
+        :param events: A list of events.
+        :returns: A list of events.
+
+        This is the equivalent of :class:`.RedirectStripper`: The ``href``
+        attribute of links is expanded and links whose text is a redirect URL
+        are replaced by the expanded URL.
+        """
+        output = []
+        link_active = False
+        link_events = []
+        link_text = []
+        for event in events:
+            kind = event[0]
+            if kind == "data":
+                if link_active:
+                    link_events.append(event)
+                    link_text.append(event[1])
+                else:
+                    output.append(event)
+            elif kind == "start":
+                tag, attrs = event[1], event[2]
+                if tag == "a":
+                    attrs = dict(attrs)
+                    if attrs.get("href"):
+                        attrs["href"] = expand_url(attrs["href"])
+                    event = ("start", tag, list(attrs.items()))
+                (link_events if link_active else output).append(event)
+                # Start collecting the content of an <a> tag?
+                if tag == "a":
+                    link_active = True
+                    link_events = []
+                    link_text = []
+            elif kind == "startend":
+                (link_events if link_active else output).append(event)
+            else:
+                if event[1] == "a":
+                    text = "".join(link_text)
+                    expanded = expand_url(text) if REDIRECT_URL_PATTERN.match(text) else text
+                    if expanded != text:
+                        output.append(("data", expanded))
+                    else:
+                        output.extend(link_events)
+                    link_active = False
+                (link_events if link_active else output).append(event)
+        return merge_data_events(output)
+
+    def highlight_keywords(self, events):
+        """
+        Highlight keywords in a list of events.
+
+        :param events: A list of events.
+        :returns: A list of events.
+
+        This is the equivalent of :class:`.KeywordHighlighter`.
+        """
+        output = []
+        for event in events:
+            if event[0] == "data":
+                data = event[1]
+                position = 0
+                for start, end in self.keyword_matcher.find_spans(data):
+                    output.append(("data", data[position:start]))
+                    output.extend(self.highlight_prefix)
+                    output.append(("data", data[start:end]))
+                    output.extend(self.highlight_suffix)
+                    position = end
+                output.append(("data", data[position:]))
+            else:
+                output.append(event)
+        return merge_data_events(output)
+
+    def render_events(self, events):
+        """
+        Convert a list of events to text with ANSI escape sequences.
+
+        :param events: A list of events.
+        :returns: The rendered text (a string).
+
+        This is the equivalent of :func:`~humanfriendly.terminal.HTMLConverter.__call__()`
+        given HTML that parses to the given events.
+        """
+        self.reset()
+        for event in events:
+            kind = event[0]
+            if kind == "data":
+                self.handle_data(event[1])
+            elif kind == "start":
+                self.handle_starttag(event[1], event[2])
+            elif kind == "startend":
+                self.handle_startendtag(event[1], event[2])
+            else:
+                self.handle_endtag(event[1])
+        self.close()
+        return compact_empty_lines(self.output.getvalue())
+
+    def render_html(self, data, expand_redirects=False):
+        """
+        Render HTML on the terminal.
+
+        :param data: The HTML to render (a string).
+        :param expand_redirects: :data:`True` to expand redirect URLs,
+                                 :data:`False` otherwise.
+        :returns: The rendered text (a string).
+        """
+        expand_redirects = expand_redirects and GOOGLE_REDIRECT_URL in data
+        if not (expand_redirects or self.keyword_matcher):
+            return self(data)
+        lowercase = data.lower()
+        if "<script" in lowercase or "<style" in lowercase:
+            # The content of these tags isn't decoded by HTMLParser which
+            # means we can't substitute events for HTML. This won't happen
+            # in chat messages, but if it does we fall back to separate passes.
+            if expand_redirects:
+                data = RedirectStripper()(data)
+            if self.keyword_matcher:
+                data = KeywordHighlighter(highlight_template=self.highlight_template, keywords=self.keywords)(data)
+            return self(data)
+        events = self.recorder(data)
+        if expand_redirects:
+            events = self.expand_redirects(events)
+        if self.keyword_matcher:
+            events = self.highlight_keywords(events)
+        return self.render_events(events)
+
+    def render_text(self, text):
+        """
+        Render plain text on the terminal.
+
+        :param text: The text to render (a string).
+        :returns: The rendered text (a string).
+
+        This is the equivalent of passing the output of :func:`.text_to_html()`
+        to :func:`render_html()` with `expand_redirects` set to :data:`True`,
+        but the HTML is never actually generated or parsed.
+        """
+        events = []
+        for token in URL_PATTERN.split(text):
+            if URL_PATTERN.match(token):
+                events.append(("start", "a", [("href", token)]))
+                events.append(("data", token))
+                events.append(("end", "a"))
+            else:
+                if self.callback:
+                    token = self.callback(token)
+                events.append(("data", token))
+        events = merge_data_events(events)
+        if GOOGLE_REDIRECT_URL in text:
+            events = self.expand_redirects(events)
+        if self.keyword_matcher:
+            events = self.highlight_keywords(events)
+        return self.render_events(events)
@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: July 22, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """
@@ -18,13 +18,33 @@ the `chat-archive` program:
 - :class:`TelephoneNumber`
 """
 
+# Standard library modules.
+import collections
+
 # External dependencies.
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, UnicodeText, func
+from sqlalchemy import (
+    DDL,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UnicodeText,
+    event,
+    func,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.session import Session
 
+# Modules included in our package.
+from chat_archive.search import SEARCH_INDEX_STATEMENTS, have_fts5_support
+from chat_archive.stats import STATS_STATEMENTS
 
 # Public identifiers that require documentation.
 __all__ = (
@@ -35,6 +55,7 @@ __all__ = (
     "EmailAddress",
     "Message",
     "TelephoneNumber",
+    "UNKNOWN_CONTACT_LABEL",
     "address_mapping",
     "metadata",
     "telephone_number_mapping",
@@ -54,6 +75,9 @@ metadata = MetaData(
 Base = declarative_base(metadata=metadata)
 """The base class for declarative models."""
 
+UNKNOWN_CONTACT_LABEL = "Unknown"
+"""The label for contacts without a name or email address (a string)."""
+
 address_mapping = Table(
     "email_address_mapping",
     Base.metadata,
@@ -214,7 +238,37 @@ class Contact(Base):
     @property
     def unambiguous_name(self):
         """The shortest unambiguous name of the contact (a string or :data:`None`)."""
-        return (self.first_name if self.first_name_is_unambiguous else self.full_name) or "Unknown"
+        return (self.first_name if self.first_name_is_unambiguous else self.full_name) or UNKNOWN_CONTACT_LABEL
+
+    @staticmethod
+    def find_ambiguous_first_names(session):
+        """
+        Find the first names that are shared by contacts with different last names.
+
+        :param session: The SQLAlchemy session to query.
+        :returns: A set of strings.
+
+        This computes :attr:`first_name_is_unambiguous` for all contacts using
+        a single query, refer to :func:`get_unambiguous_name()`.
+        """
+        last_names = collections.defaultdict(set)
+        query = session.query(Contact.first_name, Contact.last_name).filter(Contact.first_name != None)
+        for first_name, last_name in query:
+            last_names[first_name].add(last_name or "")
+        return set(first_name for first_name, values in last_names.items() if len(values) > 1)
+
+    def get_unambiguous_name(self, ambiguous_first_names):
+        """
+        Get the shortest unambiguous name of the contact.
+
+        :param ambiguous_first_names: The result of :func:`find_ambiguous_first_names()`.
+        :returns: A string.
+
+        This is the equivalent of :attr:`unambiguous_name` without a query per contact.
+        """
+        if self.first_name and self.first_name not in ambiguous_first_names:
+            return self.first_name
+        return self.full_name or UNKNOWN_CONTACT_LABEL
 
     def __repr__(self):
         """Render a human friendly representation of a :class:`Contact` object."""
@@ -354,6 +408,19 @@ class Message(Base):
     recipient_id = Column(Integer, ForeignKey(Contact.id), index=True, nullable=True)
     """A foreign key that points to the contact who received this message (an integer or :data:`None`)."""
 
+    position = Column(Integer, nullable=True)
+    """
+    The position of the chat message in its conversation (an integer or :data:`None`).
+
+    The oldest message in a conversation has position one, the next message
+    has position two, etc. Positions are (re)computed by
+    :func:`~chat_archive.ChatArchive.update_message_positions()` when
+    database changes are committed, so messages that were added since the last
+    commit have the position :data:`None`. Positions make it possible to find
+    neighbouring messages and compute the distance between messages without
+    counting the messages in between.
+    """
+
     raw = Column(UnicodeText, nullable=True)
     """
     The raw message text in a backend specific format (a string or :data:`None`).
@@ -425,6 +492,8 @@ class Message(Base):
     @property
     def next_message(self):
         """The next message in the conversation (or :data:`None`)."""
+        if self.position is not None:
+            return self.find_by_position(self.position + 1)
         return self.newer_messages.order_by(Message.timestamp).first()
 
     @property
@@ -441,10 +510,38 @@ class Message(Base):
     @property
     def previous_message(self):
         """The previous message in the conversation (or :data:`None`)."""
+        if self.position is not None:
+            return self.find_by_position(self.position - 1)
         return self.older_messages.order_by(Message.timestamp.desc()).first()
 
+    def find_by_position(self, position):
+        """
+        Find a message in the same conversation based on its :attr:`position`.
+
+        :param position: The position of the message (an integer).
+        :returns: A :class:`Message` object or :data:`None`.
+        """
+        return (
+            Session.object_session(self)
+            .query(Message)
+            .filter(Message.conversation_id == self.conversation_id)
+            .filter(Message.position == position)
+            .first()
+        )
+
     def find_distance(self, other_message):
-        """Compute the distance between two messages."""
+        """
+        Compute the distance between two messages.
+
+        :param other_message: Another :class:`Message` in the same conversation.
+        :returns: The number of messages in between the two messages (an integer).
+
+        When both messages have a known :attr:`position` the distance is
+        computed without any queries, otherwise the messages in between the
+        two messages are counted.
+        """
+        if self.position is not None and other_message.position is not None:
+            return max(0, abs(self.position - other_message.position) - 1)
         return (
             Session.object_session(self)
             .query(func.count(Message.id))
@@ -472,6 +569,29 @@ class Message(Base):
 # in SQLite please refer to https://www.sqlite.org/queryplanner.html.
 Index("ix_messages_conversation_id_timestamp", Message.conversation_id, Message.timestamp)
 
+# This composite index enables indexed lookups of neighbouring messages.
+Index("ix_messages_conversation_id_position", Message.conversation_id, Message.position)
+
+# This composite index enables keyset pagination of all messages in
+# chronological order (used to stream the output of `chat-archive list').
+Index("ix_messages_timestamp_id", Message.timestamp, Message.id)
+
+# The full-text search index isn't a regular table (it's an SQLite virtual
+# table maintained by triggers) so it's created using DDL statements that are
+# executed after the regular tables have been created.
+for statement in SEARCH_INDEX_STATEMENTS:
+    event.listen(
+        metadata,
+        "after_create",
+        DDL(statement).execute_if(
+            dialect="sqlite", callable_=lambda ddl, target, bind, **kw: have_fts5_support(bind)
+        ),
+    )
+
+# The statistics table is maintained by triggers as well.
+for statement in STATS_STATEMENTS:
+    event.listen(metadata, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
 
 def friendly_repr(obj, *attributes):
     """Render a human friendly representation of a database model instance."""
@@ -0,0 +1,165 @@
+# Easy to use offline chat archive.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-chat-archive
+
+"""
+Rate limiting of requests to chat service APIs.
+
+Chat services limit the rate at which their APIs can be used and punish
+clients that exceed those limits (using HTTP 429 responses, temporary bans,
+etc). The :class:`RateLimiter` class implements a token bucket that enables
+backends to make requests at the maximum allowed rate, combined with support
+for server provided ``Retry-After`` delays and jittered exponential back off
+for failed requests. Refer to :func:`.ChatArchiveBackend.call_api()` for
+details about how backends use this.
+"""
+
+# Standard library modules.
+import asyncio
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+# External dependencies.
+from humanfriendly import format_timespan
+from property_manager import PropertyManager, lazy_property, mutable_property, required_property
+from verboselogs import VerboseLogger
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+
+class RateLimiter(PropertyManager):
+
+    """
+    Thread safe token bucket rate limiter.
+
+    The bucket holds up to :attr:`burst` tokens and is refilled at a rate of
+    :attr:`rate` tokens per second. Every request consumes a token and when
+    the bucket is empty callers are delayed until a token becomes available.
+    Delays requested by the server (see :func:`retry_after()`) apply to all
+    callers sharing the same :class:`RateLimiter` object.
+    """
+
+    @mutable_property
+    def backoff_base(self):
+        """The initial back off delay in seconds (a number, defaults to 0.5)."""
+        return 0.5
+
+    @mutable_property
+    def backoff_max(self):
+        """The maximum back off delay in seconds (a number, defaults to 60)."""
+        return 60
+
+    @mutable_property
+    def burst(self):
+        """The maximum number of requests that can be made without delay (a number, defaults to :attr:`rate`)."""
+        return max(1, self.rate)
+
+    @lazy_property
+    def lock(self):
+        """A :class:`threading.Lock` object that protects the state of the token bucket."""
+        return threading.Lock()
+
+    @required_property
+    def rate(self):
+        """The sustained number of requests per second (a number)."""
+
+    @mutable_property
+    def tokens(self):
+        """The number of tokens in the bucket (a number, starts out equal to :attr:`burst`)."""
+        return self.burst
+
+    @mutable_property
+    def blocked_until(self):
+        """The :func:`time.monotonic()` value until which all requests are delayed (a number)."""
+        return 0
+
+    @mutable_property(cached=True)
+    def updated(self):
+        """The :func:`time.monotonic()` value at which the bucket was last refilled (a number)."""
+        return time.monotonic()
+
+    def reserve(self):
+        """
+        Consume a token from the bucket.
+
+        :returns: The number of seconds that the caller should wait before
+                  making its request (a number, zero when no delay is needed).
+
+        When the bucket is empty the token is borrowed from the future, this
+        way concurrent callers are queued up in fair, evenly spaced intervals.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            delay = max(0, -self.tokens / self.rate, self.blocked_until - now)
+        if delay > 0:
+            logger.debug("Rate limiting request by %s ..", format_timespan(delay))
+        return delay
+
+    def wait(self):
+        """Wait until a request can be made (blocks the current thread)."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        """Wait until a request can be made (yields to the :mod:`asyncio` event loop)."""
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def retry_after(self, seconds):
+        """
+        Delay all requests by the given number of seconds.
+
+        :param seconds: The number of seconds to wait (a number).
+
+        This is used to implement ``Retry-After`` headers and similar
+        server provided instructions (e.g. Telegram's flood wait errors).
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        logger.notice("Pausing requests for %s (as instructed by server) ..", format_timespan(seconds))
+
+    def backoff_delay(self, attempt):
+        """
+        Get the back off delay for a failed request.
+
+        :param attempt: The number of failed attempts so far (an integer, starting at one).
+        :returns: The number of seconds to wait before retrying (a number).
+
+        This implements exponential back off with "full jitter" (a random
+        delay between zero and the exponential delay) to avoid concurrent
+        clients retrying in lockstep.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+
+def parse_retry_after(value):
+    """
+    Parse the value of a ``Retry-After`` header.
+
+    :param value: The value of the header (a string, an integer or :data:`None`).
+    :returns: The number of seconds to wait (a number) or :data:`None` when
+              the value can't be parsed.
+
+    Both the delay-seconds and the HTTP-date forms of the header are supported.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        try:
+            moment = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        now = datetime.datetime.now(moment.tzinfo)
+        return max(0, (moment - now).total_seconds())
@@ -0,0 +1,183 @@
+# Easy to use offline chat archive.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-chat-archive
+
+"""
+Full-text search support for the `chat-archive` program based on SQLite FTS5_.
+
+Searching the chat archive used to be implemented using one ``LIKE '%...%'``
+filter per keyword, which forces SQLite to scan the full ``messages`` table on
+every search. This module defines an FTS5_ virtual table that indexes the
+message text together with the names and email addresses that are relevant to
+searches, so that :func:`~chat_archive.ChatArchive.search_messages()` can use
+an index driven ``MATCH`` query instead.
+
+The search index is kept up to date using SQLite triggers, this way all code
+paths that add, change or delete messages, contacts, conversations and email
+addresses (the backends, but also the ``chat-archive unknown`` command)
+automatically update the search index without having to know about it.
+
+.. _FTS5: https://www.sqlite.org/fts5.html
+"""
+
+# Public identifiers that require documentation.
+__all__ = (
+    "SEARCH_INDEX_COLUMNS",
+    "SEARCH_INDEX_SOURCE",
+    "SEARCH_INDEX_STATEMENTS",
+    "SEARCH_INDEX_TABLE",
+    "compile_match_expression",
+    "have_fts5_support",
+    "index_messages_sql",
+    "is_indexable_keyword",
+    "populate_search_index",
+    "reindex_messages_sql",
+)
+
+SEARCH_INDEX_TABLE = "messages_fts"
+"""The name of the FTS5 virtual table (a string)."""
+
+SEARCH_INDEX_COLUMNS = ("backend", "account", "conversation", "sender", "email_addresses", "timestamp", "text")
+"""The names of the columns in the FTS5 virtual table (a tuple of strings)."""
+
+SEARCH_INDEX_SOURCE = """
+    SELECT messages.id,
+           accounts.backend,
+           accounts.name,
+           conversations.name,
+           TRIM(COALESCE(contacts.first_name, '') || ' ' || COALESCE(contacts.last_name, '')),
+           (SELECT GROUP_CONCAT(email_addresses.value, ' ')
+              FROM email_address_mapping
+              JOIN email_addresses ON email_addresses.id = email_address_mapping.address_id
+             WHERE email_address_mapping.contact_id = messages.sender_id),
+           messages.timestamp,
+           messages.text
+      FROM messages
+      JOIN conversations ON conversations.id = messages.conversation_id
+      JOIN accounts ON accounts.id = conversations.account_id
+      LEFT JOIN contacts ON contacts.id = messages.sender_id
+     WHERE {condition}
+"""
+"""
+An SQL query that selects the values to be indexed (a format string).
+
+The ``{condition}`` placeholder needs to be filled in with an SQL expression
+that selects the messages to be (re)indexed.
+"""
+
+
+def index_messages_sql(condition):
+    """
+    Generate an SQL statement that adds messages to the search index.
+
+    :param condition: An SQL expression that selects the messages to index.
+    :returns: An SQL statement (a string).
+    """
+    return "INSERT INTO {table} (rowid, {columns}) {source}".format(
+        table=SEARCH_INDEX_TABLE,
+        columns=", ".join(SEARCH_INDEX_COLUMNS),
+        source=SEARCH_INDEX_SOURCE.format(condition=condition).strip(),
+    )
+
+
+def reindex_messages_sql(condition):
+    """
+    Generate SQL statements that reindex the messages that match a condition.
+
+    :param condition: An SQL expression that selects the messages to reindex.
+    :returns: A string with two semicolon terminated SQL statements.
+    """
+    return "DELETE FROM {table} WHERE rowid IN (SELECT messages.id FROM messages WHERE {condition}); {insert};".format(
+        table=SEARCH_INDEX_TABLE, condition=condition, insert=index_messages_sql(condition)
+    )
+
+
+SEARCH_INDEX_STATEMENTS = (
+    # The full-text index itself. Prefix indexes speed up the prefix
+    # queries generated by compile_match_expression().
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5({columns}, prefix='2 3')".format(
+        table=SEARCH_INDEX_TABLE, columns=", ".join(SEARCH_INDEX_COLUMNS)
+    ),
+    # Index new messages.
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN %s; END"
+    % index_messages_sql("messages.id = NEW.id"),
+    # Reindex changed messages.
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update"
+    " AFTER UPDATE OF conversation_id, sender_id, text, timestamp ON messages BEGIN"
+    " DELETE FROM %s WHERE rowid = OLD.id; %s; END" % (SEARCH_INDEX_TABLE, index_messages_sql("messages.id = NEW.id")),
+    # Remove deleted messages from the index.
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN"
+    " DELETE FROM %s WHERE rowid = OLD.id; END" % SEARCH_INDEX_TABLE,
+    # Reindex the messages sent by contacts whose name changed.
+    "CREATE TRIGGER IF NOT EXISTS contacts_fts_update AFTER UPDATE OF first_name, last_name ON contacts BEGIN %s END"
+    % reindex_messages_sql("messages.sender_id = NEW.id"),
+    # Reindex the messages sent by contacts whose email addresses changed.
+    "CREATE TRIGGER IF NOT EXISTS email_address_mapping_fts_insert AFTER INSERT ON email_address_mapping BEGIN %s END"
+    % reindex_messages_sql("messages.sender_id = NEW.contact_id"),
+    "CREATE TRIGGER IF NOT EXISTS email_address_mapping_fts_delete AFTER DELETE ON email_address_mapping BEGIN %s END"
+    % reindex_messages_sql("messages.sender_id = OLD.contact_id"),
+    # Reindex the messages in conversations whose name changed.
+    "CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF name ON conversations BEGIN %s END"
+    % reindex_messages_sql("messages.conversation_id = NEW.id"),
+    # Reindex the messages in accounts that were renamed.
+    "CREATE TRIGGER IF NOT EXISTS accounts_fts_update AFTER UPDATE OF backend, name ON accounts BEGIN %s END"
+    % reindex_messages_sql("messages.conversation_id IN (SELECT id FROM conversations WHERE account_id = NEW.id)"),
+)
+"""The SQL statements that create the search index and the triggers that maintain it (a tuple of strings)."""
+
+
+def compile_match_expression(keywords):
+    """
+    Convert search keywords to an FTS5 ``MATCH`` expression.
+
+    :param keywords: A list of strings with search keywords.
+    :returns: An FTS5 query expression (a string).
+
+    Each keyword is quoted as a phrase (so that punctuation like the dashes in
+    ``2018-07`` doesn't cause FTS5 syntax errors) and the last token of each
+    phrase is treated as a prefix. All keywords need to match, although they
+    can match in different columns. Because FTS5 matches tokens instead of
+    substrings, a keyword can no longer match in the middle of a word.
+    """
+    return " AND ".join('"%s"*' % kw.replace('"', '""') for kw in keywords)
+
+
+def is_indexable_keyword(keyword):
+    """
+    Check whether a search keyword can be matched using the search index.
+
+    :param keyword: A string with a search keyword.
+    :returns: :data:`True` if the keyword contains at least one alphanumeric
+              character, :data:`False` otherwise.
+
+    FTS5 ignores punctuation, so a keyword like ``-`` or ``:)`` compiles to an
+    empty phrase that never matches anything (while the ``LIKE`` based search
+    does match such keywords).
+    """
+    return any(c.isalnum() for c in keyword)
+
+
+def have_fts5_support(connection):
+    """
+    Check whether the SQLite library supports FTS5.
+
+    :param connection: An SQLAlchemy connection to an SQLite database.
+    :returns: :data:`True` if FTS5 is available, :data:`False` otherwise.
+    """
+    return bool(connection.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+
+def populate_search_index(connection):
+    """
+    Index all existing messages.
+
+    :param connection: An SQLAlchemy connection to an SQLite database.
+
+    This is used by the database migration that introduces the search index,
+    to backfill the index for messages that were imported before the search
+    index existed.
+    """
+    connection.execute("DELETE FROM %s" % SEARCH_INDEX_TABLE)
+    connection.execute(index_messages_sql("1"))
@@ -0,0 +1,96 @@
+# Easy to use offline chat archive.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-chat-archive
+
+"""
+Materialized statistics about the local chat archive.
+
+The ``chat-archive stats`` command used to count the messages in the archive
+and sum the lengths of their text and HTML, which requires a full scan of the
+``messages`` table (that can easily be gigabytes of text). This module defines
+a table with counters per conversation that's kept up to date using SQLite
+triggers (the same approach used by :mod:`chat_archive.search`), so that all
+code paths that add, change or delete messages automatically update the
+counters. Statistics per account or for the archive as a whole are computed
+by summing the counters, which only involves one row per conversation.
+"""
+
+# Public identifiers that require documentation.
+__all__ = (
+    "STATS_COLUMNS",
+    "STATS_STATEMENTS",
+    "STATS_TABLE",
+    "populate_archive_stats",
+    "update_stats_sql",
+)
+
+STATS_TABLE = "archive_stats"
+"""The name of the table with statistics per conversation (a string)."""
+
+STATS_COLUMNS = ("num_messages", "num_html_messages", "text_size", "html_size")
+"""
+The names of the counters in the statistics table (a tuple of strings).
+
+The sizes are the sum of the lengths of the plain text and HTML of messages
+as computed by the SQL ``LENGTH()`` function (i.e. in characters).
+"""
+
+
+def update_stats_sql(row, sign):
+    """
+    Generate SQL statements that add a message to (or subtract it from) the statistics.
+
+    :param row: The name of the row in a trigger (the string 'NEW' or 'OLD').
+    :param sign: The string '+' to add the message or '-' to subtract it.
+    :returns: A string with two semicolon terminated SQL statements.
+    """
+    return (
+        "INSERT OR IGNORE INTO {table} (conversation_id) VALUES ({row}.conversation_id); "
+        "UPDATE {table} SET num_messages = num_messages {sign} 1, "
+        "num_html_messages = num_html_messages {sign} ({row}.html IS NOT NULL), "
+        "text_size = text_size {sign} COALESCE(LENGTH({row}.text), 0), "
+        "html_size = html_size {sign} COALESCE(LENGTH({row}.html), 0) "
+        "WHERE conversation_id = {row}.conversation_id;"
+    ).format(table=STATS_TABLE, row=row, sign=sign)
+
+
+STATS_STATEMENTS = (
+    # The statistics table itself.
+    "CREATE TABLE IF NOT EXISTS {table} (conversation_id INTEGER PRIMARY KEY, {columns})".format(
+        table=STATS_TABLE, columns=", ".join("%s INTEGER NOT NULL DEFAULT 0" % name for name in STATS_COLUMNS)
+    ),
+    # Count new messages.
+    "CREATE TRIGGER IF NOT EXISTS messages_stats_insert AFTER INSERT ON messages BEGIN %s END"
+    % update_stats_sql("NEW", "+"),
+    # Recount changed messages.
+    "CREATE TRIGGER IF NOT EXISTS messages_stats_update"
+    " AFTER UPDATE OF conversation_id, html, text ON messages BEGIN %s %s END"
+    % (update_stats_sql("OLD", "-"), update_stats_sql("NEW", "+")),
+    # Subtract deleted messages.
+    "CREATE TRIGGER IF NOT EXISTS messages_stats_delete AFTER DELETE ON messages BEGIN %s END"
+    % update_stats_sql("OLD", "-"),
+    # Forget about deleted conversations.
+    "CREATE TRIGGER IF NOT EXISTS conversations_stats_delete AFTER DELETE ON conversations BEGIN"
+    " DELETE FROM %s WHERE conversation_id = OLD.id; END" % STATS_TABLE,
+)
+"""The SQL statements that create the statistics table and the triggers that maintain it (a tuple of strings)."""
+
+
+def populate_archive_stats(connection):
+    """
+    Compute the statistics of all conversations from scratch.
+
+    :param connection: An SQLAlchemy connection (or session) to an SQLite database.
+
+    This is used by the database migration that introduces the statistics
+    table and by ``chat-archive stats --recompute``.
+    """
+    connection.execute("DELETE FROM %s" % STATS_TABLE)
+    connection.execute(
+        "INSERT INTO {table} (conversation_id, {columns}) SELECT conversation_id, COUNT(*), COUNT(html),"
+        " COALESCE(SUM(LENGTH(text)), 0), COALESCE(SUM(LENGTH(html)), 0) FROM messages GROUP BY conversation_id".format(
+            table=STATS_TABLE, columns=", ".join(STATS_COLUMNS)
+        )
+    )
@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: August 1, 2018
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """
@@ -17,17 +17,38 @@ priorities 😇.
 """
 
 # Standard library modules.
+import asyncio
+import datetime
 import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import types
 import urllib.parse
 
 # External dependencies.
-from humanfriendly.testing import TestCase
+from humanfriendly.testing import CaptureOutput, TestCase
+from sqlalchemy import event, func
+from telethon.errors import FloodWaitError
 
 # Modules included in our package.
 from chat_archive import ChatArchive
-from chat_archive.html.redirects import expand_url
+from chat_archive.backends import ChatArchiveBackend, pre_process_message
+from chat_archive.cli import UserInterface
+from chat_archive.emoji import normalize_emoji
+from chat_archive.html import html_to_text, strip_simple_html
+from chat_archive.html.keywords import KeywordHighlighter, KeywordMatcher
+from chat_archive.html.redirects import RedirectStripper, expand_url
+from chat_archive.html.terminal import TerminalRenderer
+from chat_archive.models import Account, Contact, Conversation, EmailAddress, Message
+from chat_archive.ratelimit import RateLimiter, parse_retry_after
 
 # Ugly way to raise coverage.
+import chat_archive
 import chat_archive.cli
 import chat_archive.html.keywords
 import chat_archive.emoji
@@ -43,6 +64,46 @@ class ChatArchiveTestCase(TestCase):
     def get_test_archive(self):
         return ChatArchive(database_file=':memory:')
 
+    def get_import_times(self, *arguments, **environment):
+        """Run the command line interface with ``python -X importtime`` and return the import times (in seconds)."""
+        script = 'import sys; sys.argv[1:] = %r; from chat_archive.cli import main; main()' % (arguments,)
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            env=dict(os.environ, **environment),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        assert process.returncode == 0, process.stderr
+        import_times = {}
+        for line in process.stderr.splitlines():
+            match = re.match(r'^import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)$', line)
+            if match:
+                cumulative, indent, name = match.groups()
+                import_times[name] = (int(cumulative) / 1e6, len(indent) == 1)
+        return import_times
+
+    def get_populated_archive(self, num_messages=20, archive=None):
+        """Create an in-memory archive with a single conversation between two contacts."""
+        archive = archive or self.get_test_archive()
+        account = Account(backend='slack', name='default')
+        alice = Contact(account=account, first_name='Alice', last_name='Example')
+        alice.email_addresses.append(EmailAddress(value='alice@example.com'))
+        bob = Contact(account=account, first_name='Bob')
+        conversation = Conversation(account=account, name='#general', is_group_conversation=True)
+        start = datetime.datetime(2018, 7, 1, 12, 0, 0)
+        for i in range(num_messages):
+            archive.session.add(Message(
+                conversation=conversation,
+                sender=alice if i % 2 == 0 else bob,
+                text='Message number %i' % i,
+                timestamp=start + datetime.timedelta(minutes=i),
+            ))
+        archive.session.add(conversation)
+        archive.changed_conversations.add(conversation)
+        archive.commit_changes()
+        return archive
+
     def test_expand_url(self):
         """Test the :func:`~chat_archive.html.redirects.expand_url()` function."""
         target_url = 'https://www.python.org/'
@@ -50,6 +111,708 @@ class ChatArchiveTestCase(TestCase):
             redirect_url = '%s://www.google.com/url?q=%s' % (scheme, urllib.parse.quote(target_url))
             assert expand_url(redirect_url) == target_url
 
+    def test_pre_process_message(self):
+        """Test the :func:`~chat_archive.backends.pre_process_message()` function."""
+        redirect_url = 'https://www.google.com/url?q=%s' % urllib.parse.quote('https://www.python.org/')
+        text, html = pre_process_message(redirect_url, '<a href="%s">link</a>' % redirect_url, RedirectStripper())
+        assert text == 'https://www.python.org/'
+        assert html == '<a href="https://www.python.org/">link</a>'
+        # HTML that equals the text is dropped.
+        assert pre_process_message('Hello world!', 'Hello world!', RedirectStripper()) == ('Hello world!', None)
+
+    def test_search_messages(self):
+        """Test searching the chat archive using the full-text search index."""
+        archive = self.get_populated_archive()
+        assert archive.have_search_index
+
+        def search(*keywords):
+            return sorted(m.text for m in archive.search_messages(keywords))
+        # Search for message text (including prefix matches).
+        assert search('number', '7') == ['Message number 7']
+        assert search('numb') == ['Message number %i' % i for i in sorted(range(20), key=str)]
+        # Search for contact names, email addresses and conversation names.
+        assert len(search('alice')) == 10
+        assert len(search('alice@example.com')) == 10
+        assert len(search('general')) == 20
+        assert search('bob', '13') == ['Message number 13']
+        # Keywords match the start of words (not the middle of words).
+        assert len(search('2018-07')) == 20
+        assert search('umber') == []
+        assert len(archive.search_messages_like(['umber']).all()) == 20
+        # Keywords without alphanumeric characters use the LIKE based search.
+        assert len(search('alice', '@')) == 10
+        assert search(':)') == []
+        # Changes to contacts and messages should update the search index.
+        bob = archive.session.query(Contact).filter(Contact.first_name == 'Bob').one()
+        bob.first_name = 'Robert'
+        archive.commit_changes()
+        assert search('bob') == []
+        assert len(search('robert')) == 10
+        for message in archive.search_messages(['number', '3']):
+            archive.session.delete(message)
+        archive.commit_changes()
+        assert search('number', '3') == []
+
+    def test_archive_stats(self):
+        """Test the statistics table that's maintained by triggers."""
+        archive = self.get_populated_archive()
+        assert archive.have_archive_stats
+
+        def check(**expected):
+            stats = archive.get_archive_stats()
+            assert list(stats.values()) == list(archive.session.query(
+                func.count(Message.id),
+                func.count(Message.html),
+                func.coalesce(func.sum(func.length(Message.text)), 0),
+                func.coalesce(func.sum(func.length(Message.html)), 0),
+            ).one())
+            for name, value in expected.items():
+                assert stats[name] == value
+        check(num_messages=20, num_html_messages=0, text_size=sum(len('Message number %i' % i) for i in range(20)))
+        # Changes to messages should update the statistics.
+        message = archive.session.query(Message).filter(Message.text == 'Message number 1').one()
+        message.html = '<b>Message number 1</b>'
+        message.text = 'Changed'
+        archive.session.delete(archive.session.query(Message).filter(Message.text == 'Message number 2').one())
+        archive.commit_changes()
+        check(num_messages=19, num_html_messages=1, html_size=len(message.html))
+        # The statistics can be recomputed from scratch.
+        archive.session.execute('UPDATE archive_stats SET num_messages = 0')
+        archive.recompute_archive_stats()
+        check(num_messages=19)
+        # The database migration populates the statistics of existing messages.
+        with tempfile.TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'database.sqlite3')
+            self.get_populated_archive(archive=ChatArchive(database_file=database_file))
+            archive = ChatArchive(database_file=database_file, auto_upgrade_schema=False)
+            archive.session.execute('DROP TABLE archive_stats')
+            archive.session.execute("UPDATE alembic_version SET version_num = 'eb22932072aa'")
+            archive.session.commit()
+            archive = ChatArchive(database_file=database_file)
+            check(num_messages=20)
+
+    def test_gather_context(self):
+        """Test the gathering of context around search results."""
+        program = self.get_populated_archive(archive=UserInterface(database_file=':memory:', context=2))
+
+        def search(*keywords):
+            results = program.search_messages(keywords)
+            return [int(m.text.split()[-1]) for m in program.gather_context(results)]
+        # Context at the start and end of the conversation is truncated.
+        assert search('number 0') == [0, 1, 2]
+        assert search('number 19') == [17, 18, 19]
+        assert search('number 5') == [3, 4, 5, 6, 7]
+        # Overlapping windows are merged without duplicates and
+        # disjoint windows are emitted in chronological order.
+        assert search('number 1') == [0, 1, 2, 3, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19]
+        program.context = 1
+        assert search('number 1') == [0, 1, 2, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19]
+
+    def test_render_messages(self):
+        """Test that rendering messages uses a constant number of queries."""
+        def render(num_messages, page_size=1000):
+            program = self.get_populated_archive(
+                archive=UserInterface(database_file=':memory:', page_size=page_size, prefetch_size=5, use_colors=False),
+                num_messages=num_messages,
+            )
+            program.session.expire_all()
+            statements = []
+            event.listen(program.database_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            with CaptureOutput() as capturer:
+                program.list_cmd([])
+            return capturer.get_text(), len(statements)
+        output, num_queries = render(10)
+        assert 'Slack group chat #general with 2 participants (Alice and Bob)' in output
+        assert 'Alice: Message number 0' in output
+        assert 'Bob: Message number 9' in output
+        assert render(50)[1] == num_queries
+        # When the messages are streamed in multiple pages
+        # each additional page takes one additional query.
+        assert render(50, page_size=3)[1] <= num_queries + 50 // 3
+
+    def test_unknown_senders(self):
+        """Test assigning messages from unknown senders to a new contact."""
+        program = UserInterface(database_file=':memory:', use_colors=False)
+        account = Account(backend='telegram', name='default')
+        start = datetime.datetime(2018, 7, 1, 12, 0, 0)
+        for is_group_conversation in (False, True):
+            conversation = Conversation(account=account, is_group_conversation=is_group_conversation)
+            for i in range(15):
+                program.session.add(Message(
+                    conversation=conversation,
+                    text='Message number %i' % i,
+                    timestamp=start + datetime.timedelta(minutes=i),
+                ))
+        program.commit_changes()
+        prompts = []
+        original_prompt = chat_archive.cli.prompt_for_input
+        chat_archive.cli.prompt_for_input = lambda text: prompts.append(text) or 'Charlie Example'
+        try:
+            with CaptureOutput() as capturer:
+                program.unknown_cmd([])
+        finally:
+            chat_archive.cli.prompt_for_input = original_prompt
+        assert len(prompts) == 1
+        assert 'Message number 9' in capturer.get_text()
+        assert 'Message number 10' not in capturer.get_text()
+        charlie = program.session.query(Contact).filter(Contact.first_name == 'Charlie').one()
+        assert charlie.last_name == 'Example'
+        assert len(charlie.sent_messages) == 15
+        assert program.session.query(Message).filter(Message.sender_id == None).count() == 15
+
+    def test_unambiguous_names(self):
+        """Test computing the shortest unambiguous names of contacts."""
+        archive = self.get_test_archive()
+        account = Account(backend='slack', name='default')
+        contacts = [
+            Contact(account=account, first_name='Alice', last_name='Smith'),
+            Contact(account=account, first_name='Alice', last_name='Jones'),
+            Contact(account=account, first_name='Bob'),
+            Contact(account=account),
+        ]
+        archive.session.add_all(contacts)
+        archive.commit_changes()
+        ambiguous_first_names = Contact.find_ambiguous_first_names(archive.session)
+        assert ambiguous_first_names == {'Alice'}
+        names = [c.get_unambiguous_name(ambiguous_first_names) for c in contacts]
+        assert names == ['Alice Smith', 'Alice Jones', 'Bob', 'Unknown']
+        assert names == [c.unambiguous_name for c in contacts]
+
+    def test_stream_messages(self):
+        """Test streaming all messages using keyset pagination."""
+        program = self.get_populated_archive(
+            archive=UserInterface(database_file=':memory:', page_size=3, prefetch_size=4, use_colors=False),
+            num_messages=10,
+        )
+        # Add messages with duplicate timestamps to check that pagination
+        # doesn't skip or repeat messages that share a timestamp.
+        conversation = program.session.query(Conversation).one()
+        for i in range(10, 15):
+            program.session.add(Message(
+                conversation=conversation,
+                text='Message number %i' % i,
+                timestamp=datetime.datetime(2018, 7, 1, 12, 5, 0),
+            ))
+        program.commit_changes()
+        expected = [m.id for m in program.session.query(Message).order_by(Message.timestamp, Message.id)]
+        program.session.expunge_all()
+        assert [m.id for m in program.stream_messages()] == expected
+        # Rendered messages are expunged from the session (the page size
+        # doesn't need to match the prefetch size for this to work).
+        program.session.expunge_all()
+        with CaptureOutput() as capturer:
+            program.list_cmd([])
+        assert 'Message number 14' in capturer.get_text()
+        assert not any(isinstance(obj, Message) for obj in program.session)
+
+    def test_schema_revision(self):
+        """Test that the schema revision constant matches the migration scripts."""
+        from alembic.script import ScriptDirectory
+        from chat_archive import SCHEMA_REVISION
+        with tempfile.TemporaryDirectory() as directory:
+            database_file = os.path.join(directory, 'database.sqlite3')
+            ChatArchive(database_file=database_file)
+            archive = ChatArchive(database_file=database_file)
+            assert archive.current_schema_revision == SCHEMA_REVISION
+            assert archive.schema_up_to_date
+        head = ScriptDirectory.from_config(archive.alembic_config).get_current_head()
+        assert head == SCHEMA_REVISION, 'SCHEMA_REVISION needs to be updated to %s!' % head
+
+    def test_import_time(self):
+        """Test that the command line interface starts without importing heavy dependencies."""
+        with tempfile.TemporaryDirectory() as directory:
+            ChatArchive(database_file=os.path.join(directory, 'database.sqlite3'))
+            for arguments in (['--help'], ['stats']):
+                import_times = self.get_import_times(*arguments, CHAT_ARCHIVE_DIRECTORY=directory)
+                assert 'chat_archive.cli' in import_times
+                for name in import_times:
+                    assert name.split('.')[0] not in LAZY_DEPENDENCIES, '%s imported by %s!' % (name, arguments)
+                total = sum(seconds for seconds, toplevel in import_times.values() if toplevel)
+                assert total < IMPORT_TIME_BUDGET, 'Imports took %.2fs (budget is %.2fs)!' % (total, IMPORT_TIME_BUDGET)
+
+    def test_sqlite_profiles(self):
+        """Test the configuration of SQLite pragmas using profiles."""
+        with tempfile.TemporaryDirectory() as directory:
+            def query(archive, pragma):
+                return archive.session.execute('PRAGMA %s' % pragma).scalar()
+            archive = ChatArchive(database_file=os.path.join(directory, 'fast.sqlite3'), sqlite_profile='fast')
+            assert query(archive, 'journal_mode') == 'wal'
+            assert query(archive, 'synchronous') == 1
+            assert query(archive, 'temp_store') == 2
+            archive.session.close()
+            archive = ChatArchive(
+                database_file=os.path.join(directory, 'custom.sqlite3'),
+                sqlite_pragmas=dict(busy_timeout=1234),
+            )
+            assert query(archive, 'journal_mode') == 'delete'
+            assert query(archive, 'busy_timeout') == 1234
+            archive.session.close()
+        self.assertRaises(ValueError, ChatArchive, database_file=':memory:', sqlite_profile='nonexistent')
+
+    def test_message_positions(self):
+        """Test the numbering of messages in conversations."""
+        self.check_message_positions()
+        # Older versions of SQLite number the messages in Python.
+        chat_archive.SQLITE_HAS_UPDATE_FROM = False
+        try:
+            self.check_message_positions()
+        finally:
+            chat_archive.SQLITE_HAS_UPDATE_FROM = True
+
+    def check_message_positions(self):
+        """Check the numbering of messages in conversations."""
+        archive = self.get_populated_archive()
+        messages = archive.session.query(Message).order_by(Message.timestamp).all()
+        assert [m.position for m in messages] == list(range(1, 21))
+        assert messages[5].next_message is messages[6]
+        assert messages[5].previous_message is messages[4]
+        assert messages[0].previous_message is None
+        assert messages[-1].next_message is None
+        assert messages[3].find_distance(messages[10]) == 6
+        assert messages[10].find_distance(messages[11]) == 0
+        # Importing an older message causes the conversation to be renumbered.
+        conversation = messages[0].conversation
+        older = Message(conversation=conversation, text='Older message', timestamp=datetime.datetime(2018, 1, 1))
+        archive.session.add(older)
+        archive.changed_conversations.add(conversation)
+        archive.commit_changes()
+        assert older.position == 1
+        assert older.next_message is messages[0]
+        assert [m.position for m in messages] == list(range(2, 22))
+        # Importing newer messages (newest first) appends them to the conversation.
+        newer = [
+            Message(conversation=conversation, text='Newer message %i' % i, timestamp=datetime.datetime(2030, 1, i))
+            for i in (3, 2, 1)
+        ]
+        archive.session.add_all(newer)
+        archive.changed_conversations.add(conversation)
+        archive.commit_changes()
+        assert [m.position for m in newer] == [24, 23, 22]
+        assert [m.position for m in messages] == list(range(2, 22))
+        # Importing a message in the middle renumbers the following messages.
+        middle = Message(conversation=conversation, text='Middle message', timestamp=messages[9].timestamp)
+        archive.session.add(middle)
+        archive.changed_conversations.add(conversation)
+        archive.commit_changes()
+        assert middle.position == 12
+        assert middle.previous_message is messages[9]
+        assert [m.position for m in messages[:10]] == list(range(2, 12))
+        assert [m.position for m in messages[10:]] == list(range(13, 23))
+        assert [m.position for m in newer] == [25, 24, 23]
+
+    def test_batched_message_import(self):
+        """Test the batched import of messages by backends."""
+        archive = self.get_test_archive()
+        backend = ChatArchiveBackend(
+            account_name='default', archive=archive, backend_name='slack', stats=archive.import_stats
+        )
+        conversation = backend.get_or_create_conversation(external_id='C1234')
+        alice = backend.get_or_create_contact(external_id='U1234', first_name='Alice')
+        start = datetime.datetime(2018, 7, 1, 12, 0, 0)
+
+        def page(*numbers):
+            return [
+                dict(
+                    external_id=str(i),
+                    html='<b>Message %i</b>' % i,
+                    sender=alice,
+                    text='Message %i' % i,
+                    timestamp=start + datetime.timedelta(minutes=i),
+                )
+                for i in numbers
+            ]
+        created = backend.get_or_create_messages(conversation, page(3, 4, 5))
+        assert [m['external_id'] for m in created] == ['3', '4', '5']
+        # Existing messages are skipped, new messages are added.
+        created = backend.get_or_create_messages(conversation, page(1, 2, 3))
+        assert [m['external_id'] for m in created] == ['1', '2']
+        assert archive.import_stats.messages_added == 5
+        archive.commit_changes()
+        messages = archive.session.query(Message).order_by(Message.timestamp).all()
+        assert [m.position for m in messages] == [1, 2, 3, 4, 5]
+        assert all(m.sender is alice and m.conversation is conversation for m in messages)
+        assert messages[0].html == '<b>Message 1</b>'
+        assert [m.text for m in archive.search_messages(['alice', 'message 4'])] == ['Message 4']
+
+    def test_concurrent_synchronization(self):
+        """Test synchronizing multiple accounts concurrently."""
+        with tempfile.TemporaryDirectory() as directory:
+            archive = DummyArchive(database_file=os.path.join(directory, 'database.sqlite3'), jobs=3)
+            archive.synchronize('dummy:one', 'dummy:two', 'dummy:three', 'dummy:four')
+            assert archive.import_stats.conversations_added == 4
+            assert archive.import_stats.messages_added == 40
+            assert archive.num_conversations == 4
+            assert archive.num_messages == 40
+            positions = archive.session.query(Message.position).filter(Message.position != None)
+            assert sorted(row[0] for row in positions) == sorted(list(range(1, 11)) * 4)
+            archive.session.close()
+
+    def test_batched_email_download(self):
+        """Test downloading Google Talk emails in batches."""
+        from chat_archive.backends.gtalk import GoogleTalkBackend
+        with tempfile.TemporaryDirectory() as directory:
+            archive = ChatArchive(database_file=':memory:', data_directory=directory)
+            client = FakeIMAPClient()
+            backend = GoogleTalkBackend(
+                account_name='default',
+                archive=archive,
+                backend_name='gtalk',
+                client=client,
+                fetch_batch_size=2,
+                stats=archive.import_stats,
+            )
+            assert list(backend.download_batches([1, 2, 3, 4, 5])) == [[1, 2], [3, 4], [5]]
+            assert client.requests == ['1,2', '3,4', '5']
+            assert [e.messages[0].text.strip() for e in backend.parse_batches([[3]])] == ['Email 3']
+            # Cached emails aren't downloaded again.
+            list(backend.download_batches([1, 2, 3, 4, 5, 6]))
+            assert client.requests == ['1,2', '3,4', '5', '6']
+            # The connection is used by the thread that logged in (which isn't
+            # the main thread when accounts are synchronized in parallel).
+            backend.config.update(email='alice@example.com', password='secret')
+            thread = threading.Thread(
+                target=lambda: (backend.login_to_server(), list(backend.download_batches([7, 8])))
+            )
+            thread.start()
+            thread.join()
+            assert client.requests == ['1,2', '3,4', '5', '6', '7,8']
+            assert backend.extra_clients == []
+            # Batches are downloaded in parallel but only a few batches ahead.
+            backend.fetch_connections = 2
+            backend.get_client = lambda: client
+            batches = backend.download_batches(list(range(10, 20)))
+            assert next(batches) == [10, 11]
+            batches.close()
+            assert len(client.requests) == 5 + 3
+
+    def test_email_synchronization(self):
+        """Test synchronizing Google Talk emails that the IMAP server fails to return."""
+        from chat_archive.backends.gtalk import GoogleTalkBackend
+        with tempfile.TemporaryDirectory() as directory:
+            archive = ChatArchive(database_file=':memory:', data_directory=directory)
+            client = FakeIMAPClient(available=[1, 2, 3], omitted=[2])
+            backend = GoogleTalkBackend(
+                account_name='default',
+                archive=archive,
+                backend_name='gtalk',
+                client=client,
+                stats=archive.import_stats,
+            )
+            backend.config.update(email='alice@example.com', password='secret')
+            # Emails that weren't returned are skipped (and retried later).
+            assert backend.download_batch([1, 2, 3]) == [1, 3]
+            backend.synchronize()
+            assert sorted(m.text.strip() for m in archive.session.query(Message)) == ['Email 1', 'Email 3']
+            assert client.logged_out
+            # The connection is closed when the import fails.
+            client = FakeIMAPClient(available=[1, 2, 3, 4])
+            backend.client = client
+            backend.import_singlepart_email = lambda parsed_email: 1 / 0
+            self.assertRaises(ZeroDivisionError, backend.synchronize)
+            assert client.logged_out
+
+    def test_parallel_email_parsing(self):
+        """Test parsing cached Google Talk emails in worker processes."""
+        from chat_archive.backends.gtalk import GoogleTalkBackend
+        with tempfile.TemporaryDirectory() as directory:
+            for processes, jobs in (1, 1), (2, 1), (2, 2):
+                archive = ChatArchive(database_file=':memory:', data_directory=directory, jobs=jobs)
+                backend = GoogleTalkBackend(
+                    account_name='default',
+                    archive=archive,
+                    backend_name='gtalk',
+                    client=FakeIMAPClient(),
+                    parse_processes=processes,
+                    stats=archive.import_stats,
+                )
+                with open(backend.get_cache_file(1), 'w') as handle:
+                    handle.write(SINGLEPART_EMAIL)
+                with open(backend.get_cache_file(2), 'w') as handle:
+                    handle.write(MULTIPART_EMAIL)
+                for parsed_email in backend.parse_batches([[1, 2]]):
+                    if parsed_email.is_multipart:
+                        backend.import_multipart_email(parsed_email)
+                    else:
+                        backend.import_singlepart_email(parsed_email)
+                archive.commit_changes()
+                messages = archive.session.query(Message).order_by(Message.timestamp).all()
+                assert [m.text.strip() for m in messages] == ['Hello Bob!', 'Hi Alice', 'How are you?']
+                assert messages[0].html.strip() == '<b>Hello Bob!</b>'
+                assert str(messages[1].sender) == 'Bob'
+                assert str(messages[1].recipient) == 'Alice'
+                assert archive.num_conversations == 2
+
+    def test_concurrent_hangouts_download(self):
+        """Test downloading Google Hangouts conversations concurrently."""
+        from chat_archive.backends.hangouts import HangoutsBackend
+        archive = self.get_test_archive()
+        backend = HangoutsBackend(
+            account_name='default',
+            archive=archive,
+            backend_name='hangouts',
+            concurrency=3,
+            stats=archive.import_stats,
+        )
+        conversations = [types.SimpleNamespace(id_='C%i' % i) for i in range(10)]
+        conversation_list = types.SimpleNamespace(get_all=lambda include_archived: conversations)
+        active = set()
+        visited = []
+        max_active = []
+
+        async def download_conversation(conversation):
+            active.add(conversation.id_)
+            max_active.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(conversation.id_)
+            if conversation.id_ == 'C1':
+                raise Exception('Simulated synchronization error')
+            with backend.stats:
+                backend.stats.conversations_added += 1
+                await asyncio.sleep(0)
+                backend.stats.messages_added += 5
+            visited.append(conversation.id_)
+
+        backend.download_conversation = download_conversation
+        asyncio.new_event_loop().run_until_complete(backend.download_all_conversations(conversation_list))
+        assert max(max_active) == 3
+        assert sorted(visited) == sorted(c.id_ for c in conversations if c.id_ != 'C1')
+        assert archive.import_stats.failed_conversations == 1
+        assert archive.import_stats.conversations_added == 9
+        assert archive.import_stats.messages_added == 45
+
+    def test_concurrent_slack_download(self):
+        """Test downloading the history of Slack channels concurrently."""
+        from chat_archive.backends.slack import SlackBackend
+        archive = self.get_test_archive()
+        backend = SlackBackend(
+            account_name='default',
+            archive=archive,
+            backend_name='slack',
+            concurrency=2,
+            request_rate=1000,
+            stats=archive.import_stats,
+        )
+        conversations = [
+            backend.get_or_create_conversation(external_id=channel_id, name='#%s' % channel_id)
+            for channel_id in ('one', 'two', 'three')
+        ]
+        backend.import_conversations((FakeSlackHistory(), c) for c in conversations)
+        archive.commit_changes()
+        assert archive.num_messages == 3 * 6
+        assert all(c.import_complete for c in conversations)
+        # Errors in download threads are propagated to the caller.
+        broken = backend.get_or_create_conversation(external_id='broken')
+        self.assertRaises(ValueError, backend.import_conversations, [
+            (FakeSlackHistory(), conversations[0]),
+            (FakeSlackHistory(error=ValueError()), broken),
+        ])
+        assert not broken.import_complete
+        # Errors while importing stop the download threads.
+        history = FakeSlackHistory(num_pages=10)
+        backend.import_page = lambda conversation, page: 1 / 0
+        self.assertRaises(ZeroDivisionError, backend.import_conversations, [
+            (history, backend.get_or_create_conversation(external_id='c%i' % i)) for i in range(10)
+        ])
+        assert history.num_requests < 10
+
+    def test_concurrent_telegram_download(self):
+        """Test synchronizing Telegram dialogs concurrently."""
+        from chat_archive.backends.telegram import TelegramBackend
+        with tempfile.TemporaryDirectory() as directory:
+            archive = self.get_test_archive()
+            client = FakeTelegramClient(num_dialogs=3, num_messages=25)
+            backend = TelegramBackend(
+                account_name='default',
+                api_hash='secret',
+                api_id=42,
+                archive=archive,
+                backend_name='telegram',
+                batch_size=10,
+                client=client,
+                concurrency=2,
+                request_rate=1000,
+                session_file=os.path.join(directory, 'session'),
+                stats=archive.import_stats,
+            )
+            asyncio.new_event_loop().run_until_complete(backend.connect_then_sync())
+            assert archive.num_messages == 3 * 25
+            assert all(c.import_complete for c in archive.session.query(Conversation))
+            # The flood wait error was retried.
+            assert client.flood_wait_raised
+            # New messages are downloaded incrementally.
+            client.num_messages = 30
+            client.date += datetime.timedelta(minutes=1)
+            asyncio.new_event_loop().run_until_complete(backend.connect_then_sync())
+            archive.commit_changes()
+            assert archive.num_messages == 3 * 30
+            assert all(min_id == 25 for dialog_id, min_id in client.requests[-3:])
+            # Errors while importing stop the downloads (without leaving tasks pending).
+            client.num_messages = 60
+            client.date += datetime.timedelta(minutes=1)
+            backend.import_messages = lambda conversation, page: 1 / 0
+            loop = asyncio.new_event_loop()
+            self.assertRaises(ZeroDivisionError, loop.run_until_complete, backend.connect_then_sync())
+            assert not [t for t in asyncio.all_tasks(loop) if not t.done()]
+
+    def test_slack_html_converter(self):
+        """Test the conversion of Slack messages from mrkdwn to HTML."""
+        from chat_archive.backends.slack import HTMLConverter
+        from chat_archive.benchmarks import SLACK_CORPUS, benchmark_slack_converter
+        convert = HTMLConverter()
+        assert convert('*bold* _italic_ ~strike~') == '<b>bold</b> <i>italic</i> <s>strike</s>'
+        assert convert('*bold with _italic_*') == '<b>bold with <i>italic</i></b>'
+        assert convert('snake_case_name 2*3*4') == 'snake_case_name 2*3*4'
+        assert convert('`a < b` &amp; c') == '<code>a &lt; b</code> &amp; c'
+        assert convert('<https://example.com|example>') == '<a href="https://example.com">example</a>'
+        assert convert('```\n<https://example.com>\n```') == '<pre>https://example.com</pre>'
+        # The optimized implementation produces the same output as the reference
+        # implementation, both for real messages and random combinations of
+        # formatting characters (excluding ones that hang the reference).
+        random_generator = random.Random(42)
+        fuzzed = [''.join(random_generator.choice('ab *_~`>|\n') for i in range(20)) for j in range(1000)]
+        benchmark_slack_converter(SLACK_CORPUS + fuzzed, repeat=1)
+
+    def test_rerender_messages(self):
+        """Test regenerating the HTML and text of Slack messages from their raw text."""
+        from chat_archive.backends.slack import SlackBackend
+        archive = self.get_test_archive()
+        account = Account(backend='slack', name='default')
+        alice = Contact(account=account, external_id='U1', first_name='Alice', last_name='Example')
+        conversation = Conversation(account=account, external_id='C1', name='#general')
+        timestamp = datetime.datetime(2018, 7, 1, 12, 0, 0)
+        for i in range(5):
+            archive.session.add(Message(
+                conversation=conversation,
+                raw='Hi <@U1>, *bold* %i' % i,
+                sender=alice,
+                text='stale %i' % i,
+                timestamp=timestamp,
+            ))
+        archive.session.add(Message(conversation=conversation, raw='plain', text='plain', timestamp=timestamp))
+        archive.session.add(Message(conversation=conversation, text='no raw text', timestamp=timestamp))
+        archive.commit_changes()
+        backend = SlackBackend(
+            account_name='default',
+            archive=archive,
+            backend_name='slack',
+            render_batch_size=2,
+            render_processes=2,
+            stats=archive.import_stats,
+        )
+        assert backend.rerender_messages() == 5
+        archive.commit_changes()
+        messages = archive.session.query(Message).filter(Message.raw != None).order_by(Message.id).all()
+        assert messages[0].html == 'Hi <b>@Alice</b>, <b>bold</b> 0'
+        assert messages[0].text == 'Hi @Alice, bold 0'
+        assert messages[-1].html is None
+        # Only messages after the given message id are processed.
+        for message in messages:
+            message.text = 'stale'
+        archive.commit_changes()
+        backend.render_processes = 1
+        assert backend.rerender_messages(start_id=messages[2].id) == 3
+        # The archive re-renders all accounts with raw text.
+        assert archive.rerender_messages() == 3
+
+    def test_html_to_text(self):
+        """Test the fast path of the conversion from HTML to plain text."""
+        from chat_archive.benchmarks import benchmark_html_to_text
+        assert strip_simple_html('<b>Bold</b> &amp; <a href="https://example.com">link</a><br/>') == 'Bold & link\n'
+        assert strip_simple_html('<p>Paragraph</p>') is None
+        assert strip_simple_html('a < b') is None
+        assert html_to_text('<p>a < b</p>') == '\n\na < b\n\n'
+        # The fast path produces the same output as HTMLParser.
+        random_generator = random.Random(42)
+        tokens = ['<b>', '</b>', '<I>', '<a href="?a=1&amp;b=2">', '</a>', '<br>', '&lt;', '&am', 'p;', 'text', ' ']
+        fuzzed = [''.join(random_generator.choice(tokens) for i in range(10)) for j in range(1000)]
+        benchmark_html_to_text(fuzzed, repeat=1)
+
+    def test_keyword_highlighter(self):
+        """Test highlighting of search keywords in HTML."""
+        highlighter = KeywordHighlighter(highlight_template='[{text}]', keywords=['he', 'she', 'hers', 'Straße'])
+        assert highlighter('<b>Ushers</b> &amp; <i>HE</i>') == '<b>U[shers]</b> &amp; <i>[HE]</i>'
+        assert highlighter('a < b, STRASSE') == 'a &lt; b, [STRASSE]'
+        matcher = KeywordMatcher(['strasse'])
+        assert matcher.find_spans('Die Straße') == [(4, 10)]
+        assert KeywordMatcher([]).find_spans('anything') == []
+
+    def test_normalize_emoji(self):
+        """Test the translation of smilies and emoji macros to color emoji."""
+        from chat_archive.benchmarks import TEXT_CORPUS, benchmark_normalize_emoji
+        assert normalize_emoji('ok :-) \u263a :thumbsup:') == 'ok \U0001f642 \U0001f642 \U0001f44d'
+        assert normalize_emoji('no smilies here') == 'no smilies here'
+        # The fast path and the cache don't change the output.
+        random_generator = random.Random(42)
+        tokens = [':', ';', ')', '-', 'p', 'P', ' ', '\n', 'thumbsup', 'tada', '\u263a', '\u2639', '\U0001f60a\ufe0e']
+        fuzzed = [''.join(random_generator.choice(tokens) for i in range(10)) for j in range(1000)]
+        benchmark_normalize_emoji(fuzzed + TEXT_CORPUS + ['%s :-)' % ('x' * 200)], repeat=1)
+
+    def test_terminal_renderer(self):
+        """Test that the single pass terminal renderer is equivalent to the multi-pass pipeline."""
+        from chat_archive.benchmarks import TEXT_CORPUS, benchmark_terminal_renderer
+        renderer = TerminalRenderer(highlight_template='[{text}]', keywords=['link'])
+        redirect = 'https://www.google.com/url?q=https://example.com/&amp;sa=D'
+        assert renderer.render_html('<a href="%s">%s</a>' % (redirect, redirect), expand_redirects=True) == (
+            '\x1b[0m\x1b[4;94mhttps://example.com/\x1b[0m'
+        )
+        assert renderer.render_html('a <b>link</b>') == 'a \x1b[0m\x1b[1m[link]\x1b[0m'
+        assert renderer.render_text('<link> https://example.com/') == (
+            '<[link]> \x1b[0m\x1b[4;94mhttps://example.com/\x1b[0m'
+        )
+        # The output is identical to that of the multi-pass pipeline.
+        random_generator = random.Random(42)
+        tokens = [
+            '<b>', '</b>', '<i>', '<a href="%s">%s</a>' % (redirect, redirect), '<a href="%s">the</a>' % redirect,
+            redirect, 'https://example.com/the', '<br>',
+            '<p>', '</p>', '<pre>', '</pre>', '&lt;', '&', ':-)', 'build', 'The', 'slack', ' ', '\n',
+        ]
+        fuzzed = [''.join(random_generator.choice(tokens) for i in range(10)) for j in range(500)]
+        corpus = [(html_text, None) for html_text in fuzzed] + [(None, text) for text in fuzzed + TEXT_CORPUS]
+        benchmark_terminal_renderer(corpus, repeat=1)
+
+    def test_rate_limiter(self):
+        """Test the token bucket rate limiter."""
+        limiter = RateLimiter(rate=10, burst=2)
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == 0
+        assert 0.05 < limiter.reserve() <= 0.1
+        limiter.retry_after(30)
+        assert limiter.reserve() > 29
+        assert 0 <= limiter.backoff_delay(3) <= limiter.backoff_base * 4
+        assert parse_retry_after('5') == 5
+        assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        assert parse_retry_after('bogus') is None
+
+    def test_api_retries(self):
+        """Test retrying failed API requests."""
+        archive = self.get_test_archive()
+        backend = DummyBackend(
+            account_name='default',
+            archive=archive,
+            backend_name='dummy',
+            stats=archive.import_stats,
+        )
+        backend.rate_limiter.backoff_base = 0.001
+        backend.is_retryable = lambda e: isinstance(e, IOError)
+        attempts = []
+
+        def flaky_request(value):
+            attempts.append(value)
+            if len(attempts) < 3:
+                raise IOError()
+            return value
+        assert backend.call_api(flaky_request, 42) == 42
+        assert len(attempts) == 3
+        # Requests are attempted at most retry_count times.
+        backend.retry_count = 2
+        attempts[:] = []
+        self.assertRaises(IOError, backend.call_api, flaky_request, 42)
+        assert len(attempts) == 2
+        # Exceptions that aren't retryable are raised immediately.
+        attempts[:] = []
+        self.assertRaises(ZeroDivisionError, backend.call_api, lambda: [attempts.append(1), 1 / 0])
+        assert len(attempts) == 1
+
     def test_backend_discovery(self):
         """Test the discovery of backends through entry points."""
         archive = self.get_test_archive()
@@ -58,9 +821,205 @@ class ChatArchiveTestCase(TestCase):
         assert 'hangouts' in archive.backends
         assert 'slack' in archive.backends
         assert 'telegram' in archive.backends
+        # Friendly names are available without importing backend modules.
+        sys.modules.pop('chat_archive.backends.hangouts', None)
+        assert archive.get_backend_name('hangouts') == 'Google Hangouts'
+        assert 'chat_archive.backends.hangouts' not in sys.modules
 
     def test_backend_loading(self):
         """Test the importing of backend modules."""
         archive = self.get_test_archive()
         for name in sorted(archive.backends):
             archive.load_backend_module(name)
+
+
+IMPORT_TIME_BUDGET = 1.0
+"""The maximum number of seconds that ``chat-archive --help`` and ``chat-archive stats`` may spend importing modules."""
+
+LAZY_DEPENDENCIES = {'alembic', 'emoji', 'hangups', 'qpass', 'slacker', 'telethon'}
+"""Top level modules that shouldn't be imported by ``chat-archive --help`` and ``chat-archive stats``."""
+
+SINGLEPART_EMAIL = """\
+From: Alice <alice@example.com>
+To: Bob <bob@example.com>
+Date: Sun, 1 Jul 2018 12:00:00 +0000
+Content-Type: text/html; charset=utf-8
+
+<b>Hello Bob!</b>
+"""
+
+MULTIPART_EMAIL = """\
+From: Bob <bob@example.com>
+To: Alice <alice@example.com>
+Date: Sun, 1 Jul 2018 13:00:00 +0000
+Content-Type: multipart/alternative; boundary="boundary"
+
+--boundary
+Content-Type: text/xml; charset=utf-8
+
+<con:conversation xmlns:con="google:archive:conversation">\
+<cli:message xmlns:cli="jabber:client" to="alice@example.com" from="bob@example.com/resource">\
+<cli:body>Hi Alice</cli:body><time xmlns="google:timestamp" ms="1530450000000"/></cli:message>\
+<cli:message xmlns:cli="jabber:client" to="alice@example.com" from="bob@example.com/resource">\
+<cli:body>How are you?</cli:body><time xmlns="google:timestamp" ms="1530450060000"/></cli:message>\
+</con:conversation>
+--boundary--
+"""
+
+
+class FakeIMAPClient(object):
+
+    """A fake IMAP client that responds to ``UID SEARCH`` and ``UID FETCH`` commands."""
+
+    def __init__(self, available=(), omitted=()):
+        """Initialize a :class:`FakeIMAPClient` object."""
+        self.available = available
+        self.logged_out = False
+        self.omitted = omitted
+        self.requests = []
+
+    def login(self, user, password):
+        """Pretend to log in."""
+        return 'OK', [b'Logged in']
+
+    def logout(self):
+        """Pretend to log out."""
+        self.logged_out = True
+
+    def select(self, folder, readonly):
+        """Pretend to select a folder."""
+        return 'OK', [b'%i' % len(self.available)]
+
+    def uid(self, command, uids, parts):
+        """Respond to a ``UID FETCH`` command (the UID is reported after the message body for even UIDs)."""
+        if command == 'search':
+            return 'OK', [' '.join(map(str, self.available)).encode('ascii')]
+        self.requests.append(uids)
+        data = []
+        for i, uid in enumerate(map(int, uids.split(',')), start=1):
+            if uid in self.omitted:
+                continue
+            body = (
+                b'From: Alice <alice@example.com>\r\n'
+                b'To: Bob <bob@example.com>\r\n'
+                b'Date: Sun, 1 Jul 2018 12:00:00 +0000\r\n'
+                b'Content-Type: text/html; charset=utf-8\r\n'
+                b'\r\n'
+                b'<b>Email %i</b>\r\n' % uid
+            )
+            if uid % 2 == 0:
+                data.append((b'%i (RFC822 {%i}' % (i, len(body)), body))
+                data.append(b' UID %i)' % uid)
+            else:
+                data.append((b'%i (UID %i RFC822 {%i}' % (i, uid, len(body)), body))
+                data.append(b')')
+        return 'OK', data
+
+
+class FakeSlackHistory(object):
+
+    """A fake Slack API that provides the history of channels in pages of three messages."""
+
+    def __init__(self, num_pages=2, error=None):
+        """Initialize a :class:`FakeSlackHistory` object."""
+        self.num_pages = num_pages
+        self.num_requests = 0
+        self.error = error
+
+    def history(self, channel, latest, oldest, count):
+        """Get a page of messages (paging backward from ``latest``)."""
+        self.num_requests += 1
+        if self.error:
+            raise self.error
+        newest = int(float(latest)) - 1 if latest else self.num_pages * 3
+        messages = [
+            dict(ts='%i.000100' % ts, type='message', user='U%i' % (ts % 2), text='Message *%i*' % ts)
+            for ts in range(newest, max(newest - 3, 0), -1)
+        ]
+        return FakeSlackResponse(body=dict(messages=messages, has_more=newest > 3))
+
+
+class FakeTelegramClient(object):
+
+    """A fake :class:`telethon.TelegramClient` with group conversations that contain numbered messages."""
+
+    def __init__(self, num_dialogs, num_messages):
+        """Initialize a :class:`FakeTelegramClient` object."""
+        self.date = datetime.datetime(2026, 10, 16, 12, 0)
+        self.flood_wait_raised = False
+        self.num_dialogs = num_dialogs
+        self.num_messages = num_messages
+        self.requests = []
+        self.sender = types.SimpleNamespace(id=42, first_name='Bob', last_name=None, phone=None)
+
+    async def start(self, **options):
+        """Pretend to log in."""
+
+    async def get_dialogs(self, limit):
+        """Get the group conversations."""
+        return [
+            types.SimpleNamespace(
+                date=self.date,
+                entity=None,
+                id=dialog_id,
+                is_channel=False,
+                is_group=True,
+                is_user=False,
+                name='Group %i' % dialog_id,
+            )
+            for dialog_id in range(1, self.num_dialogs + 1)
+        ]
+
+    async def get_messages(self, dialog, limit, max_id, min_id, offset_id):
+        """Get a page of messages (paging backward from ``offset_id``)."""
+        await asyncio.sleep(0)
+        if dialog.id == 1 and not self.flood_wait_raised:
+            self.flood_wait_raised = True
+            raise FloodWaitError(request=None, capture=0)
+        self.requests.append((dialog.id, min_id))
+        newest = min([self.num_messages] + [i - 1 for i in (max_id, offset_id) if i])
+        return [
+            types.SimpleNamespace(
+                date=self.date + datetime.timedelta(seconds=i),
+                entities=None,
+                id=i,
+                message='Message %i' % i,
+                sender=self.sender,
+                to_id=types.SimpleNamespace(channel_id=dialog.id),
+            )
+            for i in range(newest, max(newest - limit, min_id), -1)
+        ]
+
+
+class FakeSlackResponse(object):
+
+    """A fake Slack API response."""
+
+    def __init__(self, body):
+        """Initialize a :class:`FakeSlackResponse` object."""
+        self.body = body
+
+
+class DummyArchive(ChatArchive):
+
+    """A :class:`.ChatArchive` that only knows about :class:`DummyBackend`."""
+
+    @property
+    def backends(self):
+        """Refer to :class:`DummyBackend`."""
+        return dict(dummy=__name__)
+
+
+class DummyBackend(ChatArchiveBackend):
+
+    """A backend that imports ten messages without talking to a chat service."""
+
+    def synchronize(self):
+        """Import ten messages into a single conversation."""
+        conversation = self.get_or_create_conversation(external_id='general', name='#general')
+        start = datetime.datetime(2018, 7, 1, 12, 0, 0)
+        self.get_or_create_messages(conversation, [
+            dict(external_id=str(i), text='Message %i' % i, timestamp=start + datetime.timedelta(minutes=i))
+            for i in range(10)
+        ])
+        self.archive.commit_changes()
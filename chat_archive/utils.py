@@ -1,7 +1,7 @@
 # Easy to use offline chat archive.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 27, 2020
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-chat-archive
 
 """Utility functions for the `chat-archive` program."""
@@ -16,7 +16,6 @@ import time
 
 # External dependencies.
 from humanfriendly import format
-from qpass import PasswordStore
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
@@ -83,7 +82,12 @@ def get_secret_from_store(name, directory=None):
     :returns: The secret (a string).
     :raises: :exc:`exceptions.ValueError` when the given `name` doesn't match
              any entries or matches multiple entries in the password store.
+
+    The :mod:`qpass` module is imported on demand because most invocations
+    of the `chat-archive` program don't need it.
     """
+    from qpass import PasswordStore
+
     kw = dict(directory=directory) if directory else {}
     store = PasswordStore(**kw)
     matches = store.smart_search(name)